@@ -0,0 +1,183 @@
+"""
+Benchmark of the API, running in-process with embedded backends:
+local filesystem (SeaweedFS), SQLite (MongoDB), memory cache and local lock (Redis)
+
+$ python -m benchmark.api_benchmark --output result.json
+
+Result is a JSON list, one record per (operation, size, format) with throughput and latency percentiles,
+it can be compared between commits to find regressions.
+"""
+import argparse
+import json
+import logging
+import math
+import os
+import sys
+import tempfile
+import time
+from io import BytesIO
+from typing import Callable, List
+
+from PIL import Image
+
+log = logging.getLogger(__file__)
+
+
+def create_test_image(size: int, image_format: str) -> bytes:
+    """
+    Create an image with both smooth area and noise, which is more like a photo than random pixels
+    :param size: width and height
+    :param image_format: format to encode
+    :return:
+    """
+    im = Image.merge("RGB", [
+        Image.effect_noise((size, size), 48),
+        Image.linear_gradient("L").resize((size, size)),
+        Image.radial_gradient("L").resize((size, size)),
+    ])
+    with BytesIO() as fp:
+        im.save(fp, format=image_format)
+        return fp.getvalue()
+
+
+def percentile(values: List[float], p: float) -> float:
+    """
+    Nearest-rank percentile: the smallest value which is not less than p% of the values
+    """
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, math.ceil(p / 100.0 * len(values)) - 1))
+    return values[index]
+
+
+def measure(operation: str, size: int, image_format: str, func: Callable[[int], None], repeat: int) -> dict:
+    """
+    Run func(i) repeatedly and summarize the latency
+    """
+    latencies = []
+    start_time = time.perf_counter()
+    for i in range(repeat):
+        tick = time.perf_counter()
+        func(i)
+        latencies.append(time.perf_counter() - tick)
+    total_time = time.perf_counter() - start_time
+    result = {
+        "operation": operation,
+        "size": size,
+        "format": image_format,
+        "count": repeat,
+        "throughput": repeat / total_time,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "mean_ms": sum(latencies) / repeat * 1000,
+    }
+    log.info("{operation} size={size} format={format}: {throughput:.2f}/s "
+             "p50={p50_ms:.3f}ms p99={p99_ms:.3f}ms".format(**result))
+    return result
+
+
+def run_benchmark(client, cache, sizes: List[int], formats: List[str], repeat: int) -> List[dict]:
+    results = []
+
+    def check(resp):
+        if resp.status_code != 200:
+            raise Exception("Request failed ({}): {}".format(resp.status_code, resp.text))
+        return resp
+
+    for size in sizes:
+        for image_format in formats:
+            # Noise differs in every image, so the uploads are different files, not copies of one image
+            images = [create_test_image(size, image_format) for _ in range(repeat)]
+            fids = []
+            hashes = []
+
+            def upload(i):
+                resp = check(client.post(
+                    "/upload",
+                    files={"file": ("image", images[i])},
+                    params={"mode": "keep", "attach_info": json.dumps({"i": i})},
+                ))
+                fids.append(resp.json()["fid"])
+                hashes.append(resp.json()["hash"])
+
+            results.append(measure("upload", size, image_format, upload, repeat))
+
+            fid = fids[0]
+            # Fill the cache before measuring
+            check(client.get("/image/{}".format(fid), params={"rescale": 0.5}))
+            results.append(measure(
+                "get_cached", size, image_format,
+                lambda i: check(client.get("/image/{}".format(fid), params={"rescale": 0.5})),
+                repeat
+            ))
+
+            def get_uncached(i):
+                cache.clean_all()
+                check(client.get("/image/{}".format(fid), params={"rescale": 0.5, "image_format": "webp"}))
+
+            results.append(measure("get_uncached_transform", size, image_format, get_uncached, repeat))
+
+            results.append(measure(
+                "list_images", size, image_format,
+                lambda i: check(client.get("/list/image/{}".format(hashes[0]))),
+                repeat
+            ))
+            results.append(measure(
+                "list_hashes", size, image_format,
+                lambda i: check(client.get("/list/hash")),
+                repeat
+            ))
+
+            results.append(measure(
+                "delete", size, image_format,
+                lambda i: check(client.delete("/image/{}".format(fids[i]))),
+                repeat
+            ))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark Nemivir API in-process")
+    parser.add_argument("--sizes", default="256,1024,2048", help="image sizes, separated by comma")
+    parser.add_argument("--formats", default="jpeg,png,webp", help="image formats, separated by comma")
+    parser.add_argument("--repeat", type=int, default=50, help="repeat times of each operation")
+    parser.add_argument("--output", default=None, help="file to save JSON result, default is stdout")
+    args = parser.parse_args()
+    # Keep the logs of API and HTTP client away from the result
+    logging.basicConfig(level=logging.WARNING, stream=sys.stderr)
+    log.setLevel(logging.INFO)
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        os.environ.update(
+            FILESYSTEM_BACKEND="local",
+            LOCAL_FS_ROOT=os.path.join(data_dir, "files"),
+            META_BACKEND="sqlite",
+            SQLITE_META=os.path.join(data_dir, "meta.db"),
+            CACHE_BACKEND="memory",
+            LOCK_BACKEND="local",
+        )
+        from fastapi.testclient import TestClient
+        from nemivir.config import cache
+        from nemivir.service.image_api import app
+
+        results = run_benchmark(
+            TestClient(app),
+            cache.resource,
+            [int(s) for s in args.sizes.split(",")],
+            args.formats.split(","),
+            args.repeat
+        )
+
+    report = json.dumps({
+        "time": int(time.time()),
+        "python": sys.version.split()[0],
+        "results": results,
+    }, indent=2)
+    if args.output is None:
+        print(report)
+    else:
+        with open(args.output, "w") as fp:
+            fp.write(report)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+"""
+Benchmark matrix of transform engines: decode, resize (to half) and encode in the same format
+
+$ python -m benchmark.engine_benchmark --sizes 1024,4096 --output engines.json
+
+The fastest engine of each format (by total time of the 3 operations) is reported as IMAGE_ENGINES setting.
+"""
+import argparse
+import json
+import logging
+import sys
+import time
+from collections import defaultdict
+from typing import List
+
+from benchmark.api_benchmark import create_test_image
+from nemivir.image.engine import ENGINES
+
+log = logging.getLogger(__file__)
+
+
+def measure_engine(engine, data: bytes, image_format: str, repeat: int) -> dict:
+    """
+    Measure the mean time (in milliseconds) of each operation
+    """
+    timing = defaultdict(float)
+    for _ in range(repeat):
+        tick = time.perf_counter()
+        bitmap = engine.decode(data)
+        timing["decode"] += time.perf_counter() - tick
+
+        width, height = engine.get_size(bitmap)
+        tick = time.perf_counter()
+        resized = engine.resize(bitmap, (width // 2, height // 2))
+        timing["resize"] += time.perf_counter() - tick
+
+        tick = time.perf_counter()
+        engine.encode(resized, image_format)
+        timing["encode"] += time.perf_counter() - tick
+    result = {op: t / repeat * 1000 for op, t in timing.items()}
+    result["total"] = sum(result.values())
+    return result
+
+
+def run_benchmark(sizes: List[int], formats: List[str], repeat: int) -> dict:
+    engines = [engine_class() for engine_class in ENGINES.values() if engine_class.available()]
+    results = []
+    for image_format in formats:
+        for size in sizes:
+            data = create_test_image(size, image_format)
+            for engine in engines:
+                if not engine.supports(image_format):
+                    continue
+                result = {
+                    "engine": engine.name,
+                    "format": image_format,
+                    "size": size,
+                    **measure_engine(engine, data, image_format, repeat)
+                }
+                log.info("{engine} {format} size={size}: decode={decode:.3f}ms resize={resize:.3f}ms "
+                         "encode={encode:.3f}ms".format(**result))
+                results.append(result)
+
+    # Sum up the time of all sizes, the engine with the least time wins
+    total_time = defaultdict(float)
+    for result in results:
+        total_time[(result["format"], result["engine"])] += result["total"]
+    fastest = {}
+    for (image_format, engine_name), t in total_time.items():
+        if image_format not in fastest or t < total_time[(image_format, fastest[image_format])]:
+            fastest[image_format] = engine_name
+    return {
+        "engines": [engine.name for engine in engines],
+        "results": results,
+        "fastest": fastest,
+        "IMAGE_ENGINES": ",".join("{}:{}".format(f, e) for f, e in sorted(fastest.items())),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark transform engines")
+    parser.add_argument("--sizes", default="512,2048", help="image sizes, separated by comma")
+    parser.add_argument("--formats", default="jpeg,png,webp", help="image formats, separated by comma")
+    parser.add_argument("--repeat", type=int, default=10, help="repeat times of each operation")
+    parser.add_argument("--output", default=None, help="file to save JSON result, default is stdout")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+
+    report = json.dumps(run_benchmark(
+        [int(s) for s in args.sizes.split(",")],
+        args.formats.split(","),
+        args.repeat
+    ), indent=2)
+    if args.output is None:
+        print(report)
+    else:
+        with open(args.output, "w") as fp:
+            fp.write(report)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,220 @@
+"""
+Replay a recorded request log against a running Nemivir service
+
+$ python -m benchmark.replay requests.log --service http://127.0.0.1:8000/ --concurrency 16 --speed 2
+
+Request log is in JSON lines format, one request per line:
+    {"t": 0.125, "op": "get", "fid": "3,01637037d6", "w": 200, "h": 100, "image_format": "webp"}
+    {"t": 0.250, "op": "hash", "hash": "00001f...", "rescale": 0.5}
+    {"t": 0.300, "op": "upload", "file": "/data/a.jpg", "mode": "keep", "image_format": "webp"}
+    {"t": 0.320, "op": "delete", "fid": "3,01637037d6"}
+- t: seconds since the beginning of the log, requests are sent at t / speed (or at --rate requests per second)
+- op: get (/image/{fid}), hash (/hash/{hash}), upload (/upload), delete (/image/{fid})
+- other fields are the parameters of the API
+
+Report contains throughput, latency percentiles, cache hit ratio (by X-Cache header) and errors per endpoint.
+Requests waiting for a free connection (concurrency is not enough) are counted in p99_with_queue_ms.
+"""
+import argparse
+import json
+import logging
+import sys
+import threading
+import time
+from collections import defaultdict, Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+from urllib.parse import urljoin
+
+import requests
+
+from benchmark.api_benchmark import percentile
+
+log = logging.getLogger(__file__)
+
+QUERY_FIELDS = ("w", "h", "rescale", "image_format")
+UPLOAD_FIELDS = ("mode", "auto_remove", "image_format", "method", "lossless", "quality", "attach_info")
+ENDPOINTS = {
+    "get": "GET /image",
+    "hash": "GET /hash",
+    "upload": "POST /upload",
+    "delete": "DELETE /image",
+}
+
+_local = threading.local()
+
+
+def _get_session() -> requests.Session:
+    # One session (connection pool) per thread
+    session = getattr(_local, "session", None)
+    if session is None:
+        session = requests.Session()
+        _local.session = session
+    return session
+
+
+def load_log(filename: str) -> List[dict]:
+    with open(filename) as fp:
+        return [json.loads(line) for line in fp if line.strip() != ""]
+
+
+def send_request(service: str, record: dict, timeout: float, scheduled_time: float = None) -> dict:
+    """
+    Send one request of the log
+    :param scheduled_time: perf_counter time the request should be sent, to measure the queueing delay
+    :return: endpoint, status, latency, queueing delay and cache status
+    """
+    op = record["op"]
+    endpoint = ENDPOINTS.get(op, op)
+    session = _get_session()
+    start_time = time.perf_counter()
+    queued = max(0.0, start_time - scheduled_time) if scheduled_time is not None else 0.0
+    try:
+        if op == "get":
+            resp = session.get(
+                urljoin(service, "/image/{}".format(record["fid"])),
+                params={k: record[k] for k in QUERY_FIELDS if record.get(k) is not None},
+                timeout=timeout
+            )
+        elif op == "hash":
+            resp = session.get(
+                urljoin(service, "/hash/{}".format(record["hash"])),
+                params={k: record[k] for k in QUERY_FIELDS if record.get(k) is not None},
+                timeout=timeout
+            )
+        elif op == "upload":
+            with open(record["file"], "rb") as fp:
+                resp = session.post(
+                    urljoin(service, "/upload"),
+                    params={k: record[k] for k in UPLOAD_FIELDS if record.get(k) is not None},
+                    files={"file": fp},
+                    timeout=timeout
+                )
+        elif op == "delete":
+            resp = session.delete(urljoin(service, "/image/{}".format(record["fid"])), timeout=timeout)
+        else:
+            raise Exception("Unknown op: {}".format(op))
+        # Read the whole body before stopping the timer
+        _ = resp.content
+        return {
+            "endpoint": endpoint,
+            "status": resp.status_code,
+            "latency": time.perf_counter() - start_time,
+            "queued": queued,
+            "cache": resp.headers.get("X-Cache"),
+        }
+    except Exception as ex:
+        return {
+            "endpoint": endpoint,
+            "status": type(ex).__name__,
+            "latency": time.perf_counter() - start_time,
+            "queued": queued,
+            "cache": None,
+        }
+
+
+def summarize(results: List[dict], duration: float) -> dict:
+    grouped = defaultdict(list)
+    for result in results:
+        grouped[result["endpoint"]].append(result)
+    report = {}
+    for endpoint, items in grouped.items():
+        latencies = [item["latency"] for item in items]
+        # Latency seen by a client which sent the request on schedule (avoid coordinated omission)
+        total_latencies = [item["latency"] + item["queued"] for item in items]
+        statuses = Counter(str(item["status"]) for item in items)
+        cache_status = Counter(item["cache"] for item in items if item["cache"] is not None)
+        cache_total = sum(cache_status.values())
+        errors = sum(count for status, count in statuses.items() if not status.startswith("2"))
+        report[endpoint] = {
+            "count": len(items),
+            "throughput": len(items) / duration,
+            "p50_ms": percentile(latencies, 50) * 1000,
+            "p90_ms": percentile(latencies, 90) * 1000,
+            "p99_ms": percentile(latencies, 99) * 1000,
+            "max_ms": max(latencies) * 1000,
+            "p99_with_queue_ms": percentile(total_latencies, 99) * 1000,
+            "error_rate": errors / len(items),
+            "statuses": dict(statuses),
+            "cache_hit_ratio": cache_status["HIT"] / cache_total if cache_total > 0 else None,
+        }
+    return report
+
+
+def replay(
+        records: List[dict],
+        service: str,
+        concurrency: int,
+        speed: float = 1.0,
+        rate: float = None,
+        timeout: float = 30.0
+) -> dict:
+    """
+    Replay the records
+    :param records: request records
+    :param service: service address
+    :param concurrency: max requests in flight
+    :param speed: speed up ratio of recorded timestamps
+    :param rate: fixed requests per second, ignore the timestamps in log if set
+    :param timeout: timeout of each request
+    :return: report
+    """
+    results = []
+    lag_count = 0
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = []
+        for i, record in enumerate(records):
+            if rate is not None:
+                scheduled = i / rate
+            else:
+                scheduled = record.get("t", 0) / speed
+            wait_time = scheduled - (time.perf_counter() - start_time)
+            if wait_time > 0:
+                time.sleep(wait_time)
+            elif wait_time < -0.1:
+                # The sender fell behind the schedule
+                lag_count += 1
+            futures.append(executor.submit(send_request, service, record, timeout, start_time + scheduled))
+        for future in futures:
+            results.append(future.result())
+    duration = time.perf_counter() - start_time
+    return {
+        "duration": duration,
+        "requests": len(results),
+        "lagged_requests": lag_count,
+        "endpoints": summarize(results, duration),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay request log against Nemivir")
+    parser.add_argument("log_file", help="request log in JSON lines")
+    parser.add_argument("--service", default="http://127.0.0.1:8000/", help="service address")
+    parser.add_argument("--concurrency", type=int, default=8, help="max requests in flight")
+    parser.add_argument("--speed", type=float, default=1.0, help="speed up ratio of the recorded timestamps")
+    parser.add_argument("--rate", type=float, default=None, help="fixed request rate per second, ignore timestamps")
+    parser.add_argument("--timeout", type=float, default=30.0, help="timeout of each request in seconds")
+    parser.add_argument("--output", default=None, help="file to save JSON report, default is stdout")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+
+    records = load_log(args.log_file)
+    log.info("Replaying {} requests with concurrency={}".format(len(records), args.concurrency))
+    report = json.dumps(replay(
+        records,
+        args.service,
+        args.concurrency,
+        speed=args.speed,
+        rate=args.rate,
+        timeout=args.timeout
+    ), indent=2)
+    if args.output is None:
+        print(report)
+    else:
+        with open(args.output, "w") as fp:
+            fp.write(report)
+
+
+if __name__ == '__main__':
+    main()
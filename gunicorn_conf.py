@@ -0,0 +1,66 @@
+"""
+Gunicorn configuration for production:
+$ gunicorn -c gunicorn_conf.py nemivir.service.image_api:app
+
+All settings can be overwritten by environment variables:
+- WEB_CONCURRENCY: worker count, default is the count of CPU cores
+- BIND: listen address, default is 0.0.0.0:8000
+- MAX_REQUESTS: restart worker after serving requests, to release memory fragmented by PIL
+- MAX_REQUESTS_JITTER: random jitter of MAX_REQUESTS, avoid all workers restart at the same time
+- GRACEFUL_TIMEOUT: seconds to finish the requests in processing while restarting
+- TIMEOUT: seconds to kill a silent worker
+- GRPC_PORT: start the gRPC API (nemivir.service.grpc_api) on this port in every worker, 0 (default) disables
+"""
+import os
+import shutil
+
+from prometheus_client import multiprocess
+
+bind = os.environ.get("BIND", "0.0.0.0:8000")
+workers = int(os.environ.get("WEB_CONCURRENCY", os.cpu_count() or 1))
+worker_class = "uvicorn.workers.UvicornWorker"
+
+# Import the app before fork, workers share the memory pages of the code
+# It's safe because all backends are created lazily in the workers (see nemivir.config)
+preload_app = True
+
+max_requests = int(os.environ.get("MAX_REQUESTS", "2000"))
+max_requests_jitter = int(os.environ.get("MAX_REQUESTS_JITTER", "200"))
+graceful_timeout = int(os.environ.get("GRACEFUL_TIMEOUT", "30"))
+timeout = int(os.environ.get("TIMEOUT", "60"))
+keepalive = 5
+
+
+def _get_prometheus_dir():
+    return os.environ.get("PROMETHEUS_MULTIPROC_DIR", os.environ.get("prometheus_multiproc_dir"))
+
+
+def on_starting(server):
+    # Remove metrics files created by the previous master, or the counters of dead processes will be summed
+    prometheus_dir = _get_prometheus_dir()
+    if prometheus_dir is not None and os.path.isdir(prometheus_dir):
+        for name in os.listdir(prometheus_dir):
+            path = os.path.join(prometheus_dir, name)
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+
+
+def child_exit(server, worker):
+    # Gauges of the exited (or recycled by max_requests) worker should be removed
+    if _get_prometheus_dir() is not None:
+        multiprocess.mark_process_dead(worker.pid)
+
+
+def post_worker_init(worker):
+    # gRPC must be imported after fork, workers share the port by SO_REUSEPORT
+    if int(os.environ.get("GRPC_PORT", "0")) > 0:
+        from nemivir.service.grpc_api import serve
+        worker.grpc_server = serve()
+
+
+def worker_exit(server, worker):
+    grpc_server = getattr(worker, "grpc_server", None)
+    if grpc_server is not None:
+        grpc_server.stop(graceful_timeout).wait()
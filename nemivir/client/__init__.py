@@ -0,0 +1,13 @@
+"""
+Python client of the image service:
+
+    from nemivir.client import NemivirClient
+    with NemivirClient("http://127.0.0.1:8000/") as client:
+        for path, result in client.upload_directory("images/", image_format="webp"):
+            print(path, result)
+
+AsyncNemivirClient has the same methods for asyncio (requires httpx).
+"""
+from .common import NemivirError, ETagCache, iter_image_files
+from .sync_client import NemivirClient
+from .async_client import AsyncNemivirClient
@@ -0,0 +1,207 @@
+import asyncio
+import logging
+from typing import Iterable, AsyncIterator, List, Tuple, Union
+
+from nemivir.protos import ImageResponse, BatchImageItem, create_image_response, unpack_batch_items
+from .common import ETagCache, DEFAULT_BATCH_SIZE, IMAGE_EXTENSIONS, get_cache_key, \
+    get_image_params, get_upload_params, get_retry_delay, parse_error, read_upload_item, iter_image_files, \
+    split_batches
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+log = logging.getLogger(__file__)
+
+
+class AsyncNemivirClient:
+    def __init__(
+            self,
+            service: str,
+            pool_size: int = 16,
+            timeout: float = 60.0,
+            max_retries: int = 3,
+            backoff: float = 0.5,
+            max_retry_delay: float = 30.0,
+            etag_cache_bytes: int = 64 * 1024 * 1024
+    ):
+        """
+        Asyncio client of the image service (requires httpx), parameters are the same as NemivirClient
+        """
+        if httpx is None:
+            raise Exception("AsyncNemivirClient requires httpx, install it by: pip install httpx")
+        self.service = service
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_retry_delay = max_retry_delay
+        self.etag_cache = ETagCache(etag_cache_bytes)
+        self._client = httpx.AsyncClient(
+            base_url=service,
+            timeout=timeout,
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+        )
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    async def close(self):
+        await self._client.aclose()
+
+    async def _send(self, method: str, path: str, stream: bool = False, **kwargs) -> "httpx.Response":
+        """
+        Send the request, retry if the service is overloaded (503), raise NemivirError if failed
+        The streamed response should be closed by the caller
+        """
+        attempt = 0
+        while True:
+            request = self._client.build_request(method, path, **kwargs)
+            response = await self._client.send(request, stream=stream)
+            if response.status_code < 400:
+                return response
+            content = await response.aread()
+            await response.aclose()
+            error = parse_error(response.status_code, response.headers, content)
+            if response.status_code != 503 or attempt >= self.max_retries:
+                raise error
+            delay = get_retry_delay(attempt, error.retry_after, self.backoff, self.max_retry_delay)
+            log.info("Service is overloaded, retry {} {} after {:.2f}s".format(method, path, delay))
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def upload(
+            self,
+            item,
+            mode: str = "keep",
+            auto_remove: bool = False,
+            image_format: str = "original",
+            method: int = None,
+            lossless: bool = False,
+            quality: int = 80,
+            attach_info: str = "{}"
+    ) -> dict:
+        """
+        Upload an image, see NemivirClient.upload
+        """
+        # Reading files blocks the event loop
+        name, content = await asyncio.get_running_loop().run_in_executor(None, read_upload_item, item)
+        response = await self._send(
+            "POST",
+            "/upload",
+            params=get_upload_params(mode, auto_remove, image_format, method, lossless, quality, attach_info),
+            files={"file": (name, content)},
+        )
+        return response.json()
+
+    async def _upload_item(self, item, options: dict) -> Tuple[object, Union[dict, Exception]]:
+        try:
+            return item, await self.upload(item, **options)
+        except Exception as ex:
+            return item, ex
+
+    async def upload_many(self, items: Iterable, concurrency: int = 8, **options) \
+            -> AsyncIterator[Tuple[object, Union[dict, Exception]]]:
+        """
+        Upload images concurrently, see NemivirClient.upload_many
+        """
+        pending = set()
+        try:
+            for item in items:
+                pending.add(asyncio.ensure_future(self._upload_item(item, options)))
+                if len(pending) >= concurrency:
+                    done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        yield task.result()
+            while len(pending) > 0:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    yield task.result()
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def upload_directory(
+            self,
+            directory: str,
+            recursive: bool = True,
+            extensions: Iterable[str] = IMAGE_EXTENSIONS,
+            concurrency: int = 8,
+            **options
+    ) -> AsyncIterator[Tuple[str, Union[dict, Exception]]]:
+        """
+        Upload the image files in the directory concurrently, see NemivirClient.upload_directory
+        """
+        return self.upload_many(iter_image_files(directory, recursive, extensions), concurrency, **options)
+
+    async def _get_cached(self, path: str, params: dict) -> ImageResponse:
+        key = get_cache_key(path, params)
+        cached = self.etag_cache.get(key)
+        headers = {}
+        if cached is not None:
+            etag, immutable, image = cached
+            if immutable:
+                return image
+            headers["If-None-Match"] = etag
+        response = await self._send("GET", path, params=params, headers=headers)
+        if response.status_code == 304 and cached is not None:
+            return cached[2]
+        image = create_image_response(response.content, response.headers.get("Content-Type", ""))
+        if "ETag" in response.headers:
+            immutable = "immutable" in response.headers.get("Cache-Control", "")
+            self.etag_cache.put(key, response.headers["ETag"], immutable, image)
+        return image
+
+    async def get_image(self, fid: str, rescale: float = None, h: int = None, w: int = None,
+                        image_format: str = None) -> ImageResponse:
+        return await self._get_cached("/image/{}".format(fid), get_image_params(rescale, h, w, image_format))
+
+    async def get_image_by_hash(self, image_hash: str, rescale: float = None, h: int = None, w: int = None,
+                                image_format: str = None) -> ImageResponse:
+        return await self._get_cached("/hash/{}".format(image_hash), get_image_params(rescale, h, w, image_format))
+
+    async def batch_get(
+            self,
+            fids: Iterable[str] = (),
+            hashes: Iterable[str] = (),
+            rescale: float = None,
+            h: int = None,
+            w: int = None,
+            image_format: str = None,
+            batch_size: int = DEFAULT_BATCH_SIZE
+    ) -> AsyncIterator[BatchImageItem]:
+        """
+        Get images with the same transform parameters, see NemivirClient.batch_get
+        """
+        for batch_fids, batch_hashes, indexes in split_batches(fids, hashes, batch_size):
+            body = {"fids": batch_fids, "hashes": batch_hashes, "rescale": rescale, "h": h, "w": w,
+                    "image_format": image_format}
+            body = {k: v for k, v in body.items() if v is not None}
+            response = await self._send("POST", "/batch_image", stream=True, json=body)
+            try:
+                buffer = bytearray()
+                async for chunk in response.aiter_bytes():
+                    buffer.extend(chunk)
+                    for item in unpack_batch_items(buffer):
+                        item.index = indexes[item.index]
+                        yield item
+                if len(buffer) > 0:
+                    raise EOFError("Incomplete batch item, {} bytes left".format(len(buffer)))
+            finally:
+                await response.aclose()
+
+    async def delete(self, fid: str) -> dict:
+        return (await self._send("DELETE", "/image/{}".format(fid))).json()
+
+    async def batch_delete(self, fids: Iterable[str] = (), hashes: Iterable[str] = ()) -> dict:
+        return (await self._send("POST", "/batch_delete", json={"fids": list(fids), "hashes": list(hashes)})).json()
+
+    async def find_similar(self, image_hash: str, max_distance: int = 5, limit: int = 100) -> List[dict]:
+        response = await self._send(
+            "GET",
+            "/similar/{}".format(image_hash),
+            params={"max_distance": max_distance, "limit": limit}
+        )
+        return response.json()["similar"]
@@ -0,0 +1,181 @@
+"""
+Shared parts of the sync and asyncio clients
+"""
+import json
+import os
+import random
+import threading
+from collections import OrderedDict
+from typing import Dict, Iterator, Optional, Tuple, Iterable, List
+
+from nemivir.protos import ImageResponse
+
+# Image files uploaded from directories
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp", ".gif", ".bmp", ".tif", ".tiff")
+
+# Default max images in a batch request of the service (BATCH_MAX_ITEMS)
+DEFAULT_BATCH_SIZE = 200
+
+
+class NemivirError(Exception):
+    def __init__(self, status_code: int, message: str, retry_after: Optional[float] = None):
+        """
+        Failed response of the service
+        :param status_code: HTTP status code
+        :param message: message of the service
+        :param retry_after: seconds to wait before retrying (Retry-After header), only for 503
+        """
+        super().__init__("{}: {}".format(status_code, message))
+        self.status_code = status_code
+        self.message = message
+        self.retry_after = retry_after
+
+
+class ETagCache:
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024):
+        """
+        LRU cache of images with their ETag
+        Immutable images (by fid) are returned without requesting the service,
+        the others are revalidated by If-None-Match (304 means the cached one is still valid)
+        :param max_bytes: max bytes of the cached images, 0 disables the cache
+        """
+        self.max_bytes = max_bytes
+        self._items: "OrderedDict[str, Tuple[str, bool, ImageResponse]]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[Tuple[str, bool, ImageResponse]]:
+        """
+        :return: ETag, immutable or not, image; None if not cached
+        """
+        with self._lock:
+            value = self._items.get(key)
+            if value is not None:
+                self._items.move_to_end(key)
+            return value
+
+    def put(self, key: str, etag: str, immutable: bool, image: ImageResponse):
+        size = len(image.content)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self._bytes -= len(old[2].content)
+            self._items[key] = (etag, immutable, image)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, (_, _, removed) = self._items.popitem(last=False)
+                self._bytes -= len(removed.content)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._bytes = 0
+
+
+def get_cache_key(path: str, params: Dict[str, str]) -> str:
+    return "{}?{}".format(path, "&".join("{}={}".format(k, params[k]) for k in sorted(params)))
+
+
+def get_image_params(rescale: float, h: int, w: int, image_format: str) -> Dict[str, str]:
+    params = {"rescale": rescale, "h": h, "w": w, "image_format": image_format}
+    return {k: str(v) for k, v in params.items() if v is not None}
+
+
+def get_upload_params(
+        mode: str,
+        auto_remove: bool,
+        image_format: str,
+        method: int,
+        lossless: bool,
+        quality: int,
+        attach_info: str
+) -> Dict[str, str]:
+    params = {
+        "mode": mode,
+        "auto_remove": "true" if auto_remove else "false",
+        "image_format": image_format,
+        "lossless": "true" if lossless else "false",
+        "quality": str(quality),
+        "attach_info": attach_info,
+    }
+    if method is not None:
+        params["method"] = str(method)
+    return params
+
+
+def get_retry_delay(attempt: int, retry_after: Optional[float], backoff: float, max_delay: float) -> float:
+    """
+    Seconds to wait before the retry: Retry-After of the service, or exponential backoff with jitter
+    :param attempt: retries done, starts from 0
+    """
+    if retry_after is not None:
+        return min(max_delay, retry_after)
+    return min(max_delay, backoff * (2 ** attempt)) * random.uniform(0.5, 1.0)
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        # HTTP date is not used by the service
+        return None
+
+
+def parse_error(status_code: int, headers, content: bytes) -> NemivirError:
+    """
+    Create the error from a failed response, the service returns {"status": "fail", "message": ...}
+    """
+    message = content.decode("utf-8", "replace")
+    try:
+        data = json.loads(message)
+        # Validation errors of FastAPI are in "detail"
+        message = str(data.get("message", data.get("detail", message)))
+    except Exception:
+        pass
+    return NemivirError(status_code, message, parse_retry_after(headers.get("Retry-After")))
+
+
+def read_upload_item(item) -> Tuple[str, bytes]:
+    """
+    Read an item to upload
+    :param item: bytes, path of the file, or a binary file object
+    :return: file name and content
+    """
+    if isinstance(item, (bytes, bytearray, memoryview)):
+        return "image", bytes(item)
+    if isinstance(item, (str, os.PathLike)):
+        with open(item, "rb") as fp:
+            return os.path.basename(item), fp.read()
+    return os.path.basename(getattr(item, "name", "image")), item.read()
+
+
+def iter_image_files(directory: str, recursive: bool = True, extensions: Iterable[str] = IMAGE_EXTENSIONS) \
+        -> Iterator[str]:
+    """
+    Paths of the image files (by extension) in the directory, sorted by name
+    """
+    extensions = tuple(e.lower() for e in extensions)
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        if not recursive:
+            dirs.clear()
+        for name in sorted(files):
+            if name.lower().endswith(extensions):
+                yield os.path.join(root, name)
+
+
+def split_batches(fids: Iterable[str], hashes: Iterable[str], batch_size: int) \
+        -> Iterator[Tuple[List[str], List[str], List[int]]]:
+    """
+    Split images into batch requests
+    :return: fids, hashes of each batch, and the index in the whole batch of each item of this batch
+    """
+    images = [("fid", fid) for fid in fids] + [("hash", image_hash) for image_hash in hashes]
+    for start in range(0, len(images), batch_size):
+        batch = list(enumerate(images[start:start + batch_size], start))
+        batch_fids = [(i, value) for i, (kind, value) in batch if kind == "fid"]
+        batch_hashes = [(i, value) for i, (kind, value) in batch if kind == "hash"]
+        # The service indexes items by fids first, then hashes
+        yield [v for _, v in batch_fids], [v for _, v in batch_hashes], [i for i, _ in batch_fids + batch_hashes]
@@ -0,0 +1,217 @@
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Iterable, Iterator, List, Tuple, Union
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from nemivir.protos import ImageResponse, BatchImageItem, create_image_response, iter_batch_items
+from .common import ETagCache, DEFAULT_BATCH_SIZE, IMAGE_EXTENSIONS, get_cache_key, \
+    get_image_params, get_upload_params, get_retry_delay, parse_error, read_upload_item, iter_image_files, \
+    split_batches
+
+log = logging.getLogger(__file__)
+
+
+class NemivirClient:
+    def __init__(
+            self,
+            service: str,
+            pool_size: int = 16,
+            timeout: float = 60.0,
+            max_retries: int = 3,
+            backoff: float = 0.5,
+            max_retry_delay: float = 30.0,
+            etag_cache_bytes: int = 64 * 1024 * 1024
+    ):
+        """
+        Client of the image service, thread safe, the connections are reused
+        :param service: URL of the service, like http://127.0.0.1:8000/
+        :param pool_size: max connections, threads wait for a free connection if all are in use
+        :param timeout: seconds to connect or to wait for the response
+        :param max_retries: retries of a request rejected by the overloaded service (503)
+        :param backoff: seconds to wait before the first retry if the service doesn't give Retry-After, doubled each time
+        :param max_retry_delay: max seconds to wait before a retry
+        :param etag_cache_bytes: max bytes of images cached locally by ETag, 0 disables the cache
+        """
+        self.service = service
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_retry_delay = max_retry_delay
+        self.etag_cache = ETagCache(etag_cache_bytes)
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True)
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        self._session.close()
+
+    def _request(self, method: str, path: str, **kwargs) -> requests.Response:
+        """
+        Send the request, retry if the service is overloaded (503), raise NemivirError if failed
+        """
+        attempt = 0
+        while True:
+            # Not urljoin, which drops the base path of a service behind a reverse proxy
+            response = self._session.request(
+                method, self.service.rstrip("/") + path, timeout=self.timeout, **kwargs
+            )
+            if response.status_code < 400:
+                return response
+            error = parse_error(response.status_code, response.headers, response.content)
+            if response.status_code != 503 or attempt >= self.max_retries:
+                raise error
+            delay = get_retry_delay(attempt, error.retry_after, self.backoff, self.max_retry_delay)
+            log.info("Service is overloaded, retry {} {} after {:.2f}s".format(method, path, delay))
+            time.sleep(delay)
+            attempt += 1
+
+    def upload(
+            self,
+            item,
+            mode: str = "keep",
+            auto_remove: bool = False,
+            image_format: str = "original",
+            method: int = None,
+            lossless: bool = False,
+            quality: int = 80,
+            attach_info: str = "{}"
+    ) -> dict:
+        """
+        Upload an image, parameters are the same as /upload
+        :param item: bytes, path of the file, or a binary file object
+        :return: response of /upload, like {"wrote": true, "fid": ..., "hash": ...}
+        """
+        name, content = read_upload_item(item)
+        return self._request(
+            "POST",
+            "/upload",
+            params=get_upload_params(mode, auto_remove, image_format, method, lossless, quality, attach_info),
+            files={"file": (name, content)},
+        ).json()
+
+    def upload_many(self, items: Iterable, concurrency: int = 8, **options) \
+            -> Iterator[Tuple[object, Union[dict, Exception]]]:
+        """
+        Upload images concurrently, the items are read lazily so the iterator can be endless
+        :param items: bytes, paths of the files, or binary file objects
+        :param concurrency: max uploads at the same time
+        :param options: parameters of upload
+        :return: (item, response or the exception), in the order of completion
+        """
+        with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="nemivir_upload") as executor:
+            pending = {}
+            try:
+                for item in items:
+                    pending[executor.submit(self.upload, item, **options)] = item
+                    if len(pending) >= concurrency * 2:
+                        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            yield pending.pop(future), future.exception() or future.result()
+                while len(pending) > 0:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        yield pending.pop(future), future.exception() or future.result()
+            finally:
+                # Stop uploading if the caller stops iterating
+                for future in pending:
+                    future.cancel()
+
+    def upload_directory(
+            self,
+            directory: str,
+            recursive: bool = True,
+            extensions: Iterable[str] = IMAGE_EXTENSIONS,
+            concurrency: int = 8,
+            **options
+    ) -> Iterator[Tuple[str, Union[dict, Exception]]]:
+        """
+        Upload the image files in the directory concurrently
+        :return: (path, response or the exception), in the order of completion
+        """
+        return self.upload_many(iter_image_files(directory, recursive, extensions), concurrency, **options)
+
+    def _get_cached(self, path: str, params: dict) -> ImageResponse:
+        key = get_cache_key(path, params)
+        cached = self.etag_cache.get(key)
+        headers = {}
+        if cached is not None:
+            etag, immutable, image = cached
+            if immutable:
+                return image
+            headers["If-None-Match"] = etag
+        response = self._request("GET", path, params=params, headers=headers)
+        if response.status_code == 304 and cached is not None:
+            return cached[2]
+        image = create_image_response(response.content, response.headers.get("Content-Type", ""))
+        if "ETag" in response.headers:
+            immutable = "immutable" in response.headers.get("Cache-Control", "")
+            self.etag_cache.put(key, response.headers["ETag"], immutable, image)
+        return image
+
+    def get_image(self, fid: str, rescale: float = None, h: int = None, w: int = None,
+                  image_format: str = None) -> ImageResponse:
+        """
+        Get image by fid, parameters are the same as /image/{fid}
+        """
+        return self._get_cached("/image/{}".format(fid), get_image_params(rescale, h, w, image_format))
+
+    def get_image_by_hash(self, image_hash: str, rescale: float = None, h: int = None, w: int = None,
+                          image_format: str = None) -> ImageResponse:
+        """
+        Get an image of the hash, parameters are the same as /hash/{image_hash}
+        """
+        return self._get_cached("/hash/{}".format(image_hash), get_image_params(rescale, h, w, image_format))
+
+    def batch_get(
+            self,
+            fids: Iterable[str] = (),
+            hashes: Iterable[str] = (),
+            rescale: float = None,
+            h: int = None,
+            w: int = None,
+            image_format: str = None,
+            batch_size: int = DEFAULT_BATCH_SIZE
+    ) -> Iterator[BatchImageItem]:
+        """
+        Get images with the same transform parameters, split into requests of batch_size images
+        :return: items in the order of arrival, index of the item is the position in fids + hashes
+        """
+        for batch_fids, batch_hashes, indexes in split_batches(fids, hashes, batch_size):
+            body = {"fids": batch_fids, "hashes": batch_hashes, "rescale": rescale, "h": h, "w": w,
+                    "image_format": image_format}
+            body = {k: v for k, v in body.items() if v is not None}
+            with self._request("POST", "/batch_image", json=body, stream=True) as response:
+                for item in iter_batch_items(response.raw):
+                    item.index = indexes[item.index]
+                    yield item
+
+    def delete(self, fid: str) -> dict:
+        return self._request("DELETE", "/image/{}".format(fid)).json()
+
+    def batch_delete(self, fids: Iterable[str] = (), hashes: Iterable[str] = ()) -> dict:
+        """
+        Remove images and all images of the hashes
+        :return: {"removed": [fids], "failed": {fid: error}}
+        """
+        return self._request("POST", "/batch_delete", json={"fids": list(fids), "hashes": list(hashes)}).json()
+
+    def find_similar(self, image_hash: str, max_distance: int = 5, limit: int = 100) -> List[dict]:
+        """
+        Hashes of similar images
+        :return: list of {"hash", "distance", "fids"}, the nearest first
+        """
+        return self._request(
+            "GET",
+            "/similar/{}".format(image_hash),
+            params={"max_distance": max_distance, "limit": limit}
+        ).json()["similar"]
@@ -1,3 +1,8 @@
-from .filesystem import AbstractFileSystem, WeedFileSystem
-from .image_operation import get_hash
-from .meta import MongoDBMeta, AbstractImageMeta
+from .filesystem import AbstractFileSystem, WeedFileSystem, LocalFileSystem
+from .replica import ReplicaSelector
+from .image_operation import get_hash, get_target_size, transform_animated, ImageLimitError, \
+    ANIMATED_FORMATS, get_reduce_factor, check_image_limits, ImageFormat
+from .meta import MongoDBMeta, SQLiteMeta, AbstractImageMeta
+from .engine import AbstractTransformEngine, PillowEngine, OpenCVEngine, EngineSelector
+from .encoder_profile import EncoderProfile, EncoderProfileSelector
+from .similar import SimilarHashIndex
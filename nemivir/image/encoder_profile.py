@@ -0,0 +1,105 @@
+"""
+Encoder profiles: choose the encoder options by image size and current load within a time budget
+"""
+import os
+import threading
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+from typing import Dict, List
+
+EncoderProfile = namedtuple("EncoderProfile", ("name", "options", "megapixels_per_second"))
+
+# Profiles of each format, from the best compression (slowest) to the fastest
+# megapixels_per_second is the initial estimation of encoding speed on one core, will be updated by measurement
+DEFAULT_PROFILES = {
+    "WEBP": [
+        EncoderProfile("webp-m6", {"method": 6}, 1.5),
+        EncoderProfile("webp-m4", {"method": 4}, 4.0),
+        EncoderProfile("webp-m2", {"method": 2}, 8.0),
+        EncoderProfile("webp-m0", {"method": 0}, 16.0),
+    ],
+    "JPEG": [
+        EncoderProfile("jpeg-progressive", {"optimize": True, "progressive": True}, 25.0),
+        EncoderProfile("jpeg-optimize", {"optimize": True}, 40.0),
+        EncoderProfile("jpeg-fast", {}, 80.0),
+    ],
+    "PNG": [
+        EncoderProfile("png-9", {"compress_level": 9}, 2.0),
+        EncoderProfile("png-6", {"compress_level": 6}, 6.0),
+        EncoderProfile("png-1", {"compress_level": 1}, 25.0),
+    ],
+}
+
+DEFAULT_PROFILE = EncoderProfile("default", {}, None)
+
+
+class EncoderProfileSelector:
+    def __init__(self, time_budget: float, profiles: Dict[str, List[EncoderProfile]] = None, alpha: float = 0.2):
+        """
+        Select the best compression profile which can be finished in time budget
+        :param time_budget: expected max encoding time in seconds
+        :param profiles: profiles of formats, slowest first
+        :param alpha: smoothing factor of EWMA while updating the encoding speed
+        """
+        self.time_budget = time_budget
+        self._profiles = profiles if profiles is not None else DEFAULT_PROFILES
+        self._alpha = alpha
+        self._speeds = {
+            profile.name: profile.megapixels_per_second
+            for format_profiles in self._profiles.values()
+            for profile in format_profiles
+        }
+        self._cpu_count = os.cpu_count() or 1
+        self._in_flight = 0
+        self._lock = threading.Lock()
+
+    def get_load_factor(self) -> float:
+        """
+        How many times slower than encoding on an idle core, estimated by concurrent encodings and load average
+        """
+        load = self._in_flight / self._cpu_count
+        if hasattr(os, "getloadavg"):
+            load = max(load, os.getloadavg()[0] / self._cpu_count)
+        return max(1.0, load)
+
+    def estimate(self, profile: EncoderProfile, pixels: int) -> float:
+        """
+        Estimate encoding time (seconds) under current load
+        """
+        return pixels / 1e6 / self._speeds[profile.name] * self.get_load_factor()
+
+    def select(self, image_format: str, pixels: int) -> EncoderProfile:
+        """
+        Select the slowest (best compression) profile which can be finished in time budget,
+        or the fastest one if none of them can
+        :param image_format: target format
+        :param pixels: pixels to encode (sum of all frames for animated image)
+        """
+        profiles = self._profiles.get(image_format.upper())
+        if not profiles:
+            return DEFAULT_PROFILE
+        for profile in profiles:
+            if self.estimate(profile, pixels) <= self.time_budget:
+                return profile
+        return profiles[-1]
+
+    @contextmanager
+    def encoding(self, profile: EncoderProfile, pixels: int):
+        """
+        Context of encoding, count the concurrent encodings and update the speed of the profile
+        """
+        with self._lock:
+            self._in_flight += 1
+            load_factor = self.get_load_factor()
+        start_time = time.perf_counter()
+        try:
+            yield profile
+        finally:
+            used_time = time.perf_counter() - start_time
+            with self._lock:
+                self._in_flight -= 1
+                if profile.name in self._speeds and used_time > 0 and pixels > 0:
+                    # Normalize the speed to an idle core
+                    speed = pixels / 1e6 / used_time * load_factor
+                    self._speeds[profile.name] = self._alpha * speed + (1 - self._alpha) * self._speeds[profile.name]
@@ -0,0 +1,225 @@
+"""
+Transform engines for still images, an engine decodes, resizes and encodes image:
+- pillow: default engine, supports all formats
+- opencv: requires opencv-python(-headless), usually faster on large JPEG/PNG
+"""
+from abc import ABC, abstractmethod
+from io import BytesIO
+from typing import Tuple, Dict
+
+from PIL import Image
+
+from .image_operation import get_draft_scale
+
+try:
+    import cv2
+    import numpy
+except ImportError:
+    cv2 = None
+    numpy = None
+
+
+class AbstractTransformEngine(ABC):
+    name = "abstract"
+
+    @classmethod
+    def available(cls) -> bool:
+        """
+        Check the dependencies of the engine are installed
+        """
+        return True
+
+    @abstractmethod
+    def supports(self, image_format: str) -> bool:
+        """
+        Check the engine can decode/encode the format
+        :param image_format: format name like jpeg/png/webp
+        """
+        pass
+
+    @abstractmethod
+    def decode(self, data: bytes, reduce_factor: int = 1):
+        """
+        Decode image data into the bitmap of the engine
+        :param data: encoded image
+        :param reduce_factor: the bitmap can be reduced up to this factor while decoding (to save memory and time),
+            the bitmap may be larger than 1/reduce_factor, it depends on the engine and format
+        :return: bitmap, the type depends on the engine
+        """
+        pass
+
+    @abstractmethod
+    def get_size(self, bitmap) -> Tuple[int, int]:
+        """
+        :return: (width, height) of the bitmap
+        """
+        pass
+
+    @abstractmethod
+    def resize(self, bitmap, size: Tuple[int, int]):
+        """
+        Resize the bitmap
+        :param bitmap: bitmap from decode
+        :param size: (width, height)
+        :return: resized bitmap
+        """
+        pass
+
+    @abstractmethod
+    def encode(self, bitmap, image_format: str, **options) -> bytes:
+        """
+        Encode the bitmap
+        :param bitmap: bitmap
+        :param image_format: format name like jpeg/png/webp
+        :param options: encoder options in Pillow's naming (quality/method/lossless/optimize/compress_level...)
+        :return: encoded image
+        """
+        pass
+
+
+class PillowEngine(AbstractTransformEngine):
+    name = "pillow"
+
+    def supports(self, image_format: str) -> bool:
+        return image_format.upper() in Image.registered_extensions().values()
+
+    def decode(self, data: bytes, reduce_factor: int = 1):
+        with BytesIO(data) as fp:
+            im = Image.open(fp)
+            original_width = im.size[0]
+            if reduce_factor > 1:
+                # JPEG only: decode at 1/2, 1/4 or 1/8 scale by DCT scaling, never holds the full size bitmap
+                scale = get_draft_scale(reduce_factor)
+                im.draft(im.mode, (im.size[0] // scale, im.size[1] // scale))
+            im.load()
+        # Box downsampling by the rest factor, much cheaper than resampling the large bitmap
+        rest_factor = reduce_factor * im.size[0] // original_width
+        if rest_factor >= 2 and im.mode not in ("1", "P"):
+            im = im.reduce(rest_factor)
+        return im
+
+    def get_size(self, bitmap) -> Tuple[int, int]:
+        return bitmap.size
+
+    def resize(self, bitmap, size: Tuple[int, int]):
+        return bitmap.resize(size=size)
+
+    def encode(self, bitmap, image_format: str, **options) -> bytes:
+        if image_format.lower() == "jpeg" and bitmap.mode != "RGB":
+            bitmap = bitmap.convert("RGB")
+        with BytesIO() as fp:
+            bitmap.save(fp, format=image_format, **options)
+            return fp.getvalue()
+
+
+class OpenCVEngine(AbstractTransformEngine):
+    name = "opencv"
+    _EXTENSIONS = {
+        "jpeg": ".jpg",
+        "jpg": ".jpg",
+        "png": ".png",
+        "webp": ".webp",
+    }
+
+    @classmethod
+    def available(cls) -> bool:
+        return cv2 is not None
+
+    def supports(self, image_format: str) -> bool:
+        return image_format.lower() in self._EXTENSIONS
+
+    def decode(self, data: bytes, reduce_factor: int = 1):
+        flags = cv2.IMREAD_UNCHANGED
+        scale = get_draft_scale(reduce_factor)
+        if scale > 1 and data[:2] == b"\xff\xd8":
+            # JPEG (no alpha channel) can be decoded at reduced scale by DCT scaling
+            # Reduced modes apply EXIF orientation but IMREAD_UNCHANGED (and Pillow) don't, ignore it to be the same
+            flags = {
+                2: cv2.IMREAD_REDUCED_COLOR_2,
+                4: cv2.IMREAD_REDUCED_COLOR_4,
+                8: cv2.IMREAD_REDUCED_COLOR_8,
+            }[scale] | cv2.IMREAD_IGNORE_ORIENTATION
+        bitmap = cv2.imdecode(numpy.frombuffer(data, dtype=numpy.uint8), flags)
+        if bitmap is None:
+            raise Exception("OpenCV can't decode the image")
+        return bitmap
+
+    def get_size(self, bitmap) -> Tuple[int, int]:
+        return bitmap.shape[1], bitmap.shape[0]
+
+    def resize(self, bitmap, size: Tuple[int, int]):
+        shrink = size[0] * size[1] < bitmap.shape[0] * bitmap.shape[1]
+        return cv2.resize(bitmap, size, interpolation=cv2.INTER_AREA if shrink else cv2.INTER_LINEAR)
+
+    def encode(self, bitmap, image_format: str, **options) -> bytes:
+        image_format = image_format.lower()
+        params = []
+        if image_format != "png" and bitmap.dtype == numpy.uint16:
+            # 16 bits PNG, only PNG encoder supports 16 bits depth
+            bitmap = (bitmap >> 8).astype(numpy.uint8)
+        if image_format in ("jpeg", "jpg"):
+            if bitmap.ndim == 3 and bitmap.shape[2] == 4:
+                bitmap = cv2.cvtColor(bitmap, cv2.COLOR_BGRA2BGR)
+            params = [cv2.IMWRITE_JPEG_QUALITY, options.get("quality", 75)]
+            if options.get("optimize"):
+                params += [cv2.IMWRITE_JPEG_OPTIMIZE, 1]
+            if options.get("progressive"):
+                params += [cv2.IMWRITE_JPEG_PROGRESSIVE, 1]
+        elif image_format == "png":
+            params = [cv2.IMWRITE_PNG_COMPRESSION, options.get("compress_level", 6)]
+        elif image_format == "webp":
+            # OpenCV treats quality > 100 as lossless
+            params = [cv2.IMWRITE_WEBP_QUALITY, 101 if options.get("lossless") else options.get("quality", 80)]
+        succeed, buffer = cv2.imencode(self._EXTENSIONS[image_format], bitmap, params)
+        if not succeed:
+            raise Exception("OpenCV can't encode the image into {}".format(image_format))
+        return buffer.tobytes()
+
+
+ENGINES = {
+    engine.name: engine
+    for engine in (PillowEngine, OpenCVEngine)
+}
+
+
+class EngineSelector:
+    def __init__(self, engine_mapping: Dict[str, str] = None, default_engine: str = "pillow"):
+        """
+        Select engine by the format of the source image
+        :param engine_mapping: source format -> engine name, like {"jpeg": "opencv"}
+        :param default_engine: the engine for the formats not in mapping
+        """
+        self._default = self._create_engine(default_engine)
+        self._engines = {
+            image_format.lower(): self._create_engine(engine_name)
+            for image_format, engine_name in (engine_mapping or {}).items()
+        }
+
+    @staticmethod
+    def _create_engine(name: str) -> AbstractTransformEngine:
+        if name not in ENGINES:
+            raise Exception("Unknown transform engine: {}".format(name))
+        engine_class = ENGINES[name]
+        if not engine_class.available():
+            raise Exception("Transform engine {} is not available, dependencies are not installed".format(name))
+        return engine_class()
+
+    def select(self, source_format: str, target_format: str) -> AbstractTransformEngine:
+        """
+        Select engine by source format, fallback to default engine if the engine can't handle the formats
+        """
+        engine = self._engines.get(source_format.lower(), self._default)
+        if engine.supports(source_format) and engine.supports(target_format):
+            return engine
+        return self._default
+
+    @staticmethod
+    def parse_mapping(mapping: str) -> Dict[str, str]:
+        """
+        Parse engine mapping like "jpeg:opencv,png:opencv"
+        """
+        return dict(
+            item.strip().split(":", 1)
+            for item in mapping.split(",")
+            if item.strip() != ""
+        )
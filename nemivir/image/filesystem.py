@@ -1,11 +1,21 @@
+import hashlib
+import os
+import random
+import shutil
+import tempfile
+import time
+import uuid
 from abc import ABC, abstractmethod
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED, Future
 from io import BytesIO
-import random
-from typing import BinaryIO
-from urllib.parse import urljoin
+from typing import BinaryIO, List, Dict
+from urllib.parse import urljoin, urlparse
 
 import requests
 
+from .replica import ReplicaSelector, hedge_count
+
 
 class AbstractFileSystem(ABC):
     def read(self, fid: str) -> bytes:
@@ -57,55 +67,363 @@ class AbstractFileSystem(ABC):
         """
         pass
 
+    def delete_many(self, fids: List[str]) -> Dict[str, Exception]:
+        """
+        Remove files in batch, won't stop on failure
+        :param fids: File IDs
+        :return: fid -> exception of the files which failed to remove, KeyError means the file doesn't exist
+        """
+        errors = {}
+        for fid in fids:
+            try:
+                self.delete(fid)
+            except Exception as ex:
+                errors[fid] = ex
+        return errors
+
+    def ping(self):
+        """
+        Check the filesystem is available, raise exception if not
+        :return:
+        """
+        pass
+
 
 class WeedFileSystem(AbstractFileSystem):
-    def __init__(self, master_address: str):
+    def __init__(
+            self,
+            master_address: str,
+            timeout: float = None,
+            concurrency: int = 8,
+            replica_selector: ReplicaSelector = None,
+            lookup_ttl: float = 60,
+            read_concurrency: int = 64
+    ):
         """
         Weed FS interface
         :param master_address: For example http://127.0.0.1:9333/
+        :param timeout: timeout in seconds of connecting/reading, None means waiting forever
+        :param concurrency: max concurrent requests of batch operations
+        :param replica_selector: choose the replica to read and the delay of hedged request
+        :param lookup_ttl: seconds to cache the locations of a volume, 0 means looking up every time
+        :param read_concurrency: max concurrent requests of reading (including hedged requests)
         """
         self._master_address = master_address
+        self._timeout = timeout
+        self._concurrency = concurrency
+        self._replicas = replica_selector if replica_selector is not None else ReplicaSelector()
+        self._lookup_ttl = lookup_ttl
+        self._locations = {}
+        self._read_executor = ThreadPoolExecutor(max_workers=read_concurrency, thread_name_prefix="weed-read")
 
     def download(self, fid: str, fp: BinaryIO, chunk_size: int = 81920):
-        with requests.get(
-                random.choice(self._get_file_urls(fid)),
-                stream=True
-        ) as resp:
-            resp.raise_for_status()
+        try:
+            resp = self._open_fastest(self._get_file_urls(fid))
+        except Exception:
+            # The volume may be moved, look up again next time
+            self._locations.pop(fid.split(",")[0], None)
+            raise
+        with resp:
             chucks = (c for c in resp.iter_content(chunk_size=chunk_size) if c)
             for chunk in chucks:
                 fp.write(chunk)
 
+    def get_replica_stats(self) -> dict:
+        """
+        Latency and error rate of volume servers
+        """
+        return self._replicas.get_stats()
+
+    def _open_fastest(self, urls: List[str]) -> requests.Response:
+        """
+        Request the best replica, send a hedged request to the next replica if the response is slower than usual,
+        and request the next replica at once if a request failed
+        :param urls: URLs of the file on replicas
+        :return: the first succeed response (streaming)
+        """
+        if len(urls) == 0:
+            raise FileNotFoundError("No location of the file")
+        hosts = {urlparse(url).netloc: url for url in urls}
+        candidates = deque(self._replicas.rank(hosts.keys()))
+        running = {}
+        hedged = False
+        last_error = None
+        start_time = time.perf_counter()
+
+        def start() -> Future:
+            host = candidates.popleft()
+            future = self._read_executor.submit(self._open_replica, hosts[host])
+            running[future] = host
+            return future
+
+        primary_future = start()
+        try:
+            while len(running) > 0:
+                can_hedge = self._replicas.hedging and not hedged and len(candidates) > 0
+                done, _ = wait(
+                    running,
+                    timeout=self._replicas.get_hedge_delay() if can_hedge else None,
+                    return_when=FIRST_COMPLETED
+                )
+                if len(done) == 0:
+                    hedged = True
+                    start()
+                    continue
+                for future in done:
+                    running.pop(future)
+                    if future.exception() is not None:
+                        last_error = future.exception()
+                        # Don't wait for the slower requests, replace the failed one
+                        if len(candidates) > 0:
+                            start()
+                        continue
+                    if not hedged:
+                        hedge_count.labels("none").inc()
+                    else:
+                        hedge_count.labels("lost" if future is primary_future else "won").inc()
+                    for host in running.values():
+                        self._replicas.record_slow(host, time.perf_counter() - start_time)
+                    return future.result()
+            raise last_error
+        finally:
+            # Release the connections of the slower requests
+            for future in running:
+                future.add_done_callback(self._close_response)
+
+    def _open_replica(self, url: str) -> requests.Response:
+        host = urlparse(url).netloc
+        start_time = time.perf_counter()
+        try:
+            resp = requests.get(url, stream=True, timeout=self._timeout)
+        except Exception:
+            self._replicas.record(host, time.perf_counter() - start_time, False)
+            raise
+        # Client errors (like 404) are not the fault of the host
+        self._replicas.record(host, time.perf_counter() - start_time, resp.status_code < 500)
+        try:
+            resp.raise_for_status()
+        except Exception:
+            resp.close()
+            raise
+        return resp
+
+    @staticmethod
+    def _close_response(future: Future):
+        if not future.cancelled() and future.exception() is None:
+            future.result().close()
+
     def upload(self, fp: BinaryIO) -> str:
         assigned_info = self._assign_fid()
         url = "http://{}/".format(assigned_info["url"])
         fid = assigned_info["fid"]
-        self._save_file(url, fid, fp)
+        self._save_file(url, fid, fp, self._timeout)
         return fid
 
     def delete(self, fid: str):
-        requests.delete(
-            random.choice(self._get_file_urls(fid))
-        ).raise_for_status()
+        self._delete_file(random.choice(self._get_file_urls(fid)), fid)
+
+    def delete_many(self, fids: List[str]) -> Dict[str, Exception]:
+        # Files in the same volume share the locations, look up once per volume
+        volumes = defaultdict(list)
+        for fid in fids:
+            volumes[fid.split(",")[0]].append(fid)
+        errors = {}
+        with ThreadPoolExecutor(max_workers=self._concurrency) as executor:
+            lookups = {
+                volume_id: executor.submit(self._get_locations, volume_id)
+                for volume_id in volumes.keys()
+            }
+            deletions = {}
+            for volume_id, volume_fids in volumes.items():
+                try:
+                    locations = lookups[volume_id].result()
+                except Exception as ex:
+                    errors.update((fid, ex) for fid in volume_fids)
+                    continue
+                for fid in volume_fids:
+                    url = urljoin("http://{}/".format(random.choice(locations)["url"]), fid)
+                    deletions[fid] = executor.submit(self._delete_file, url, fid)
+            for fid, future in deletions.items():
+                try:
+                    future.result()
+                except Exception as ex:
+                    errors[fid] = ex
+        return errors
+
+    def ping(self):
+        requests.get(urljoin(self._master_address, "/cluster/status"), timeout=self._timeout).raise_for_status()
 
     def _get_file_urls(self, fid: str) -> list:
         return [
             urljoin("http://{}/".format(location["url"]), fid)
-            for location in self._query_locations(fid)["locations"]
+            for location in self._get_locations(fid.split(",")[0])
         ]
 
+    def _get_locations(self, volume_id: str) -> list:
+        # Locations of a volume rarely change, cache them to save a round trip to master
+        cached = self._locations.get(volume_id)
+        if cached is not None and cached[0] > time.monotonic():
+            return cached[1]
+        locations = self._query_locations(volume_id)["locations"]
+        if self._lookup_ttl > 0:
+            self._locations[volume_id] = (time.monotonic() + self._lookup_ttl, locations)
+        return locations
+
+    def _delete_file(self, url: str, fid: str):
+        resp = requests.delete(url, timeout=self._timeout)
+        if resp.status_code == 404:
+            raise KeyError("Can't find file which fid={}".format(fid))
+        resp.raise_for_status()
+
     def _assign_fid(self):
-        resp = requests.get(urljoin(self._master_address, "/dir/assign"))
+        resp = requests.get(urljoin(self._master_address, "/dir/assign"), timeout=self._timeout)
         resp.raise_for_status()
         return resp.json()
 
     def _query_locations(self, fid: str) -> dict:
-        resp = requests.get(urljoin(self._master_address, "/dir/lookup"), params={"volumeId": fid})
+        resp = requests.get(
+            urljoin(self._master_address, "/dir/lookup"),
+            params={"volumeId": fid},
+            timeout=self._timeout
+        )
         resp.raise_for_status()
         return resp.json()
 
     @staticmethod
-    def _save_file(url: str, fid: str, fp: BinaryIO):
-        resp = requests.post(urljoin(url, fid), files={"file": fp})
+    def _save_file(url: str, fid: str, fp: BinaryIO, timeout: float = None):
+        # requests builds the whole multipart body in memory for files=..., stream it from fp instead
+        body = MultipartFileBody(fp)
+        resp = requests.post(
+            urljoin(url, fid),
+            data=body,
+            headers={"Content-Type": body.content_type},
+            timeout=timeout
+        )
         resp.raise_for_status()
         return resp.json()
+
+
+class MultipartFileBody:
+    def __init__(self, fp: BinaryIO, field: str = "file", filename: str = "file", chunk_size: int = 81920):
+        """
+        multipart/form-data body of a single file, read from fp while sending,
+        so the content is never copied into memory as a whole
+        :param fp: file to send from the current position, should be seekable to get the length
+        :param field: name of the form field
+        :param filename: file name in the form
+        :param chunk_size: bytes of each chunk while iterating
+        """
+        boundary = uuid.uuid4().hex
+        self.content_type = "multipart/form-data; boundary={}".format(boundary)
+        self._chunk_size = chunk_size
+        head = "--{}\r\nContent-Disposition: form-data; name=\"{}\"; filename=\"{}\"\r\n\r\n".format(
+            boundary, field, filename
+        ).encode("utf-8")
+        tail = "\r\n--{}--\r\n".format(boundary).encode("utf-8")
+        start = fp.tell()
+        size = fp.seek(0, os.SEEK_END) - start
+        fp.seek(start)
+        self._length = len(head) + size + len(tail)
+        self._parts = deque([BytesIO(head), fp, BytesIO(tail)])
+
+    def __len__(self) -> int:
+        # Used as Content-Length by requests
+        return self._length
+
+    def read(self, size: int = -1) -> bytes:
+        chunks = []
+        while len(self._parts) > 0 and size != 0:
+            chunk = self._parts[0].read(size)
+            if len(chunk) == 0:
+                # Current part is finished
+                self._parts.popleft()
+                continue
+            chunks.append(chunk)
+            if size > 0:
+                size -= len(chunk)
+        return chunks[0] if len(chunks) == 1 else b"".join(chunks)
+
+    def __iter__(self):
+        return iter(lambda: self.read(self._chunk_size), b"")
+
+
+class LocalFileSystem(AbstractFileSystem):
+    def __init__(self, root: str, shard_depth: int = 2, shard_width: int = 2):
+        """
+        Filesystem on local disk, file ID is the sha256 of the content with a random suffix,
+        so uploading the same content twice creates two files (as other backends) and each fid has its own file
+        Files are saved in sharded directories like <root>/ab/cd/abcd...
+        :param root: Root directory to save files
+        :param shard_depth: how many levels of directories
+        :param shard_width: how many hex characters per directory level
+        """
+        self._root = os.path.abspath(root)
+        self._shard_depth = shard_depth
+        self._shard_width = shard_width
+        self._tmp_dir = os.path.join(self._root, "tmp")
+        os.makedirs(self._tmp_dir, exist_ok=True)
+
+    def read(self, fid: str) -> bytes:
+        # Read in one call, the buffer is allocated by the file size
+        with open(self._get_path(fid), "rb") as fp:
+            return fp.read()
+
+    def download(self, fid: str, fp: BinaryIO, chunk_size: int = 81920):
+        with open(self._get_path(fid), "rb") as src:
+            try:
+                out_fd = fp.fileno()
+            except (AttributeError, OSError):
+                out_fd = None
+            if out_fd is not None and hasattr(os, "sendfile"):
+                # Kernel side copy, the data never goes into user space
+                fp.flush()
+                size = os.fstat(src.fileno()).st_size
+                offset = 0
+                while offset < size:
+                    sent = os.sendfile(out_fd, src.fileno(), offset, size - offset)
+                    if sent <= 0:
+                        break
+                    offset += sent
+            else:
+                shutil.copyfileobj(src, fp, chunk_size)
+
+    def upload(self, fp: BinaryIO) -> str:
+        digest = hashlib.sha256()
+        fd, tmp_path = tempfile.mkstemp(dir=self._tmp_dir)
+        try:
+            with os.fdopen(fd, "wb") as tmp:
+                for chunk in iter(lambda: fp.read(81920), b""):
+                    digest.update(chunk)
+                    tmp.write(chunk)
+                tmp.flush()
+                os.fsync(tmp.fileno())
+            fid = digest.hexdigest() + uuid.uuid4().hex[:16]
+            path = self._get_path(fid)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Atomic on POSIX, readers will see the old file or the whole new file
+            os.replace(tmp_path, path)
+            return fid
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def delete(self, fid: str):
+        try:
+            os.remove(self._get_path(fid))
+        except FileNotFoundError:
+            raise KeyError("Can't find file which fid={}".format(fid))
+
+    def ping(self):
+        if not os.access(self._tmp_dir, os.W_OK):
+            raise Exception("Can't write to {}".format(self._tmp_dir))
+
+    def _get_path(self, fid: str) -> str:
+        if len(fid) < self._shard_depth * self._shard_width or not all(c in "0123456789abcdef" for c in fid):
+            # The same as a missing file, not found (404) rather than internal error
+            raise FileNotFoundError("Invalid fid: {}".format(fid))
+        shards = [
+            fid[i * self._shard_width:(i + 1) * self._shard_width]
+            for i in range(self._shard_depth)
+        ]
+        return os.path.join(self._root, *shards, fid)
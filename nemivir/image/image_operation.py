@@ -3,11 +3,23 @@ Image operations:
 - Resize
 - Reformat webp->?
 """
+import math
 from enum import Enum, unique
+from io import BytesIO
+from typing import Optional, Tuple
 
-from PIL import Image
+from PIL import Image, ImageSequence
 from imagehash import average_hash
 
+ANIMATED_FORMATS = {"GIF", "WEBP"}
+
+
+class ImageLimitError(Exception):
+    """
+    The image is too large to process
+    """
+    pass
+
 
 @unique
 class ImageFormat(Enum):
@@ -27,3 +39,137 @@ def get_hash(image: Image) -> str:
     :return:
     """
     return str(average_hash(image=image, hash_size=10))
+
+
+def get_target_size(size: Tuple[int, int], rescale: float = None, w: int = None, h: int = None) -> Tuple[int, int]:
+    """
+    Get the size after resizing
+    :param size: original size
+    :param rescale: ratio to resize
+    :param w: target width
+    :param h: target height
+    :return:
+    """
+    if rescale is not None:
+        return max(1, round(size[0] * rescale)), max(1, round(size[1] * rescale))
+    elif w is not None and h is not None:
+        return w, h
+    else:
+        return size
+
+
+def get_reduce_factor(size: Tuple[int, int], target_size: Tuple[int, int]) -> int:
+    """
+    How many times the image can be reduced while decoding and still not smaller than target size
+    """
+    return max(1, min(size[0] // max(1, target_size[0]), size[1] // max(1, target_size[1])))
+
+
+def get_draft_scale(reduce_factor: int) -> int:
+    """
+    JPEG can be decoded at 1/2, 1/4 or 1/8 scale by DCT scaling, the memory is reduced by scale^2
+    """
+    for scale in (8, 4, 2):
+        if reduce_factor >= scale:
+            return scale
+    return 1
+
+
+def estimate_decode_bytes(im: Image, reduce_factor: int = 1) -> int:
+    """
+    Estimate the memory of decoded bitmap (without decoding)
+    :param im: image opened but not loaded
+    :param reduce_factor: reduce factor while decoding, only works for JPEG
+    :return:
+    """
+    width, height = im.size
+    if im.format == "JPEG":
+        scale = get_draft_scale(reduce_factor)
+        width, height = math.ceil(width / scale), math.ceil(height / scale)
+    if im.mode in ("I", "F"):
+        bytes_per_band = 4
+    elif im.mode.startswith("I;16"):
+        bytes_per_band = 2
+    else:
+        bytes_per_band = 1
+    return width * height * len(im.getbands()) * bytes_per_band
+
+
+def check_image_limits(im: Image, max_pixels: int, max_decode_bytes: int, reduce_factor: int = 1):
+    """
+    Check the image size before decoding, raise ImageLimitError if too large
+    :param im: image opened but not loaded (only header is parsed)
+    :param max_pixels: max pixels of source image
+    :param max_decode_bytes: max memory of decoded bitmap
+    :param reduce_factor: reduce factor while decoding
+    :return:
+    """
+    pixels = im.size[0] * im.size[1]
+    if pixels > max_pixels:
+        raise ImageLimitError("Too many pixels: {}x{} > {}".format(im.size[0], im.size[1], max_pixels))
+    decode_bytes = estimate_decode_bytes(im, reduce_factor)
+    if decode_bytes > max_decode_bytes:
+        raise ImageLimitError("Decoding requires too much memory: {} bytes > {}".format(decode_bytes, max_decode_bytes))
+
+
+def transform_animated(
+        im: Image,
+        size: Optional[Tuple[int, int]],
+        image_format: str,
+        max_frames: int,
+        max_pixels: int,
+        **save_options
+) -> bytes:
+    """
+    Resize and re-encode an animated image frame by frame
+    Only one source frame is decoded at a time, the resized frames are kept until encoding,
+    so the memory is bounded by max_pixels (sum of pixels of all resized frames) rather than the source.
+    :param im: animated image
+    :param size: target size, None means keeping the original size
+    :param image_format: target format, only the first frame is kept if the format is not animated
+    :param max_frames: raise ImageLimitError if the image has more frames
+    :param max_pixels: raise ImageLimitError if the resized frames have more pixels in total
+    :param save_options: options for Image.save
+    :return: encoded data
+    """
+    image_format = image_format.upper()
+    if size is None:
+        size = im.size
+    n_frames = getattr(im, "n_frames", 1)
+    if image_format not in ANIMATED_FORMATS:
+        n_frames = 1
+    if n_frames > max_frames:
+        raise ImageLimitError("Too many frames: {} > {}".format(n_frames, max_frames))
+    if n_frames * size[0] * size[1] > max_pixels:
+        raise ImageLimitError("Too many pixels: {} frames x {}x{} > {}".format(n_frames, size[0], size[1], max_pixels))
+
+    frames = []
+    durations = []
+    for frame in ImageSequence.Iterator(im):
+        if len(frames) >= n_frames:
+            break
+        # Duration of a WEBP frame is read while loading the frame
+        frame.load()
+        durations.append(frame.info.get("duration", im.info.get("duration", 100)))
+        frame = frame.convert("RGB" if image_format == "JPEG" else "RGBA")
+        if frame.size != size:
+            frame = frame.resize(size)
+        frames.append(frame)
+
+    with BytesIO() as fp:
+        if len(frames) > 1:
+            if image_format == "GIF":
+                # Clear the frame before rendering the next one, or the transparent pixels will be overlapped
+                save_options.setdefault("disposal", 2)
+            frames[0].save(
+                fp,
+                format=image_format,
+                save_all=True,
+                append_images=frames[1:],
+                duration=durations,
+                loop=im.info.get("loop", 0),
+                **save_options
+            )
+        else:
+            frames[0].save(fp, format=image_format, **save_options)
+        return fp.getvalue()
@@ -1,5 +1,8 @@
+import json
+import sqlite3
+import threading
 from abc import ABC, abstractmethod
-from typing import List
+from typing import List, Iterator
 from warnings import warn
 
 from pymongo import MongoClient, IndexModel, DESCENDING, ASCENDING, HASHED
@@ -29,28 +32,111 @@ class AbstractImageMeta(ABC):
         """
         pass
 
+    def list_images_by_hashes(self, image_hashes: List[str]) -> List[dict]:
+        """
+        List all images of the hashes in batch
+        :param image_hashes: image hashes
+        :return: the same fields as list_images
+        """
+        images = []
+        for image_hash in image_hashes:
+            images.extend(self.list_images(image_hash))
+        return images
+
     @abstractmethod
     def add_image(self, image_hash: str, fid: str, **kwargs): pass
 
+    def add_images(self, images: List[dict]):
+        """
+        Add images in batch
+        :param images: dicts which contains image_hash, fid and other fields
+        :return:
+        """
+        for image in images:
+            self.add_image(**image)
+
+    @abstractmethod
+    def iter_images(self, after_fid: str = None, batch_size: int = 1000) -> Iterator[dict]:
+        """
+        Iterate all images ordered by fid, for walking through the meta in background jobs
+        Images are queried page by page (keyset pagination), no cursor is kept open between pages
+        :param after_fid: only images with fid greater than this, None means from the beginning
+        :param batch_size: images of each query
+        :return: the same fields as list_images
+        """
+        pass
+
+    @abstractmethod
+    def replace_image(self, fid: str, new_fid: str, **kwargs) -> bool:
+        """
+        Replace the fid of an image and update the fields atomically
+        :param fid: current File ID
+        :param new_fid: new File ID
+        :param kwargs: fields to update
+        :return: False if the image doesn't exist (removed)
+        """
+        pass
+
     @abstractmethod
     def remove_image(self, fid: str): pass
 
+    def remove_images(self, fids: List[str]) -> int:
+        """
+        Remove images in batch, missing fids are ignored
+        :param fids: File IDs
+        :return: removed count
+        """
+        count = 0
+        for fid in fids:
+            try:
+                self.remove_image(fid)
+                count += 1
+            except KeyError:
+                pass
+        return count
+
     @abstractmethod
     def remove_hash(self, image_hash: str) -> int: pass
 
+    def ping(self):
+        """
+        Check the meta database is available, raise exception if not
+        :return:
+        """
+        pass
+
 
 class MongoDBMeta(AbstractImageMeta):
-    def __init__(self, mongodb_url: str, db_name: str, collection_name: str):
+    def __init__(self, mongodb_url: str, db_name: str, collection_name: str, timeout: float = None):
+        """
+        Image meta saved in MongoDB
+        Won't connect to MongoDB until the first operation
+        :param mongodb_url: MongoDB URL
+        :param db_name: database name
+        :param collection_name: collection name
+        :param timeout: server selection/connect timeout in seconds, None means using driver's default
+        """
         self.collection_name = collection_name
         self.db_name = db_name
-        self._conn: MongoClient = MongoClient(mongodb_url)
-        self._get_collection().create_indexes([
-            IndexModel([("image_hash", HASHED)]),
-            IndexModel([("fid", ASCENDING)], unique=True),
-        ])
+        options = {}
+        if timeout is not None:
+            options["serverSelectionTimeoutMS"] = int(timeout * 1000)
+            options["connectTimeoutMS"] = int(timeout * 1000)
+        self._conn: MongoClient = MongoClient(mongodb_url, connect=False, **options)
+        self._indexes_created = False
 
     def _get_collection(self):
-        return self._conn.get_database(self.db_name).get_collection(self.collection_name)
+        collection = self._conn.get_database(self.db_name).get_collection(self.collection_name)
+        if not self._indexes_created:
+            collection.create_indexes([
+                IndexModel([("image_hash", HASHED)]),
+                IndexModel([("fid", ASCENDING)], unique=True),
+            ])
+            self._indexes_created = True
+        return collection
+
+    def ping(self):
+        self._conn.admin.command("ping")
 
     def list_hashes(self, limit: int = -1) -> List[str]:
         if limit > 0:
@@ -63,6 +149,11 @@ class MongoDBMeta(AbstractImageMeta):
             result_set = result_set.limit(limit)
         return list(result_set)
 
+    def list_images_by_hashes(self, image_hashes: List[str]) -> List[dict]:
+        if len(image_hashes) == 0:
+            return []
+        return list(self._get_collection().find({"image_hash": {"$in": list(image_hashes)}}))
+
     def add_image(self, image_hash: str, fid: str, **kwargs):
         return self._get_collection().insert_one(dict(
             image_hash=image_hash,
@@ -70,6 +161,26 @@ class MongoDBMeta(AbstractImageMeta):
             **kwargs
         ))
 
+    def add_images(self, images: List[dict]):
+        if len(images) > 0:
+            return self._get_collection().insert_many(images)
+
+    def iter_images(self, after_fid: str = None, batch_size: int = 1000) -> Iterator[dict]:
+        while True:
+            query = {} if after_fid is None else {"fid": {"$gt": after_fid}}
+            images = list(self._get_collection().find(query).sort("fid", ASCENDING).limit(batch_size))
+            yield from images
+            if len(images) < batch_size:
+                return
+            after_fid = images[-1]["fid"]
+
+    def replace_image(self, fid: str, new_fid: str, **kwargs) -> bool:
+        # Update of a single document is atomic
+        return self._get_collection().update_one(
+            {"fid": fid},
+            {"$set": dict(kwargs, fid=new_fid)}
+        ).matched_count > 0
+
     def remove_image(self, fid: str):
         doc = self._get_collection().find_one({"fid": fid})
         if doc is None:
@@ -78,7 +189,163 @@ class MongoDBMeta(AbstractImageMeta):
         if dc <= 0:
             raise Exception("Can't delete log {}".format(str(doc)))
 
+    def remove_images(self, fids: List[str]) -> int:
+        if len(fids) == 0:
+            return 0
+        return self._get_collection().delete_many(
+            {"fid": {"$in": list(fids)}}
+        ).deleted_count
+
     def remove_hash(self, image_hash: str) -> int:
         return self._get_collection().delete_many(
             {"image_hash": image_hash}
         ).deleted_count
+
+
+class SQLiteMeta(AbstractImageMeta):
+    _CREATE_TABLE = """
+    CREATE TABLE IF NOT EXISTS image_meta (
+        fid TEXT NOT NULL PRIMARY KEY,
+        image_hash TEXT NOT NULL,
+        w INTEGER,
+        h INTEGER,
+        attach TEXT NOT NULL
+    )
+    """
+    _CREATE_INDEXES = (
+        "CREATE INDEX IF NOT EXISTS idx_image_meta_hash ON image_meta (image_hash)",
+        "CREATE INDEX IF NOT EXISTS idx_image_meta_size ON image_meta (w, h)",
+    )
+    _SQL_LIST_HASHES = "SELECT DISTINCT image_hash FROM image_meta"
+    _SQL_LIST_HASHES_LIMIT = "SELECT DISTINCT image_hash FROM image_meta LIMIT ?"
+    _SQL_LIST_IMAGES = "SELECT fid, image_hash, attach FROM image_meta WHERE image_hash = ? LIMIT ?"
+    _SQL_INSERT = "INSERT INTO image_meta (fid, image_hash, w, h, attach) VALUES (?, ?, ?, ?, ?)"
+    _SQL_DELETE_FID = "DELETE FROM image_meta WHERE fid = ?"
+    _SQL_DELETE_HASH = "DELETE FROM image_meta WHERE image_hash = ?"
+    _SQL_LIST_IMAGES_BY_HASHES = "SELECT fid, image_hash, attach FROM image_meta WHERE image_hash IN ({})"
+    _SQL_DELETE_FIDS = "DELETE FROM image_meta WHERE fid IN ({})"
+    _SQL_ITER_IMAGES = "SELECT fid, image_hash, attach FROM image_meta WHERE fid > ? ORDER BY fid LIMIT ?"
+    _SQL_GET_ATTACH = "SELECT image_hash, attach FROM image_meta WHERE fid = ?"
+    _SQL_REPLACE = "UPDATE image_meta SET fid = ?, w = ?, h = ?, attach = ? WHERE fid = ?"
+    # Max host parameters of a statement is 999 in old SQLite versions
+    _BATCH_SIZE = 500
+
+    def __init__(self, db_path: str):
+        """
+        Image meta saved in SQLite (WAL mode), for single node deployment
+        The fields except image_hash/fid/w/h are saved as JSON in attach column
+        :param db_path: SQLite database file path
+        """
+        self.db_path = db_path
+        self._local = threading.local()
+        conn = self._get_connection()
+        with conn:
+            conn.execute(self._CREATE_TABLE)
+            for sql in self._CREATE_INDEXES:
+                conn.execute(sql)
+
+    def _get_connection(self) -> sqlite3.Connection:
+        # sqlite3 connection can't be shared between threads, so one connection per thread
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, cached_statements=256)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA busy_timeout=5000")
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def _to_row(image_hash: str, fid: str, **kwargs) -> tuple:
+        return fid, image_hash, kwargs.get("w"), kwargs.get("h"), json.dumps(kwargs)
+
+    def list_hashes(self, limit: int = -1) -> List[str]:
+        conn = self._get_connection()
+        if limit > 0:
+            cursor = conn.execute(self._SQL_LIST_HASHES_LIMIT, (limit,))
+        else:
+            cursor = conn.execute(self._SQL_LIST_HASHES)
+        return [row[0] for row in cursor]
+
+    def list_images(self, image_hash: str, limit: int = -1) -> List[dict]:
+        cursor = self._get_connection().execute(self._SQL_LIST_IMAGES, (image_hash, limit))
+        return [
+            dict(json.loads(attach), fid=fid, image_hash=ih)
+            for fid, ih, attach in cursor
+        ]
+
+    def _batches(self, items: List[str]):
+        items = list(items)
+        for i in range(0, len(items), self._BATCH_SIZE):
+            batch = items[i:i + self._BATCH_SIZE]
+            yield batch, ", ".join("?" * len(batch))
+
+    def list_images_by_hashes(self, image_hashes: List[str]) -> List[dict]:
+        conn = self._get_connection()
+        images = []
+        for batch, placeholders in self._batches(image_hashes):
+            cursor = conn.execute(self._SQL_LIST_IMAGES_BY_HASHES.format(placeholders), batch)
+            images.extend(
+                dict(json.loads(attach), fid=fid, image_hash=ih)
+                for fid, ih, attach in cursor
+            )
+        return images
+
+    def add_image(self, image_hash: str, fid: str, **kwargs):
+        conn = self._get_connection()
+        with conn:
+            conn.execute(self._SQL_INSERT, self._to_row(image_hash, fid, **kwargs))
+
+    def add_images(self, images: List[dict]):
+        conn = self._get_connection()
+        with conn:
+            conn.executemany(self._SQL_INSERT, (self._to_row(**image) for image in images))
+
+    def iter_images(self, after_fid: str = None, batch_size: int = 1000) -> Iterator[dict]:
+        conn = self._get_connection()
+        while True:
+            cursor = conn.execute(self._SQL_ITER_IMAGES, ("" if after_fid is None else after_fid, batch_size))
+            images = [
+                dict(json.loads(attach), fid=fid, image_hash=ih)
+                for fid, ih, attach in cursor
+            ]
+            yield from images
+            if len(images) < batch_size:
+                return
+            after_fid = images[-1]["fid"]
+
+    def replace_image(self, fid: str, new_fid: str, **kwargs) -> bool:
+        conn = self._get_connection()
+        with conn:
+            # Lock the database before reading, so the fields read can't be changed before updating
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute(self._SQL_GET_ATTACH, (fid,)).fetchone()
+            if row is None:
+                return False
+            image_hash, attach = row
+            new_fid, image_hash, w, h, attach = self._to_row(image_hash, new_fid, **dict(json.loads(attach), **kwargs))
+            conn.execute(self._SQL_REPLACE, (new_fid, w, h, attach, fid))
+        return True
+
+    def remove_image(self, fid: str):
+        conn = self._get_connection()
+        with conn:
+            dc = conn.execute(self._SQL_DELETE_FID, (fid,)).rowcount
+        if dc <= 0:
+            raise KeyError("Can't find log which fid={}".format(fid))
+
+    def remove_images(self, fids: List[str]) -> int:
+        conn = self._get_connection()
+        count = 0
+        with conn:
+            for batch, placeholders in self._batches(fids):
+                count += conn.execute(self._SQL_DELETE_FIDS.format(placeholders), batch).rowcount
+        return count
+
+    def remove_hash(self, image_hash: str) -> int:
+        conn = self._get_connection()
+        with conn:
+            return conn.execute(self._SQL_DELETE_HASH, (image_hash,)).rowcount
+
+    def ping(self):
+        self._get_connection().execute("SELECT 1").fetchone()
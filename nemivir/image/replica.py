@@ -0,0 +1,135 @@
+"""
+Replica selection of volume servers: prefer the host with lower latency and error rate (EWMA),
+and estimate the delay to send a hedged request to another replica
+"""
+import random
+import threading
+from collections import deque
+from typing import List, Optional
+
+from prometheus_client import Counter
+
+replica_request_count = Counter(
+    "weed_replica_request_count",
+    "Requests to volume servers by host and result",
+    labelnames=("host", "result")
+)
+
+hedge_count = Counter(
+    "weed_hedge_count",
+    "Reads of volume servers by hedging result (none: no hedged request, lost: primary finished first, won)",
+    labelnames=("result",)
+)
+
+
+class ReplicaSelector:
+    def __init__(
+            self,
+            alpha: float = 0.2,
+            error_penalty: float = 10.0,
+            explore_ratio: float = 0.02,
+            hedge_percentile: Optional[float] = 95.0,
+            default_hedge_delay: float = 0.05,
+            min_hedge_delay: float = 0.005,
+            window: int = 1000
+    ):
+        """
+        Track the latency and error rate of each host
+        :param alpha: smoothing factor of EWMA
+        :param error_penalty: score of a host is latency * (1 + error_penalty * error_rate)
+        :param explore_ratio: ratio of requests choosing a random host, so a recovered host can be measured again
+        :param hedge_percentile: send hedged request after this percentile of recent latencies, None disables hedging
+        :param default_hedge_delay: hedge delay (seconds) before there are enough samples
+        :param min_hedge_delay: lower bound of hedge delay (seconds), avoid doubling the requests of fast hosts
+        :param window: how many recent latencies to estimate the percentile
+        """
+        self._alpha = alpha
+        self._error_penalty = error_penalty
+        self._explore_ratio = explore_ratio
+        self._hedge_percentile = hedge_percentile
+        self._default_hedge_delay = default_hedge_delay
+        self._min_hedge_delay = min_hedge_delay
+        self._latencies = {}
+        self._error_rates = {}
+        self._recent = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    @property
+    def hedging(self) -> bool:
+        return self._hedge_percentile is not None
+
+    def score(self, host: str) -> float:
+        """
+        Expected latency of the host, lower is better, unknown host scores 0 to be measured first
+        """
+        latency = self._latencies.get(host)
+        if latency is None:
+            return 0.0
+        return latency * (1 + self._error_penalty * self._error_rates.get(host, 0.0))
+
+    def rank(self, hosts: List[str]) -> List[str]:
+        """
+        Sort the hosts, the best first
+        """
+        hosts = list(hosts)
+        random.shuffle(hosts)
+        if random.random() < self._explore_ratio:
+            return hosts
+        with self._lock:
+            return sorted(hosts, key=self.score)
+
+    def record(self, host: str, latency: float, succeed: bool):
+        """
+        Record the result of a request
+        :param host: host of the request
+        :param latency: seconds, the time until failure for a failed request
+        :param succeed: False if the request failed
+        """
+        replica_request_count.labels(host, "success" if succeed else "error").inc()
+        with self._lock:
+            error_rate = self._error_rates.get(host, 0.0)
+            self._error_rates[host] = self._alpha * (0.0 if succeed else 1.0) + (1 - self._alpha) * error_rate
+            if succeed:
+                self._recent.append(latency)
+            # A failed request counts at least as slow as the latency so far
+            old_latency = self._latencies.get(host)
+            if old_latency is None:
+                self._latencies[host] = latency
+            elif succeed or latency > old_latency:
+                self._latencies[host] = self._alpha * latency + (1 - self._alpha) * old_latency
+
+    def record_slow(self, host: str, elapsed: float):
+        """
+        Record a request which is still running but slower than the hedged one,
+        the latency is at least the elapsed time, so the host can be avoided before the request finishes
+        """
+        with self._lock:
+            old_latency = self._latencies.get(host)
+            if old_latency is None or elapsed > old_latency:
+                self._latencies[host] = elapsed if old_latency is None else \
+                    self._alpha * elapsed + (1 - self._alpha) * old_latency
+
+    def get_hedge_delay(self) -> float:
+        """
+        Delay (seconds) before sending hedged request, the percentile of recent latencies
+        """
+        with self._lock:
+            if len(self._recent) < 20:
+                return self._default_hedge_delay
+            latencies = sorted(self._recent)
+        index = min(len(latencies) - 1, int(len(latencies) * self._hedge_percentile / 100.0))
+        return max(self._min_hedge_delay, latencies[index])
+
+    def get_stats(self) -> dict:
+        """
+        Current latency (seconds) and error rate of hosts
+        """
+        with self._lock:
+            return {
+                host: {
+                    "latency": latency,
+                    "error_rate": self._error_rates.get(host, 0.0),
+                    "score": self.score(host),
+                }
+                for host, latency in self._latencies.items()
+            }
@@ -0,0 +1,73 @@
+"""
+Index of image hashes to find the similar images: hashes within a small Hamming distance
+"""
+import threading
+import time
+from typing import Iterable, List, Tuple
+
+
+class SimilarHashIndex:
+    def __init__(self, hash_bits: int = 100, bands: int = 8):
+        """
+        Multi-index hashing: the bits of the hash are split into bands, and each band is indexed by its value.
+        If the distance of two hashes is less than the band count, at least one band is exactly the same,
+        so only the hashes sharing a band with the query are compared.
+        Larger distances fall back to comparing all the hashes.
+        :param hash_bits: bits of the hash, get_hash with hash_size=10 creates 100 bits
+        :param bands: how many bands to split, distance < bands is searched by the index
+        """
+        self.hash_bits = hash_bits
+        self.bands = bands
+        band_size = (hash_bits + bands - 1) // bands
+        self._band_ranges = [
+            (offset, min(band_size, hash_bits - offset))
+            for offset in range(0, hash_bits, band_size)
+        ]
+        self._tables = [{} for _ in self._band_ranges]
+        self._hashes = {}
+        self._lock = threading.Lock()
+        self.build_time = time.time()
+
+    def __len__(self):
+        return len(self._hashes)
+
+    def _get_bands(self, value: int) -> List[int]:
+        return [(value >> offset) & ((1 << size) - 1) for offset, size in self._band_ranges]
+
+    def add(self, image_hash: str):
+        value = int(image_hash, 16)
+        with self._lock:
+            if image_hash in self._hashes:
+                return
+            self._hashes[image_hash] = value
+            for table, band in zip(self._tables, self._get_bands(value)):
+                table.setdefault(band, []).append(image_hash)
+
+    def add_all(self, image_hashes: Iterable[str]):
+        for image_hash in image_hashes:
+            self.add(image_hash)
+
+    def search(self, image_hash: str, max_distance: int, limit: int = 100) -> List[Tuple[str, int]]:
+        """
+        Find the hashes within the distance (including the hash itself if it's indexed)
+        :param image_hash: hash to query, a hex string
+        :param max_distance: max Hamming distance
+        :param limit: max hashes to return
+        :return: (hash, distance), the nearest first
+        """
+        value = int(image_hash, 16)
+        with self._lock:
+            if max_distance < len(self._tables):
+                candidates = set()
+                for table, band in zip(self._tables, self._get_bands(value)):
+                    candidates.update(table.get(band, ()))
+                candidates = [(h, self._hashes[h]) for h in candidates]
+            else:
+                candidates = list(self._hashes.items())
+        matched = []
+        for candidate, candidate_value in candidates:
+            distance = bin(value ^ candidate_value).count("1")
+            if distance <= max_distance:
+                matched.append((candidate, distance))
+        matched.sort(key=lambda x: (x[1], x[0]))
+        return matched[:limit]
@@ -1,9 +1,21 @@
 """
 Build protobuf:
-$ protoc -I protos --python_out=nemivir/protos protos/image_cache.proto
+$ protoc -I protos --python_out=nemivir/protos protos/image_cache.proto protos/image_service.proto
+$ python -m grpc_tools.protoc -I protos --grpc_python_out=nemivir/protos protos/image_service.proto
+Then change the absolute imports of the generated modules (`import image_cache_pb2 as ...`) to `from . import`.
+
+image_service_pb2_grpc requires grpcio, it's not imported here, so the HTTP service works without grpcio.
 """
 
-from .image_cache_pb2 import ImageResponse
+import struct
+from typing import BinaryIO, Iterator, List
+
+from .image_cache_pb2 import ImageResponse, BatchImageItem
+from .image_service_pb2 import UploadRequest, UploadResult, BatchGetRequest, DeleteRequest, DeleteResult, \
+    SimilarRequest, SimilarHash, SimilarResult
+
+# Length prefix of each item in batch response
+_LENGTH_PREFIX = struct.Struct(">I")
 
 
 def create_image_response(data: bytes, media_type: str) -> ImageResponse:
@@ -11,3 +23,50 @@ def create_image_response(data: bytes, media_type: str) -> ImageResponse:
     ir.content = data
     ir.media_type = media_type
     return ir
+
+
+def pack_batch_item(item: BatchImageItem) -> bytes:
+    """
+    Serialize an item of batch response: 4 bytes length (big endian) + serialized BatchImageItem
+    """
+    data = item.SerializeToString()
+    return _LENGTH_PREFIX.pack(len(data)) + data
+
+
+def iter_batch_items(fp: BinaryIO) -> Iterator[BatchImageItem]:
+    """
+    Read the items of batch response from a stream
+    """
+    while True:
+        header = fp.read(_LENGTH_PREFIX.size)
+        if len(header) == 0:
+            return
+        if len(header) < _LENGTH_PREFIX.size:
+            raise EOFError("Incomplete length prefix of batch item")
+        length, = _LENGTH_PREFIX.unpack(header)
+        data = fp.read(length)
+        if len(data) < length:
+            raise EOFError("Incomplete batch item, expect {} bytes, got {}".format(length, len(data)))
+        item = BatchImageItem()
+        item.ParseFromString(data)
+        yield item
+
+
+def unpack_batch_items(buffer: bytearray) -> List[BatchImageItem]:
+    """
+    Read the complete items at the beginning of the buffer and remove them from the buffer,
+    for reading the batch response incrementally (by chunks)
+    """
+    items = []
+    offset = 0
+    while len(buffer) - offset >= _LENGTH_PREFIX.size:
+        length, = _LENGTH_PREFIX.unpack_from(buffer, offset)
+        end = offset + _LENGTH_PREFIX.size + length
+        if end > len(buffer):
+            break
+        item = BatchImageItem()
+        item.ParseFromString(bytes(buffer[offset + _LENGTH_PREFIX.size:end]))
+        items.append(item)
+        offset = end
+    del buffer[:offset]
+    return items
@@ -1,12 +1,10 @@
 # -*- coding: utf-8 -*-
 # Generated by the protocol buffer compiler.  DO NOT EDIT!
 # source: image_cache.proto
-
-import sys
-_b=sys.version_info[0]<3 and (lambda x:x) or (lambda x:x.encode('latin1'))
+"""Generated protocol buffer code."""
+from google.protobuf.internal import builder as _builder
 from google.protobuf import descriptor as _descriptor
-from google.protobuf import message as _message
-from google.protobuf import reflection as _reflection
+from google.protobuf import descriptor_pool as _descriptor_pool
 from google.protobuf import symbol_database as _symbol_database
 # @@protoc_insertion_point(imports)
 
@@ -15,63 +13,15 @@ _sym_db = _symbol_database.Default()
 
 
 
-DESCRIPTOR = _descriptor.FileDescriptor(
-  name='image_cache.proto',
-  package='nemivir.protos',
-  syntax='proto3',
-  serialized_options=None,
-  serialized_pb=_b('\n\x11image_cache.proto\x12\x0enemivir.protos\"4\n\rImageResponse\x12\x0f\n\x07\x63ontent\x18\x01 \x01(\x0c\x12\x12\n\nmedia_type\x18\x02 \x01(\tb\x06proto3')
-)
-
-
-
-
-_IMAGERESPONSE = _descriptor.Descriptor(
-  name='ImageResponse',
-  full_name='nemivir.protos.ImageResponse',
-  filename=None,
-  file=DESCRIPTOR,
-  containing_type=None,
-  fields=[
-    _descriptor.FieldDescriptor(
-      name='content', full_name='nemivir.protos.ImageResponse.content', index=0,
-      number=1, type=12, cpp_type=9, label=1,
-      has_default_value=False, default_value=_b(""),
-      message_type=None, enum_type=None, containing_type=None,
-      is_extension=False, extension_scope=None,
-      serialized_options=None, file=DESCRIPTOR),
-    _descriptor.FieldDescriptor(
-      name='media_type', full_name='nemivir.protos.ImageResponse.media_type', index=1,
-      number=2, type=9, cpp_type=9, label=1,
-      has_default_value=False, default_value=_b("").decode('utf-8'),
-      message_type=None, enum_type=None, containing_type=None,
-      is_extension=False, extension_scope=None,
-      serialized_options=None, file=DESCRIPTOR),
-  ],
-  extensions=[
-  ],
-  nested_types=[],
-  enum_types=[
-  ],
-  serialized_options=None,
-  is_extendable=False,
-  syntax='proto3',
-  extension_ranges=[],
-  oneofs=[
-  ],
-  serialized_start=37,
-  serialized_end=89,
-)
-
-DESCRIPTOR.message_types_by_name['ImageResponse'] = _IMAGERESPONSE
-_sym_db.RegisterFileDescriptor(DESCRIPTOR)
-
-ImageResponse = _reflection.GeneratedProtocolMessageType('ImageResponse', (_message.Message,), {
-  'DESCRIPTOR' : _IMAGERESPONSE,
-  '__module__' : 'image_cache_pb2'
-  # @@protoc_insertion_point(class_scope:nemivir.protos.ImageResponse)
-  })
-_sym_db.RegisterMessage(ImageResponse)
+DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\x11image_cache.proto\x12\x0enemivir.protos\"4\n\rImageResponse\x12\x0f\n\x07\x63ontent\x18\x01 \x01(\x0c\x12\x12\n\nmedia_type\x18\x02 \x01(\t\"\xac\x01\n\x0e\x42\x61tchImageItem\x12\r\n\x05index\x18\x01 \x01(\x05\x12\x0b\n\x03\x66id\x18\x02 \x01(\t\x12\x12\n\nimage_hash\x18\x03 \x01(\t\x12\x0e\n\x06status\x18\x04 \x01(\x05\x12\x0f\n\x07message\x18\x05 \x01(\t\x12,\n\x05image\x18\x06 \x01(\x0b\x32\x1d.nemivir.protos.ImageResponse\x12\x0c\n\x04\x65tag\x18\x07 \x01(\t\x12\r\n\x05\x63\x61\x63he\x18\x08 \x01(\tb\x06proto3')
 
+_builder.BuildMessageAndEnumDescriptors(DESCRIPTOR, globals())
+_builder.BuildTopDescriptorsAndMessages(DESCRIPTOR, 'image_cache_pb2', globals())
+if _descriptor._USE_C_DESCRIPTORS == False:
 
+  DESCRIPTOR._options = None
+  _IMAGERESPONSE._serialized_start=37
+  _IMAGERESPONSE._serialized_end=89
+  _BATCHIMAGEITEM._serialized_start=92
+  _BATCHIMAGEITEM._serialized_end=264
 # @@protoc_insertion_point(module_scope)
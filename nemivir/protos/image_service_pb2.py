@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+# Generated by the protocol buffer compiler.  DO NOT EDIT!
+# source: image_service.proto
+"""Generated protocol buffer code."""
+from google.protobuf.internal import builder as _builder
+from google.protobuf import descriptor as _descriptor
+from google.protobuf import descriptor_pool as _descriptor_pool
+from google.protobuf import symbol_database as _symbol_database
+# @@protoc_insertion_point(imports)
+
+_sym_db = _symbol_database.Default()
+
+
+from . import image_cache_pb2 as image__cache__pb2
+
+
+DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\x13image_service.proto\x12\x0enemivir.protos\x1a\x11image_cache.proto\"\xd6\x01\n\rUploadRequest\x12\x0f\n\x07\x63ontent\x18\x01 \x01(\x0c\x12\x0c\n\x04mode\x18\x02 \x01(\t\x12\x13\n\x0b\x61uto_remove\x18\x03 \x01(\x08\x12\x14\n\x0cimage_format\x18\x04 \x01(\t\x12\x13\n\x06method\x18\x05 \x01(\x05H\x00\x88\x01\x01\x12\x10\n\x08lossless\x18\x06 \x01(\x08\x12\x14\n\x07quality\x18\x07 \x01(\x05H\x01\x88\x01\x01\x12\x13\n\x0b\x61ttach_info\x18\x08 \x01(\t\x12\x12\n\nrequest_id\x18\t \x01(\tB\t\n\x07_methodB\n\n\x08_quality\"\x94\x01\n\x0cUploadResult\x12\x12\n\nrequest_id\x18\x01 \x01(\t\x12\x0e\n\x06status\x18\x02 \x01(\x05\x12\x0f\n\x07message\x18\x03 \x01(\t\x12\r\n\x05wrote\x18\x04 \x01(\x08\x12\x0b\n\x03\x66id\x18\x05 \x01(\t\x12\x12\n\nimage_hash\x18\x06 \x01(\t\x12\x0f\n\x07removed\x18\x07 \x03(\t\x12\x0e\n\x06\x61ttach\x18\x08 \x01(\t\"\x93\x01\n\x0f\x42\x61tchGetRequest\x12\x0c\n\x04\x66ids\x18\x01 \x03(\t\x12\x0e\n\x06hashes\x18\x02 \x03(\t\x12\x14\n\x07rescale\x18\x03 \x01(\x02H\x00\x88\x01\x01\x12\x0e\n\x01w\x18\x04 \x01(\x05H\x01\x88\x01\x01\x12\x0e\n\x01h\x18\x05 \x01(\x05H\x02\x88\x01\x01\x12\x14\n\x0cimage_format\x18\x06 \x01(\tB\n\n\x08_rescaleB\x04\n\x02_wB\x04\n\x02_h\"-\n\rDeleteRequest\x12\x0c\n\x04\x66ids\x18\x01 \x03(\t\x12\x0e\n\x06hashes\x18\x02 \x03(\t\"\x88\x01\n\x0c\x44\x65leteResult\x12\x0f\n\x07removed\x18\x01 \x03(\t\x12\x38\n\x06\x66\x61iled\x18\x02 \x03(\x0b\x32(.nemivir.protos.DeleteResult.FailedEntry\x1a-\n\x0b\x46\x61iledEntry\x12\x0b\n\x03key\x18\x01 \x01(\t\x12\r\n\x05value\x18\x02 \x01(\t:\x02\x38\x01\"I\n\x0eSimilarRequest\x12\x12\n\nimage_hash\x18\x01 \x01(\t\x12\x14\n\x0cmax_distance\x18\x02 \x01(\x05\x12\r\n\x05limit\x18\x03 \x01(\x05\"A\n\x0bSimilarHash\x12\x12\n\nimage_hash\x18\x01 \x01(\t\x12\x10\n\x08\x64istance\x18\x02 \x01(\x05\x12\x0c\n\x04\x66ids\x18\x03 \x03(\t\"=\n\rSimilarResult\x12,\n\x07similar\x18\x01 \x03(\x0b\x32\x1b.nemivir.protos.SimilarHash2\xbd\x02\n\x0cImageService\x12I\n\x06Upload\x12\x1d.nemivir.protos.UploadRequest\x1a\x1c.nemivir.protos.UploadResult(\x01\x30\x01\x12M\n\x08\x42\x61tchGet\x12\x1f.nemivir.protos.BatchGetRequest\x1a\x1e.nemivir.protos.BatchImageItem0\x01\x12\x45\n\x06\x44\x65lete\x12\x1d.nemivir.protos.DeleteRequest\x1a\x1c.nemivir.protos.DeleteResult\x12L\n\x0b\x46indSimilar\x12\x1e.nemivir.protos.SimilarRequest\x1a\x1d.nemivir.protos.SimilarResultb\x06proto3')
+
+_builder.BuildMessageAndEnumDescriptors(DESCRIPTOR, globals())
+_builder.BuildTopDescriptorsAndMessages(DESCRIPTOR, 'image_service_pb2', globals())
+if _descriptor._USE_C_DESCRIPTORS == False:
+
+  DESCRIPTOR._options = None
+  _DELETERESULT_FAILEDENTRY._options = None
+  _DELETERESULT_FAILEDENTRY._serialized_options = b'8\001'
+  _UPLOADREQUEST._serialized_start=59
+  _UPLOADREQUEST._serialized_end=273
+  _UPLOADRESULT._serialized_start=276
+  _UPLOADRESULT._serialized_end=424
+  _BATCHGETREQUEST._serialized_start=427
+  _BATCHGETREQUEST._serialized_end=574
+  _DELETEREQUEST._serialized_start=576
+  _DELETEREQUEST._serialized_end=621
+  _DELETERESULT._serialized_start=624
+  _DELETERESULT._serialized_end=760
+  _DELETERESULT_FAILEDENTRY._serialized_start=715
+  _DELETERESULT_FAILEDENTRY._serialized_end=760
+  _SIMILARREQUEST._serialized_start=762
+  _SIMILARREQUEST._serialized_end=835
+  _SIMILARHASH._serialized_start=837
+  _SIMILARHASH._serialized_end=902
+  _SIMILARRESULT._serialized_start=904
+  _SIMILARRESULT._serialized_end=965
+  _IMAGESERVICE._serialized_start=968
+  _IMAGESERVICE._serialized_end=1285
+# @@protoc_insertion_point(module_scope)
@@ -0,0 +1,234 @@
+# Generated by the gRPC Python protocol compiler plugin. DO NOT EDIT!
+"""Client and server classes corresponding to protobuf-defined services."""
+import grpc
+import warnings
+
+from . import image_cache_pb2 as image__cache__pb2
+from . import image_service_pb2 as image__service__pb2
+
+GRPC_GENERATED_VERSION = '1.84.0'
+GRPC_VERSION = grpc.__version__
+_version_not_supported = False
+
+try:
+    from grpc._utilities import first_version_is_lower
+    _version_not_supported = first_version_is_lower(GRPC_VERSION, GRPC_GENERATED_VERSION)
+except ImportError:
+    _version_not_supported = True
+
+if _version_not_supported:
+    raise RuntimeError(
+        f'The grpc package installed is at version {GRPC_VERSION},'
+        + ' but the generated code in image_service_pb2_grpc.py depends on'
+        + f' grpcio>={GRPC_GENERATED_VERSION}.'
+        + f' Please upgrade your grpc module to grpcio>={GRPC_GENERATED_VERSION}'
+        + f' or downgrade your generated code using grpcio-tools<={GRPC_VERSION}.'
+    )
+
+
+class ImageServiceStub:
+    """The same functions as the HTTP API, for internal clients pushing or pulling a lot of images
+    """
+
+    def __init__(self, channel):
+        """Constructor.
+
+        Args:
+            channel: A grpc.Channel.
+        """
+        self.Upload = channel.stream_stream(
+                '/nemivir.protos.ImageService/Upload',
+                request_serializer=image__service__pb2.UploadRequest.SerializeToString,
+                response_deserializer=image__service__pb2.UploadResult.FromString,
+                _registered_method=True)
+        self.BatchGet = channel.unary_stream(
+                '/nemivir.protos.ImageService/BatchGet',
+                request_serializer=image__service__pb2.BatchGetRequest.SerializeToString,
+                response_deserializer=image__cache__pb2.BatchImageItem.FromString,
+                _registered_method=True)
+        self.Delete = channel.unary_unary(
+                '/nemivir.protos.ImageService/Delete',
+                request_serializer=image__service__pb2.DeleteRequest.SerializeToString,
+                response_deserializer=image__service__pb2.DeleteResult.FromString,
+                _registered_method=True)
+        self.FindSimilar = channel.unary_unary(
+                '/nemivir.protos.ImageService/FindSimilar',
+                request_serializer=image__service__pb2.SimilarRequest.SerializeToString,
+                response_deserializer=image__service__pb2.SimilarResult.FromString,
+                _registered_method=True)
+
+
+class ImageServiceServicer:
+    """The same functions as the HTTP API, for internal clients pushing or pulling a lot of images
+    """
+
+    def Upload(self, request_iterator, context):
+        """Upload images in a stream, results are returned in the order of requests
+        """
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def BatchGet(self, request, context):
+        """Get images with the same transform parameters, cached images are sent first
+        """
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def Delete(self, request, context):
+        """Remove images by fids and hashes
+        """
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def FindSimilar(self, request, context):
+        """Find the hashes within a Hamming distance
+        """
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+
+def add_ImageServiceServicer_to_server(servicer, server):
+    rpc_method_handlers = {
+            'Upload': grpc.stream_stream_rpc_method_handler(
+                    servicer.Upload,
+                    request_deserializer=image__service__pb2.UploadRequest.FromString,
+                    response_serializer=image__service__pb2.UploadResult.SerializeToString,
+            ),
+            'BatchGet': grpc.unary_stream_rpc_method_handler(
+                    servicer.BatchGet,
+                    request_deserializer=image__service__pb2.BatchGetRequest.FromString,
+                    response_serializer=image__cache__pb2.BatchImageItem.SerializeToString,
+            ),
+            'Delete': grpc.unary_unary_rpc_method_handler(
+                    servicer.Delete,
+                    request_deserializer=image__service__pb2.DeleteRequest.FromString,
+                    response_serializer=image__service__pb2.DeleteResult.SerializeToString,
+            ),
+            'FindSimilar': grpc.unary_unary_rpc_method_handler(
+                    servicer.FindSimilar,
+                    request_deserializer=image__service__pb2.SimilarRequest.FromString,
+                    response_serializer=image__service__pb2.SimilarResult.SerializeToString,
+            ),
+    }
+    generic_handler = grpc.method_handlers_generic_handler(
+            'nemivir.protos.ImageService', rpc_method_handlers)
+    server.add_generic_rpc_handlers((generic_handler,))
+    server.add_registered_method_handlers('nemivir.protos.ImageService', rpc_method_handlers)
+
+
+ # This class is part of an EXPERIMENTAL API.
+class ImageService:
+    """The same functions as the HTTP API, for internal clients pushing or pulling a lot of images
+    """
+
+    @staticmethod
+    def Upload(request_iterator,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.stream_stream(
+            request_iterator,
+            target,
+            '/nemivir.protos.ImageService/Upload',
+            image__service__pb2.UploadRequest.SerializeToString,
+            image__service__pb2.UploadResult.FromString,
+            options,
+            channel_credentials,
+            insecure,
+            call_credentials,
+            compression,
+            wait_for_ready,
+            timeout,
+            metadata,
+            _registered_method=True)
+
+    @staticmethod
+    def BatchGet(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_stream(
+            request,
+            target,
+            '/nemivir.protos.ImageService/BatchGet',
+            image__service__pb2.BatchGetRequest.SerializeToString,
+            image__cache__pb2.BatchImageItem.FromString,
+            options,
+            channel_credentials,
+            insecure,
+            call_credentials,
+            compression,
+            wait_for_ready,
+            timeout,
+            metadata,
+            _registered_method=True)
+
+    @staticmethod
+    def Delete(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_unary(
+            request,
+            target,
+            '/nemivir.protos.ImageService/Delete',
+            image__service__pb2.DeleteRequest.SerializeToString,
+            image__service__pb2.DeleteResult.FromString,
+            options,
+            channel_credentials,
+            insecure,
+            call_credentials,
+            compression,
+            wait_for_ready,
+            timeout,
+            metadata,
+            _registered_method=True)
+
+    @staticmethod
+    def FindSimilar(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_unary(
+            request,
+            target,
+            '/nemivir.protos.ImageService/FindSimilar',
+            image__service__pb2.SimilarRequest.SerializeToString,
+            image__service__pb2.SimilarResult.FromString,
+            options,
+            channel_credentials,
+            insecure,
+            call_credentials,
+            compression,
+            wait_for_ready,
+            timeout,
+            metadata,
+            _registered_method=True)
@@ -0,0 +1,661 @@
+"""
+Core logic of the image service, shared by the HTTP API (image_api) and the gRPC API (grpc_api)
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from io import BytesIO
+from typing import List, Tuple, Dict, Iterator, BinaryIO, Optional
+
+from PIL import Image, UnidentifiedImageError
+from prometheus_client import Counter, Histogram
+from requests import HTTPError
+
+from nemivir.config import filesystem, lock_manager, cache, metadb, transform_engines, \
+    animation_max_frames, animation_max_pixels, upload_encoder_profiles, transform_encoder_profiles, \
+    image_max_pixels, image_max_decode_bytes, batch_concurrency, admission, similar_index_ttl, similar_max_distance, \
+    upload_max_bytes
+from nemivir.image import get_hash, get_target_size, transform_animated, ImageLimitError, ANIMATED_FORMATS, \
+    EncoderProfile, get_reduce_factor, check_image_limits, SimilarHashIndex, ImageFormat
+from nemivir.protos import ImageResponse, BatchImageItem, create_image_response
+from nemivir.util import RedisDistributedLock, LazyResource, OverloadError, LockError
+
+log = logging.getLogger(__file__)
+
+# Pillow's decompression bomb check is replaced by check_image_limits (before decoding)
+Image.MAX_IMAGE_PIXELS = image_max_pixels
+
+request_count = Counter(
+    "api_request_count",
+    "Request Count of API",
+    labelnames=("api_name",)
+)
+
+fail_count = Counter(
+    "api_fail_count",
+    "Fail Count of API",
+    labelnames=("status_code", "exception_type")
+)
+
+stage_latency = Histogram(
+    "api_stage_latency_seconds",
+    "Latency of each stage while processing image",
+    labelnames=("stage", "image_format", "transform"),
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+)
+
+cache_count = Counter(
+    "api_cache_count",
+    "Hit/Miss count of image cache",
+    labelnames=("result", "image_format", "transform")
+)
+
+image_bytes = Histogram(
+    "api_image_bytes",
+    "Size in bytes of images",
+    labelnames=("stage", "image_format", "transform"),
+    buckets=(1 << 10, 4 << 10, 16 << 10, 64 << 10, 256 << 10, 1 << 20, 4 << 20, 16 << 20, 64 << 20)
+)
+
+admission_wait = Histogram(
+    "api_admission_wait_seconds",
+    "Waiting time of admission control by request class",
+    labelnames=("request_class",),
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+)
+
+admission_reject_count = Counter(
+    "api_admission_reject_count",
+    "Rejected requests of admission control by request class",
+    labelnames=("request_class",)
+)
+
+# Created in worker process lazily (after forking)
+batch_executor = LazyResource(lambda: ThreadPoolExecutor(max_workers=batch_concurrency, thread_name_prefix="batch"))
+
+
+def _create_similar_index() -> SimilarHashIndex:
+    index = SimilarHashIndex()
+    with stage_latency.labels("similar_index", "any", "similar").time():
+        index.add_all(metadb.resource.list_hashes())
+    log.info("Similar hash index is built with {} hashes".format(len(index)))
+    return index
+
+
+similar_index = LazyResource(_create_similar_index)
+_similar_index_rebuilding = threading.Lock()
+
+
+class ParameterError(Exception): pass
+
+
+# Formats which images can be converted to
+TRANSFORM_FORMATS = tuple(f.value for f in ImageFormat)
+_FORMAT_ALIASES = {"jpg": "jpeg"}
+# Values of image_format label, other values share the label "other" (every label value is a new series)
+_FORMAT_LABELS = set(TRANSFORM_FORMATS) | {"original", "auto"}
+
+
+def check_image_format(image_format: Optional[str]) -> Optional[str]:
+    """
+    Check the format to convert to
+    :param image_format: format in any case (jpg is jpeg), None means the original format
+    :return: lower case format, None means the original format
+    """
+    if image_format is None:
+        return None
+    normalized = image_format.lower()
+    normalized = _FORMAT_ALIASES.get(normalized, normalized)
+    if normalized not in TRANSFORM_FORMATS:
+        raise ParameterError("Unknown image format: {}, should be one of {}".format(
+            image_format,
+            "/".join(TRANSFORM_FORMATS)
+        ))
+    return normalized
+
+
+def get_format_label(image_format: Optional[str]) -> str:
+    """
+    Label of image format for metrics
+    """
+    if image_format is None:
+        return "original"
+    image_format = image_format.lower()
+    return image_format if image_format in _FORMAT_LABELS else "other"
+
+
+def get_transform_type(rescale: float, h: int, w: int, image_format: str) -> str:
+    """
+    Label of transform type for metrics
+    """
+    if rescale is not None:
+        return "rescale"
+    elif h is not None or w is not None:
+        return "resize"
+    elif image_format is not None:
+        return "format"
+    else:
+        return "none"
+
+
+@contextmanager
+def admit(request_class: str):
+    """
+    Run in the concurrency limit of the request class, raise OverloadError if waited too long
+    """
+    start_time = time.perf_counter()
+    try:
+        with admission.admit(request_class):
+            admission_wait.labels(request_class).observe(time.perf_counter() - start_time)
+            yield
+    except OverloadError as ex:
+        if ex.request_class == request_class:
+            admission_reject_count.labels(request_class).inc()
+        raise
+
+
+def get_error_status(exc: Exception) -> int:
+    """
+    HTTP status code of the exception
+    """
+    if isinstance(exc, HTTPError) and exc.response is not None:
+        return exc.response.status_code
+    elif isinstance(exc, ParameterError):
+        return 422
+    elif isinstance(exc, ImageLimitError):
+        return 413
+    elif isinstance(exc, (OverloadError, LockError)):
+        return 503
+    elif isinstance(exc, (KeyError, FileNotFoundError)):
+        return 404
+    return 500
+
+
+def get_param_key(image_format: str, w: int, h: int, rescale: float) -> str:
+    """
+    Cache key of the transform parameters
+    """
+    return "({},{},{},{})".format(
+        image_format,
+        w if w else "-",
+        h if h else "-",
+        "{:.3f}".format(rescale) if rescale else "-"
+    )
+
+
+def get_etag(fid: str, param_key: str) -> str:
+    # fid + param_key decides the content, so it can be used as a strong ETag
+    return "\"{}\"".format(hashlib.sha1("{}_{}".format(fid, param_key).encode()).hexdigest())
+
+
+def check_transform_params(rescale: float, h: int, w: int):
+    if rescale is not None and (rescale > 1.0 or rescale <= 0):
+        raise ParameterError("Invalid value rescale={}".format(rescale))
+
+    if (w is None) != (h is None):
+        raise ParameterError("Parameter w and h should appeared at same time!")
+
+    if rescale is not None and w is not None:
+        raise ParameterError("Parameter rescale/(w&h) are mutually exclusive.")
+
+
+def get_cached_image(
+        fid: str,
+        rescale: float,
+        h: int,
+        w: int,
+        image_format: str
+) -> Tuple[ImageResponse, str]:
+    """
+    Get image from cache, or create it and put into cache
+    :param image_format: lower case format, None means the original format
+    :return: image, and cache result: hit/miss
+    """
+    param_key = get_param_key(image_format, w, h, rescale)
+    format_label = get_format_label(image_format)
+    transform_label = get_transform_type(rescale, h, w, image_format)
+    try:
+        with admit("hit"), stage_latency.labels("cache_get", format_label, transform_label).time():
+            image_response = cache.resource.get(fid, key=param_key)
+        cache_result = "hit"
+        cache_count.labels(cache_result, format_label, transform_label).inc()
+        log.info("Hit cache on KEY {}_{}".format(fid, param_key))
+    except KeyError:
+        cache_result = "miss"
+        cache_count.labels(cache_result, format_label, transform_label).inc()
+        with admit("transform"):
+            with stage_latency.labels("get_image", format_label, transform_label).time():
+                image_response = get_image(
+                    fid,
+                    rescale,
+                    h,
+                    w,
+                    image_format
+                )
+            log.info("Create cache on KEY {}_{}".format(fid, param_key))
+            with stage_latency.labels("cache_put", format_label, transform_label).time():
+                cache.resource.put(fid, param_key, image_response)
+    image_bytes.labels("response", format_label, transform_label).observe(len(image_response.content))
+    return image_response, cache_result
+
+
+def create_batch_items(fids: List[str], hashes: List[str], param_key: str) -> List[BatchImageItem]:
+    """
+    Items of batch retrieval, one image of each hash, items of unknown hashes are marked as 404
+    """
+    items = [BatchImageItem(index=i, fid=fid) for i, fid in enumerate(fids)]
+    if len(hashes) > 0:
+        hash_fids = {}
+        for info in metadb.resource.list_images_by_hashes(hashes):
+            hash_fids.setdefault(info["image_hash"], info["fid"])
+        for image_hash in hashes:
+            item = BatchImageItem(index=len(items), image_hash=image_hash)
+            if image_hash in hash_fids:
+                item.fid = hash_fids[image_hash]
+            else:
+                item.status = 404
+                item.message = "Can't find image by hash: {}".format(image_hash)
+            items.append(item)
+    for item in items:
+        if item.fid:
+            item.etag = get_etag(item.fid, param_key)
+    return items
+
+
+def get_batch_images(
+        items: List[BatchImageItem],
+        param_key: str,
+        rescale: float,
+        h: int,
+        w: int,
+        image_format: str
+) -> Iterator[BatchImageItem]:
+    """
+    Fill the images of items, the cached images are read before returning,
+    so OverloadError is raised here rather than after the response is started
+    :return: iterator of the items, cached items at first and the others once they are created
+    """
+    format_label = get_format_label(image_format)
+    transform_label = get_transform_type(rescale, h, w, image_format)
+    pending = [item for item in items if item.fid and item.status == 0]
+    ready = [item for item in items if item.status != 0]
+
+    with admit("hit"), stage_latency.labels("batch_cache_get", format_label, transform_label).time():
+        cached = cache.resource.get_many([(item.fid, param_key) for item in pending])
+    misses = []
+    for item, image_response in zip(pending, cached):
+        if image_response is None:
+            misses.append(item)
+            continue
+        cache_count.labels("hit", format_label, transform_label).inc()
+        item.status = 200
+        item.cache = "HIT"
+        item.image.CopyFrom(image_response)
+        ready.append(item)
+    return _iter_batch_images(ready, misses, param_key, rescale, h, w, image_format)
+
+
+def _iter_batch_images(
+        ready: List[BatchImageItem],
+        misses: List[BatchImageItem],
+        param_key: str,
+        rescale: float,
+        h: int,
+        w: int,
+        image_format: str
+) -> Iterator[BatchImageItem]:
+    format_label = get_format_label(image_format)
+    transform_label = get_transform_type(rescale, h, w, image_format)
+    yield from ready
+
+    created = []
+    futures = {
+        batch_executor.resource.submit(_get_admitted_image, item.fid, rescale, h, w, image_format): item
+        for item in misses
+    }
+    try:
+        for future in as_completed(futures):
+            item = futures[future]
+            cache_count.labels("miss", format_label, transform_label).inc()
+            item.cache = "MISS"
+            try:
+                image_response = future.result()
+            except Exception as ex:
+                item.status = get_error_status(ex)
+                item.message = str(ex)
+                log.warning("Failed to get image {} in batch: {}".format(item.fid, ex))
+            else:
+                item.status = 200
+                item.image.CopyFrom(image_response)
+                created.append((item.fid, param_key, image_response))
+            yield item
+    finally:
+        # The client may disconnect before all items are sent
+        for future in futures.keys():
+            future.cancel()
+        if len(created) > 0:
+            with stage_latency.labels("batch_cache_put", format_label, transform_label).time():
+                cache.resource.put_many(created)
+
+
+def _get_admitted_image(fid: str, rescale: float, h: int, w: int, image_format: str) -> ImageResponse:
+    with admit("transform"):
+        return get_image(fid, rescale, h, w, image_format)
+
+
+def get_image(
+        fid: str,
+        rescale: float,
+        h: int,
+        w: int,
+        image_format: str
+) -> ImageResponse:
+    """
+    Image resource
+    - **filename**:
+    - **image_hash**:
+    - **rescale**:  Zoom image before response
+    - **h**:  Height limit
+    - **w**:  Width limit
+    - **image_format**:  The image format to return, none means using original format
+    """
+    request_count.labels("__get_image").inc()
+
+    # Parameter verify
+    check_transform_params(rescale, h, w)
+
+    format_label = get_format_label(image_format)
+    transform_label = get_transform_type(rescale, h, w, image_format)
+
+    with stage_latency.labels("download", format_label, transform_label).time():
+        data = filesystem.resource.read(fid)
+    image_bytes.labels("download", format_label, transform_label).observe(len(data))
+
+    with BytesIO(data) as bio:
+        with stage_latency.labels("probe", format_label, transform_label).time():
+            im = Image.open(bio)
+
+        if image_format is None:
+            image_final_format = im.format.lower()
+        else:
+            image_final_format = image_format.lower()
+        media_type = "image/{}".format(image_final_format)
+        need_transform = not (image_format is None or (image_format.upper() == im.format))
+
+        need_rescale = rescale is not None
+        need_resize = h is not None and w is not None
+
+        if not need_transform and not need_rescale and not need_resize:
+            return create_image_response(data, media_type)
+
+        target_size = get_target_size(im.size, rescale, w, h)
+        is_animated = getattr(im, "is_animated", False)
+        # Animated image is decoded frame by frame in full size
+        reduce_factor = 1 if is_animated else get_reduce_factor(im.size, target_size)
+        check_image_limits(im, image_max_pixels, image_max_decode_bytes, reduce_factor)
+        if is_animated:
+            # Decode, resize and encode frame by frame
+            n_frames = im.n_frames if image_final_format.upper() in ANIMATED_FORMATS else 1
+            pixels = target_size[0] * target_size[1] * n_frames
+            profile = transform_encoder_profiles.select(image_final_format, pixels)
+            with stage_latency.labels("animation", format_label, transform_label).time(), \
+                    transform_encoder_profiles.encoding(profile, pixels):
+                data = transform_animated(
+                    im,
+                    target_size,
+                    image_final_format,
+                    max_frames=animation_max_frames,
+                    max_pixels=animation_max_pixels,
+                    **profile.options
+                )
+            return create_image_response(data, media_type)
+
+        engine = transform_engines.resource.select(im.format, image_final_format)
+        with stage_latency.labels("decode", format_label, transform_label).time():
+            bitmap = engine.decode(data, reduce_factor)
+
+        # Apply resize stage by parameters
+        with stage_latency.labels("resize", format_label, transform_label).time():
+            if target_size != engine.get_size(bitmap):
+                bitmap = engine.resize(bitmap, target_size)
+        pixels = target_size[0] * target_size[1]
+        profile = transform_encoder_profiles.select(image_final_format, pixels)
+        with stage_latency.labels("encode", format_label, transform_label).time(), \
+                transform_encoder_profiles.encoding(profile, pixels):
+            data = engine.encode(bitmap, image_final_format, **profile.options)
+        return create_image_response(data, media_type)
+
+
+def delete_hashes(image_hashes: List[str]) -> Tuple[List[str], Dict[str, str]]:
+    return delete_fids([i["fid"] for i in metadb.resource.list_images_by_hashes(image_hashes)])
+
+
+def delete_fids(fids: List[str]) -> Tuple[List[str], Dict[str, str]]:
+    """
+    Remove files, cached items and meta of the images in batch
+    :param fids: File IDs
+    :return: removed fids (including the files already missing), fid -> error message of failed fids
+    """
+    fids = list(dict.fromkeys(fids))
+    if len(fids) == 0:
+        return [], {}
+    with stage_latency.labels("delete", "any", "delete").time():
+        errors = filesystem.resource.delete_many(fids)
+    failed = {
+        fid: str(ex)
+        for fid, ex in errors.items()
+        if not isinstance(ex, KeyError)
+    }
+    for fid, message in failed.items():
+        log.warning("Failed to remove file {}: {}".format(fid, message))
+    removed = [fid for fid in fids if fid not in failed]
+    cache.resource.clean_many(fids)
+    metadb.resource.remove_images(removed)
+    return removed, failed
+
+
+def find_similar_hashes(image_hash: str, max_distance: int, limit: int) -> List[dict]:
+    """
+    Find the hashes of similar images (Hamming distance of average hash)
+    :param image_hash: hash to query, the hash itself is included if it exists
+    :param max_distance: max Hamming distance
+    :param limit: max hashes to return
+    :return: list of {"hash", "distance", "fids"}, the nearest first
+    """
+    try:
+        int(image_hash, 16)
+    except ValueError:
+        raise ParameterError("Invalid image hash: {}".format(image_hash))
+    if max_distance < 0 or max_distance > similar_max_distance:
+        raise ParameterError("max_distance should in 0~{}".format(similar_max_distance))
+    index = similar_index.resource
+    if time.time() - index.build_time > similar_index_ttl and _similar_index_rebuilding.acquire(blocking=False):
+        # Only one thread rebuilds the index, the others keep using the old one
+        try:
+            index = _create_similar_index()
+            similar_index.set_resource(index)
+        finally:
+            _similar_index_rebuilding.release()
+    with stage_latency.labels("similar_search", "any", "similar").time():
+        matched = index.search(image_hash, max_distance, limit)
+    # The index may have the hashes already removed
+    hash_fids = {}
+    for info in metadb.resource.list_images_by_hashes([h for h, _ in matched]):
+        hash_fids.setdefault(info["image_hash"], []).append(info["fid"])
+    return [
+        {"hash": h, "distance": distance, "fids": hash_fids[h]}
+        for h, distance in matched
+        if h in hash_fids
+    ]
+
+
+def commit_image_file(
+        fp: BinaryIO,
+        mode: str,
+        auto_remove: bool,
+        image_format: str,
+        # WebP options
+        method: int,
+        lossless: bool,
+        quality: int,
+        attach_info: str
+):
+    """
+    Commit single file to weed FS filer
+    The image is read from fp (like the spooled file of the upload) and, if it's not converted,
+    sent to the filesystem from fp as well, so the content is never copied into memory as a whole
+
+    :param fp: seekable file of the image
+    :param mode:
+    :param auto_remove:
+    :param image_format:
+    :param method:
+    :param lossless:
+    :param quality:
+    :param attach_info:
+    :return:
+    """
+    request_count.labels("__commit_image_file").inc()
+    if mode not in {"keep", "block", "largest"}:
+        raise ParameterError("mode should in keep/block/largest.")
+
+    try:
+        attach_obj = json.loads(attach_info)
+    except Exception as ex:
+        log.warning("Error while parsing attach info as JSON caused by: {}".format(str(ex)))
+        attach_obj = {}
+    if image_format.lower() != "original":
+        image_format = check_image_format(image_format)
+    format_label = get_format_label(image_format)
+    upload_size = fp.seek(0, os.SEEK_END)
+    fp.seek(0)
+    image_bytes.labels("upload", format_label, "upload").observe(upload_size)
+    if upload_size > upload_max_bytes:
+        raise ImageLimitError("Image file is larger than {} bytes".format(upload_max_bytes))
+    # File to save, replaced by the converted image
+    output = fp
+    try:
+        # Only the header is parsed, nothing is decoded before checking the limits
+        im = Image.open(fp)
+    except UnidentifiedImageError:
+        raise ParameterError("Can't identify the image format")
+    check_image_limits(im, image_max_pixels, image_max_decode_bytes)
+    width = im.width
+    height = im.height
+    im_format = im.format
+    attach_obj["mode"] = im.mode
+    attach_obj["tick"] = int(time.time() * 1000)
+    attach_obj["w"] = width
+    attach_obj["h"] = height
+    image_format = image_format.upper()
+    # That means don't need convert
+    image_format_matched = image_format.lower() == "original" or im.format == image_format
+    with stage_latency.labels("hash", format_label, "upload").time():
+        image_hash = get_hash(im)
+    is_animated = getattr(im, "is_animated", False)
+    attach_obj["is_animated"] = is_animated
+    if not image_format_matched and not (is_animated and image_format not in ANIMATED_FORMATS):
+        pixels = width * height * (getattr(im, "n_frames", 1) if is_animated else 1)
+        if method is not None and image_format == "WEBP":
+            profile = EncoderProfile("manual", {"method": method}, None)
+        else:
+            profile = upload_encoder_profiles.select(image_format, pixels)
+        save_options = dict(profile.options)
+        if image_format == "WEBP":
+            save_options.update(lossless=lossless, quality=quality)
+        if is_animated:
+            try:
+                with stage_latency.labels("animation", format_label, "upload").time(), \
+                        upload_encoder_profiles.encoding(profile, pixels):
+                    output = BytesIO(transform_animated(
+                        im,
+                        None,
+                        image_format,
+                        max_frames=animation_max_frames,
+                        max_pixels=animation_max_pixels,
+                        **save_options
+                    ))
+                im_format = image_format
+                attach_obj["encoder_profile"] = profile.name
+            except ImageLimitError as ex:
+                log.warning("Keep animated image in {} caused by: {}".format(im.format, str(ex)))
+        else:
+            # Encoded into memory and uploaded from the buffer (no getvalue() copy)
+            output = BytesIO()
+            with stage_latency.labels("encode", format_label, "upload").time(), \
+                    upload_encoder_profiles.encoding(profile, pixels):
+                im_format = image_format
+                im_save = im.convert("RGB") if image_format == "JPEG" and im.mode != "RGB" else im
+                im_save.save(output, format=image_format, **save_options)
+            attach_obj["encoder_profile"] = profile.name
+    elif not image_format_matched:
+        # Won't convert animated image to a still image format, or the frames will be lost
+        log.warning("Can't convert animated image format from {} -> {}".format(
+            im.format,
+            image_format
+        ))
+    # Get image hash by hash function
+    attach_obj["format"] = im_format
+    content_size = output.seek(0, os.SEEK_END)
+    lazy_existed_file_info = LazyResource(lambda: metadb.resource.list_images(image_hash))
+    # Lock the hash in redis
+    lock_start = time.time()
+    with RedisDistributedLock(lock_manager.resource, image_hash) as _:
+        stage_latency.labels("lock", format_label, "upload").observe(time.time() - lock_start)
+        if mode == "keep":
+            need_to_write = True
+        else:
+            with stage_latency.labels("meta_query", format_label, "upload").time():
+                existed_count = len(lazy_existed_file_info.resource)
+            if existed_count <= 0:
+                need_to_write = True
+            else:
+                if mode == "block":
+                    need_to_write = False
+                elif mode == "largest":
+                    max_image_size = max(
+                        int(info["w"]) * int(info["h"])
+                        for info in lazy_existed_file_info.resource
+                        if "w" in info and "h" in info
+                    )
+                    need_to_write = (width * height) > max_image_size
+                else:
+                    raise Exception("Unknown mode: {}".format(mode))
+        if need_to_write:
+            # File name parts:
+            # <image hash>/<hostname>_<micro sec tick(%x)>_<random str>.img
+            removed = []
+            if auto_remove:
+                removed, _ = delete_hashes([image_hash])
+            with stage_latency.labels("upload", format_label, "upload").time():
+                output.seek(0)
+                fid = filesystem.resource.upload(output)
+            attach_obj["content_size"] = content_size
+            image_bytes.labels("stored", format_label, "upload").observe(content_size)
+            with stage_latency.labels("meta_write", format_label, "upload").time():
+                metadb.resource.add_image(
+                    image_hash=image_hash,
+                    fid=fid,
+                    **attach_obj
+                )
+            if similar_index.created:
+                similar_index.resource.add(image_hash)
+            return {
+                "status": "success",
+                "wrote": True,
+                "fid": fid,
+                "removed": removed,
+                "hash": image_hash,
+                "attach": attach_obj
+            }
+        else:
+            return {
+                "status": "success",
+                "wrote": False,
+                "hash": image_hash,
+            }
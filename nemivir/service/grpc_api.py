@@ -0,0 +1,172 @@
+"""
+gRPC API of the image service (see protos/image_service.proto), the same core logic as the HTTP API
+Run it alone:
+$ python -m nemivir.service.grpc_api
+Or set GRPC_PORT to run it in every gunicorn worker together with the HTTP API (see gunicorn_conf.py)
+"""
+import json
+import logging
+import traceback
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+import grpc
+
+from nemivir.config import metadb, batch_max_items, grpc_port, grpc_workers, grpc_max_message_bytes, \
+    grpc_upload_window
+from nemivir.protos import UploadRequest, UploadResult, DeleteResult, SimilarHash, SimilarResult
+from nemivir.protos.image_service_pb2_grpc import ImageServiceServicer, add_ImageServiceServicer_to_server
+from nemivir.service.core import request_count, fail_count, ParameterError, admit, get_error_status, \
+    get_param_key, check_transform_params, create_batch_items, get_batch_images, delete_fids, find_similar_hashes, \
+    commit_image_file, check_image_format
+from nemivir.util import LazyResource, OverloadError
+
+log = logging.getLogger(__file__)
+
+_status_codes = {
+    404: grpc.StatusCode.NOT_FOUND,
+    413: grpc.StatusCode.RESOURCE_EXHAUSTED,
+    422: grpc.StatusCode.INVALID_ARGUMENT,
+    503: grpc.StatusCode.UNAVAILABLE,
+}
+
+# Uploads of all streams are processed here, the concurrency is limited by admission control
+upload_executor = LazyResource(lambda: ThreadPoolExecutor(max_workers=grpc_workers, thread_name_prefix="grpc_upload"))
+
+
+def _abort(context: grpc.ServicerContext, exc: Exception):
+    """
+    Fail the RPC with the status code mapped from the exception
+    """
+    status = get_error_status(exc)
+    fail_count.labels(status, str(type(exc))).inc()
+    if isinstance(exc, OverloadError):
+        context.set_trailing_metadata((("retry-after", str(exc.retry_after)),))
+    elif status >= 500:
+        log.error("Some internal error caused: {}".format(traceback.format_exc()))
+    context.abort(_status_codes.get(status, grpc.StatusCode.INTERNAL), str(exc))
+
+
+def _upload(request: UploadRequest) -> UploadResult:
+    result = UploadResult(request_id=request.request_id)
+    try:
+        with admit("upload"):
+            response = commit_image_file(
+                BytesIO(request.content),
+                request.mode or "keep",
+                request.auto_remove,
+                request.image_format or "original",
+                request.method if request.HasField("method") else None,
+                request.lossless,
+                request.quality if request.HasField("quality") else 80,
+                request.attach_info or "{}"
+            )
+    except Exception as ex:
+        result.status = get_error_status(ex)
+        result.message = str(ex)
+        fail_count.labels(result.status, str(type(ex))).inc()
+        log.warning("Failed to upload image {} by gRPC: {}".format(request.request_id, ex))
+        return result
+    result.status = 200
+    result.wrote = response["wrote"]
+    result.image_hash = response["hash"]
+    if response["wrote"]:
+        result.fid = response["fid"]
+        result.removed.extend(response["removed"])
+        result.attach = json.dumps(response["attach"])
+    return result
+
+
+class ImageService(ImageServiceServicer):
+    def Upload(self, request_iterator, context):
+        """
+        Upload images of the stream concurrently (at most GRPC_UPLOAD_WINDOW of a stream at the same time),
+        a failed image doesn't stop the stream, see the status of the result
+        """
+        request_count.labels("grpc_upload").inc()
+        pending = deque()
+        try:
+            for request in request_iterator:
+                pending.append(upload_executor.resource.submit(_upload, request))
+                while len(pending) >= grpc_upload_window:
+                    yield pending.popleft().result()
+            while len(pending) > 0:
+                yield pending.popleft().result()
+        finally:
+            # The client may cancel the stream
+            for future in pending:
+                future.cancel()
+
+    def BatchGet(self, request, context):
+        request_count.labels("grpc_batch_get").inc()
+        try:
+            count = len(request.fids) + len(request.hashes)
+            if count > batch_max_items:
+                raise ParameterError("Too many images in batch: {} > {}".format(count, batch_max_items))
+            rescale = request.rescale if request.HasField("rescale") else None
+            h = request.h if request.HasField("h") else None
+            w = request.w if request.HasField("w") else None
+            check_transform_params(rescale, h, w)
+            image_format = check_image_format(request.image_format or None)
+            param_key = get_param_key(image_format, w, h, rescale)
+            items = create_batch_items(list(request.fids), list(request.hashes), param_key)
+            # Cache is read (and admitted) before the first item, so overload fails the call with UNAVAILABLE
+            images = get_batch_images(items, param_key, rescale, h, w, image_format)
+        except Exception as ex:
+            _abort(context, ex)
+        yield from images
+
+    def Delete(self, request, context):
+        request_count.labels("grpc_delete").inc()
+        try:
+            fids = list(request.fids)
+            if len(request.hashes) > 0:
+                fids.extend(i["fid"] for i in metadb.resource.list_images_by_hashes(list(request.hashes)))
+            removed, failed = delete_fids(fids)
+        except Exception as ex:
+            _abort(context, ex)
+        return DeleteResult(removed=removed, failed=failed)
+
+    def FindSimilar(self, request, context):
+        request_count.labels("grpc_find_similar").inc()
+        try:
+            with admit("listing"):
+                similar = find_similar_hashes(request.image_hash, request.max_distance, request.limit or 100)
+        except Exception as ex:
+            _abort(context, ex)
+        return SimilarResult(similar=[
+            SimilarHash(image_hash=s["hash"], distance=s["distance"], fids=s["fids"])
+            for s in similar
+        ])
+
+
+def create_server(max_workers: int = grpc_workers) -> grpc.Server:
+    """
+    Create the server without any port, add the port by server.add_insecure_port
+    :param max_workers: max RPCs processing at the same time
+    """
+    server = grpc.server(
+        ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="grpc"),
+        options=[
+            ("grpc.max_send_message_length", grpc_max_message_bytes),
+            ("grpc.max_receive_message_length", grpc_max_message_bytes),
+            # Gunicorn workers listen on the same port
+            ("grpc.so_reuseport", 1),
+        ]
+    )
+    add_ImageServiceServicer_to_server(ImageService(), server)
+    return server
+
+
+def serve(port: int = grpc_port, max_workers: int = grpc_workers) -> grpc.Server:
+    server = create_server(max_workers)
+    server.add_insecure_port("[::]:{}".format(port))
+    server.start()
+    log.info("gRPC server is listening on port {}".format(port))
+    return server
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    serve(grpc_port if grpc_port > 0 else 50051).wait_for_termination()
@@ -1,24 +1,27 @@
 import gc
-import json
 import logging
-import socket
-import time
+import os
 import traceback
-from io import BytesIO
-from typing import List
+from email.utils import formatdate, parsedate_to_datetime
+from typing import List, Iterator
 
-from PIL import Image
-from fastapi import FastAPI, File, UploadFile
-from prometheus_client import CollectorRegistry, multiprocess, generate_latest, Counter
-from redlock import Redlock
+import anyio.to_thread
+from fastapi import FastAPI, File, UploadFile, Header
+from pydantic import BaseModel
+from prometheus_client import CollectorRegistry, multiprocess, generate_latest, CONTENT_TYPE_LATEST
 from requests import HTTPError, Response
 from starlette.requests import Request
-from starlette.responses import JSONResponse, RedirectResponse, Response
-
-from nemivir.config import filesystem, redis_connection_pool, cache, metadb
-from nemivir.image import get_hash
-from nemivir.protos import ImageResponse, create_image_response
-from nemivir.util import RedisDistributedLock, LazyResource
+from starlette.responses import JSONResponse, RedirectResponse, Response, PlainTextResponse, StreamingResponse
+
+from nemivir.config import filesystem, cache, metadb, lock_manager, profile_sample_rate, batch_max_items, \
+    admission, upload_max_bytes
+from nemivir.image import ImageLimitError
+from nemivir.protos import BatchImageItem, pack_batch_item
+from nemivir.service.core import request_count, fail_count, ParameterError, admit, get_param_key, get_etag, \
+    check_transform_params, get_cached_image, create_batch_items, get_batch_images, delete_fids, delete_hashes, \
+    find_similar_hashes, commit_image_file, check_image_format
+from nemivir.util import MemoryTracer, format_collapsed_stacks, sample_stacks, get_random_string, \
+    OverloadError, LockError, RequestSizeLimit, ping_lock_manager, ProfileMiddleware
 
 app = FastAPI(
     title="Nemivir Image Database",
@@ -27,22 +30,22 @@ app = FastAPI(
                 "<a href=\"https://github.com/TsingJyujing/nemivir\">Source Code</a>"
 )
 
-log = logging.getLogger(__file__)
+# Uploads are spooled to temporary files by starlette while parsing the form,
+# reject the oversized ones before that
+app.add_middleware(RequestSizeLimit, max_bytes=upload_max_bytes, paths=["/upload", "/batch_upload"])
+app.add_middleware(ProfileMiddleware, sample_rate=profile_sample_rate)
 
-request_count = Counter(
-    "api_request_count",
-    "Request Count of API",
-    labelnames=("api_name",)
-)
+log = logging.getLogger(__file__)
 
-fail_count = Counter(
-    "api_fail_count",
-    "Fail Count of API",
-    labelnames=("status_code", "exception_type")
-)
+memory_tracer = MemoryTracer()
 
 
-class ParameterError(Exception): pass
+@app.on_event("startup")
+def set_threadpool_size():
+    # Requests waiting in admission queues hold the threads of sync endpoints,
+    # make sure the queues can't exhaust the threadpool, so unlimited requests (health check...) can still run
+    limiter = anyio.to_thread.current_default_thread_limiter()
+    limiter.total_tokens = max(limiter.total_tokens, admission.capacity + 16)
 
 
 @app.get("/")
@@ -58,8 +61,37 @@ def read_root():
 @app.get("/health")
 def health():
     """
-    Health check interface
+    Health check interface (liveness), won't touch any backend
+    """
+    return {"status": "success"}
+
+
+@app.get("/ready")
+def ready():
+    """
+    Readiness check interface, check all backends are available
     """
+    checks = {
+        "filesystem": lambda: filesystem.resource.ping(),
+        "metadb": lambda: metadb.resource.ping(),
+        "cache": lambda: cache.resource.ping(),
+        # Uploads and deletes can't run without locks
+        "lock": lambda: ping_lock_manager(lock_manager.resource),
+    }
+    errors = {}
+    for name, check in checks.items():
+        try:
+            check()
+        except Exception as ex:
+            errors[name] = str(ex)
+    if len(errors) > 0:
+        return JSONResponse(
+            status_code=503,
+            content={
+                "status": "fail",
+                "errors": errors,
+            }
+        )
     return {"status": "success"}
 
 
@@ -74,6 +106,70 @@ def system_gc(generation: int = 2):
     return {"status": "success"}
 
 
+@app.get("/system/profile")
+def system_profile(seconds: float = 5.0, interval: float = 0.005, top: int = None):
+    """
+    Sample stacks of all threads in this worker, return stacks in collapsed format (flamegraph.pl/speedscope)
+    - **seconds**: sampling duration, 0~60
+    - **interval**: sampling interval in seconds
+    - **top**: only return the top N stacks
+    """
+    if seconds <= 0 or seconds > 60:
+        raise ParameterError("Invalid value seconds={}".format(seconds))
+    if interval <= 0:
+        raise ParameterError("Invalid value interval={}".format(interval))
+    return PlainTextResponse(format_collapsed_stacks(sample_stacks(seconds, interval), top=top))
+
+
+@app.post("/system/tracemalloc/start")
+def system_tracemalloc_start(frame_count: int = 1):
+    """
+    Start tracing memory allocations in this worker
+    - **frame_count**: frames to store in a traceback
+    """
+    memory_tracer.start(frame_count)
+    return {"status": "success"}
+
+
+@app.post("/system/tracemalloc/stop")
+def system_tracemalloc_stop():
+    """
+    Stop tracing memory allocations and drop the snapshot
+    """
+    memory_tracer.stop()
+    return {"status": "success"}
+
+
+@app.get("/system/tracemalloc/snapshot")
+def system_tracemalloc_snapshot(top: int = 20, key_type: str = "lineno"):
+    """
+    Take a snapshot of memory allocations, the difference compared with last snapshot will be returned too
+    - **top**: return top N allocations
+    - **key_type**: group allocations by lineno/filename/traceback
+    """
+    if not memory_tracer.is_tracing():
+        raise ParameterError("tracemalloc is not started, start it by /system/tracemalloc/start")
+    if key_type not in {"lineno", "filename", "traceback"}:
+        raise ParameterError("key_type should in lineno/filename/traceback.")
+    return {
+        "status": "success",
+        "pid": os.getpid(),
+        **memory_tracer.snapshot(top, key_type)
+    }
+
+
+@app.get("/system/admission")
+def system_admission():
+    """
+    Running and waiting requests of each class in admission control (of this worker)
+    """
+    return {
+        "status": "success",
+        "pid": os.getpid(),
+        "classes": admission.get_stats(),
+    }
+
+
 @app.get("/metrics")
 def metrics():
     """
@@ -82,7 +178,7 @@ def metrics():
     request_count.labels("metrics").inc()
     registry = CollectorRegistry()
     multiprocess.MultiProcessCollector(registry)
-    return generate_latest(registry)
+    return Response(content=generate_latest(registry), media_type=CONTENT_TYPE_LATEST)
 
 
 @app.exception_handler(HTTPError)
@@ -114,6 +210,55 @@ async def requests_http_error_handler(request: Request, exc: ParameterError):
     )
 
 
+@app.exception_handler(ImageLimitError)
+async def requests_http_error_handler(request: Request, exc: ImageLimitError):
+    fail_count.labels(413, str(type(exc))).inc()
+    return JSONResponse(
+        status_code=413,
+        content={
+            "status": "fail",
+            "message": str(exc),
+        }
+    )
+
+
+@app.exception_handler(FileNotFoundError)
+async def requests_http_error_handler(request: Request, exc: FileNotFoundError):
+    fail_count.labels(404, str(type(exc))).inc()
+    return JSONResponse(
+        status_code=404,
+        content={
+            "status": "fail",
+            "message": str(exc),
+        }
+    )
+
+
+@app.exception_handler(OverloadError)
+async def requests_http_error_handler(request: Request, exc: OverloadError):
+    fail_count.labels(503, str(type(exc))).inc()
+    return JSONResponse(
+        status_code=503,
+        content={
+            "status": "fail",
+            "message": str(exc),
+        },
+        headers={"Retry-After": str(exc.retry_after)}
+    )
+
+
+@app.exception_handler(LockError)
+async def requests_http_error_handler(request: Request, exc: LockError):
+    fail_count.labels(503, str(type(exc))).inc()
+    return JSONResponse(
+        status_code=503,
+        content={
+            "status": "fail",
+            "message": str(exc),
+        }
+    )
+
+
 @app.exception_handler(Exception)
 async def requests_http_error_handler(request: Request, exc: Exception):
     fail_count.labels(500, str(type(exc))).inc()
@@ -136,10 +281,11 @@ def list_hashes(limit: int = -1):
     - **limit**: Limit the number of the return
     """
     request_count.labels("list_hashes").inc()
-    return {
-        "status": "success",
-        "hashes": metadb.list_hashes(limit)
-    }
+    with admit("listing"):
+        return {
+            "status": "success",
+            "hashes": metadb.resource.list_hashes(limit)
+        }
 
 
 @app.get("/list/image/{image_hash}")
@@ -150,7 +296,24 @@ def list_images(image_hash: str, limit: int = 1000):
     - **limit**: Limit the number of the return
     """
     request_count.labels("list_images").inc()
-    return metadb.list_images(image_hash, limit)
+    with admit("listing"):
+        return metadb.resource.list_images(image_hash, limit)
+
+
+@app.get("/similar/{image_hash}")
+def find_similar_images(image_hash: str, max_distance: int = 5, limit: int = 100):
+    """
+    Find the hashes of similar images, hashes are compared by Hamming distance
+    - **image_hash**: Image hash
+    - **max_distance**: max different bits of the hash, up to `SIMILAR_MAX_DISTANCE`, less than 8 is searched by index
+    - **limit**: Limit the number of the return
+    """
+    request_count.labels("find_similar_images").inc()
+    with admit("listing"):
+        return {
+            "status": "success",
+            "similar": find_similar_hashes(image_hash, max_distance, limit)
+        }
 
 
 @app.get("/image/{fid}")
@@ -159,7 +322,9 @@ def get_specified_image(
         rescale: float = None,
         h: int = None,
         w: int = None,
-        image_format: str = None
+        image_format: str = None,
+        if_none_match: str = Header(None),
+        accept: str = Header(None)
 ):
     """
     Get a image name by specified filename
@@ -167,13 +332,18 @@ def get_specified_image(
     - **rescale**:  resize image by ratio (0.0~1.0) before response, don't input means don't apply change
     - **h**:  resize image by height and width
     - **w**:  resize image by height and width
-    - **image_format**:  the image format to return, WEBP/PNG/JPG/...
+    - **image_format**:  the image format to return, WEBP/PNG/JPG/..., `auto` means choosing by Accept header
+
+    The image of a fid never changes, so the response can be cached forever (by ETag)
     """
     request_count.labels("get_specified_image").inc()
     return __get_image_cache(
         fid=fid,
         rescale=rescale, h=h, w=w,
         image_format=image_format,
+        if_none_match=if_none_match,
+        accept=accept,
+        immutable=True,
     )
 
 
@@ -183,7 +353,10 @@ def get_one_image_by_hash(
         rescale: float = None,
         h: int = None,
         w: int = None,
-        image_format: str = None
+        image_format: str = None,
+        if_none_match: str = Header(None),
+        if_modified_since: str = Header(None),
+        accept: str = Header(None)
 ):
     """
     Get a image by hash
@@ -191,20 +364,104 @@ def get_one_image_by_hash(
     - **rescale**:  resize image by ratio (0.0~1.0) before response, don't input means don't apply change
     - **h**:  resize image by height and width
     - **w**:  resize image by height and width
-    - **image_format**:  the image format to return, WEBP/PNG/JPG/...
+    - **image_format**:  the image format to return, WEBP/PNG/JPG/..., `auto` means choosing by Accept header
+
+    The image of a hash may be replaced, so the client should revalidate (by ETag) before using the cache
     """
     request_count.labels("get_one_image_by_hash").inc()
-    image_info = metadb.list_images(image_hash, limit=1)
+    image_info = metadb.resource.list_images(image_hash, limit=1)
     if len(image_info) <= 0:
-        raise Exception("Can't find image by hash: {}".format(image_hash))
+        raise FileNotFoundError("Can't find image by hash: {}".format(image_hash))
     fid = image_info[0]["fid"]
     return __get_image_cache(
         fid=fid,
         rescale=rescale, h=h, w=w,
         image_format=image_format,
+        if_none_match=if_none_match,
+        if_modified_since=if_modified_since,
+        accept=accept,
+        immutable=False,
+        last_modified=image_info[0].get("tick"),
+    )
+
+
+class BatchImageRequest(BaseModel):
+    fids: List[str] = []
+    hashes: List[str] = []
+    rescale: float = None
+    h: int = None
+    w: int = None
+    image_format: str = None
+    output: str = "protobuf"
+
+
+@app.post("/batch_image")
+def batch_get_images(
+        request: BatchImageRequest,
+        accept: str = Header(None)
+):
+    """
+    Get images in batch with the same transform parameters, like thumbnails of a gallery page
+    - **fids**: File IDs
+    - **hashes**: Image hashes, one image of each hash
+    - **rescale**, **h**, **w**, **image_format**: the same as `/image/{fid}`
+    - **output**:
+        - `protobuf`: stream of items, each item is 4 bytes length (big endian) + serialized `BatchImageItem`
+          (see protos/image_cache.proto), `iter_batch_items` in nemivir.protos reads it
+        - `multipart`: multipart/mixed, each part has headers `X-Index`, `X-Fid`, `X-Status`, `ETag` and `X-Cache`
+
+    Cached images are read in one round trip and sent first,
+    the others are created concurrently and sent as soon as they are ready.
+    Failure of an image doesn't fail the batch, see the status of the item.
+    """
+    request_count.labels("batch_get_images").inc()
+    count = len(request.fids) + len(request.hashes)
+    if count > batch_max_items:
+        raise ParameterError("Too many images in batch: {} > {}".format(count, batch_max_items))
+    if request.output not in ("protobuf", "multipart"):
+        raise ParameterError("Unknown output: {}".format(request.output))
+    check_transform_params(request.rescale, request.h, request.w)
+    image_format = check_image_format(_negotiate_format(request.image_format, accept))
+    param_key = get_param_key(image_format, request.w, request.h, request.rescale)
+
+    items = create_batch_items(request.fids, request.hashes, param_key)
+    # Cache is read (and admitted) before the response is started, so overload is still 503
+    images = get_batch_images(items, param_key, request.rescale, request.h, request.w, image_format)
+
+    if request.output == "multipart":
+        boundary = get_random_string(32)
+        return StreamingResponse(
+            _iter_multipart(images, boundary),
+            media_type="multipart/mixed; boundary={}".format(boundary),
+            headers={"X-Batch-Count": str(len(items))},
+        )
+    return StreamingResponse(
+        (pack_batch_item(item) for item in images),
+        media_type="application/x-protobuf",
+        headers={"X-Batch-Count": str(len(items))},
     )
 
 
+def _iter_multipart(items: Iterator[BatchImageItem], boundary: str) -> Iterator[bytes]:
+    for item in items:
+        headers = [
+            ("Content-Type", item.image.media_type if item.status == 200 else "text/plain; charset=utf-8"),
+            ("X-Index", item.index),
+            ("X-Fid", item.fid),
+            ("X-Image-Hash", item.image_hash),
+            ("X-Status", item.status),
+            ("ETag", item.etag),
+            ("X-Cache", item.cache),
+        ]
+        head = "--{}\r\n{}\r\n\r\n".format(
+            boundary,
+            "\r\n".join("{}: {}".format(k, v) for k, v in headers if v != "")
+        )
+        content = item.image.content if item.status == 200 else item.message.encode()
+        yield head.encode() + content + b"\r\n"
+    yield "--{}--\r\n".format(boundary).encode()
+
+
 @app.delete("/image/{fid}")
 def delete_specified_image(
         fid: str
@@ -215,9 +472,9 @@ def delete_specified_image(
     - **filename**: file name under the hash
     """
     request_count.labels("delete_specified_image").inc()
-    filesystem.delete(fid)
-    metadb.remove_image(fid)
-    cache.clean(fid)
+    filesystem.resource.delete(fid)
+    metadb.resource.remove_image(fid)
+    cache.resource.clean(fid)
     return {"status": "success"}
 
 
@@ -230,15 +487,78 @@ def delete_images_by_hash(
     - **image_hash**: Image hash
     """
     request_count.labels("delete_images_by_hash").inc()
-    __delete_hash(image_hash)
-    return {"status": "success"}
+    removed, failed = delete_hashes([image_hash])
+    return {
+        "status": "success" if len(failed) == 0 else "fail",
+        "removed": removed,
+        "failed": failed,
+    }
+
+
+class BatchDeleteRequest(BaseModel):
+    hashes: List[str] = []
+    fids: List[str] = []
+
+
+@app.post("/batch_delete")
+def batch_delete_images(
+        request: BatchDeleteRequest
+):
+    """
+    Remove images in batch, files are removed concurrently and won't stop on failure
+    - **hashes**: remove all images under these hashes
+    - **fids**: remove these images
+
+    Images failed to remove are listed in `failed` (fid -> error), their meta is kept to retry
+    """
+    request_count.labels("batch_delete_images").inc()
+    fids = list(request.fids)
+    if len(request.hashes) > 0:
+        fids.extend(i["fid"] for i in metadb.resource.list_images_by_hashes(request.hashes))
+    removed, failed = delete_fids(fids)
+    return {
+        "status": "success" if len(failed) == 0 else "fail",
+        "removed": removed,
+        "failed": failed,
+    }
+
+
+def _negotiate_format(image_format: str, accept: str) -> str:
+    """
+    Resolve image format `auto` by Accept header: WEBP if client supports, or else original format
+    """
+    if image_format is None or image_format.lower() != "auto":
+        return image_format
+    if accept is not None and "image/webp" in accept:
+        return "webp"
+    return None
+
 
+def _etag_matched(etag: str, if_none_match: str) -> bool:
+    """
+    Check If-None-Match header (weak comparison, as RFC 7232 required)
+    """
+    if if_none_match is None:
+        return False
+    return any(
+        tag.strip().replace("W/", "", 1) == etag
+        for tag in if_none_match.split(",")
+    )
 
-def __delete_hash(image_hash: str) -> int:
-    for i in metadb.list_images(image_hash):
-        filesystem.delete(i["fid"])
-        cache.clean(i["fid"])
-    return metadb.remove_hash(image_hash)
+
+def _not_modified_since(last_modified: int, if_modified_since: str) -> bool:
+    """
+    Check If-Modified-Since header
+    :param last_modified: timestamp in milliseconds, None means unknown
+    """
+    if last_modified is None or if_modified_since is None:
+        return False
+    try:
+        since = parsedate_to_datetime(if_modified_since).timestamp()
+    except (TypeError, ValueError):
+        return False
+    # Last-Modified is in seconds
+    return int(last_modified / 1000) <= since
 
 
 def __get_image_cache(
@@ -246,112 +566,62 @@ def __get_image_cache(
         rescale: float,
         h: int,
         w: int,
-        image_format: str
+        image_format: str,
+        if_none_match: str = None,
+        accept: str = None,
+        immutable: bool = False,
+        last_modified: int = None,
+        if_modified_since: str = None
 ):
+    """
+    Get image from cache, or create it and put into cache
+    :param if_none_match: If-None-Match header, return 304 without reading the image if ETag matched,
+        `*` matches only if the image exists
+    :param if_modified_since: If-Modified-Since header, only used without If-None-Match (RFC 7232)
+    :param accept: Accept header, to resolve image format `auto`
+    :param immutable: the response can be cached forever, False means client should revalidate every time
+    :param last_modified: timestamp in milliseconds for Last-Modified header
+    """
     request_count.labels("__get_image_cache").inc()
 
-    param_key = "({},{},{},{})".format(
-        image_format,
-        w if w else "-",
-        h if h else "-",
-        "{:.3f}".format(rescale) if rescale else "-"
-    )
+    auto_format = image_format is not None and image_format.lower() == "auto"
+    image_format = check_image_format(_negotiate_format(image_format, accept))
 
-    try:
-        image_response = cache.get(fid, key=param_key)
-        log.info("Hit cache on KEY {}_{}".format(fid, param_key))
-    except KeyError:
-        image_response = __get_image(
-            fid,
-            rescale,
-            h,
-            w,
-            image_format
-        )
-        log.info("Create cache on KEY {}_{}".format(fid, param_key))
-        cache.put(fid, param_key, image_response)
+    param_key = get_param_key(image_format, w, h, rescale)
+    headers = {
+        "ETag": get_etag(fid, param_key),
+        "Cache-Control": "public, max-age=31536000, immutable" if immutable else "public, no-cache",
+    }
+    if auto_format:
+        headers["Vary"] = "Accept"
+    if last_modified is not None:
+        headers["Last-Modified"] = formatdate(last_modified / 1000.0, usegmt=True)
+    if _etag_matched(headers["ETag"], if_none_match) or (
+            if_none_match is None and _not_modified_since(last_modified, if_modified_since)
+    ):
+        request_count.labels("not_modified").inc()
+        return Response(status_code=304, headers=headers)
+
+    image_response, cache_result = get_cached_image(fid, rescale, h, w, image_format)
+    if if_none_match is not None and if_none_match.strip() == "*":
+        # Checked after the image is read, a missing image is 404
+        request_count.labels("not_modified").inc()
+        return Response(status_code=304, headers=headers)
     return Response(
         content=image_response.content,
         status_code=200,
-        media_type=image_response.media_type
+        media_type=image_response.media_type,
+        headers={"X-Cache": cache_result.upper(), **headers}
     )
 
 
-def __get_image(
-        fid: str,
-        rescale: float,
-        h: int,
-        w: int,
-        image_format: str
-) -> ImageResponse:
-    """
-    Image resource
-    - **filename**:
-    - **image_hash**:
-    - **rescale**:  Zoom image before response
-    - **h**:  Height limit
-    - **w**:  Width limit
-    - **image_format**:  The image format to return, none means using original format
-    """
-    request_count.labels("__get_image").inc()
-
-    # Parameter verify
-    if rescale is not None and (rescale > 1.0 or rescale <= 0):
-        raise ParameterError("Invalid value rescale={}".format(rescale))
-
-    if (w is None) != (h is None):
-        raise ParameterError("Parameter w and h should appeared at same time!")
-
-    if rescale is not None and w is not None:
-        raise ParameterError("Parameter rescale/(w&h) are mutually exclusive.")
-
-    data = filesystem.read(fid)
-
-    with BytesIO(data) as bio:
-        im = Image.open(bio)
-
-        if image_format is None:
-            image_final_format = im.format.lower()
-        else:
-            image_final_format = image_format.lower()
-        media_type = "image/{}".format(image_final_format)
-        need_transform = not (image_format is None or (image_format.upper() == im.format))
-
-        need_rescale = rescale is not None
-        need_resize = h is not None and w is not None
-
-        # FIXME for now we can't deal with the animated image
-        if getattr(im, "is_animated", False):
-            need_transform = False
-            need_rescale = False
-            need_resize = False
-        if not need_transform and not need_rescale and not need_resize:
-            return create_image_response(data, media_type)
-
-        # Apply resize stage by parameters
-        if rescale is not None:
-            new_size = round(im.size[0] * rescale), round(im.size[1] * rescale)
-            im = im.resize(size=new_size)
-        elif h is not None and w is not None:
-            im = im.resource.resize(
-                size=(w, h)
-            )
-        if image_final_format == "JPEG":
-            im = im.convert("RGB")
-        with BytesIO() as fp:
-            im.save(fp, format=image_final_format)
-            fp.seek(0)
-            data = fp.read()
-        return create_image_response(data, media_type)
-
-
 @app.post("/upload")
 def upload_image(
         file: UploadFile = File(...),
         mode: str = "keep",
         auto_remove: bool = False,
         image_format: str = "original",
-        method: int = 6,
+        method: int = None,
         lossless: bool = False,
         quality: int = 80,
         attach_info: str = "{}"
@@ -368,22 +638,24 @@ def upload_image(
 
     **These parameters only works while to_webp is true**
 
-    - **method**: Compress method from 0~6, 0 is fastest and 6 is slowest
+    - **method**: Compress method from 0~6, 0 is fastest and 6 is slowest,
+      don't input means choosing by image size and server load (see `encoder_profile` in response attach)
     - **lossless**: lossless=true will make file large
     - **quality**: 0~100, default is 80, a good trade-off between size and quality
     - **attach_info**: JSON formatted attach info, an object/dictionary
     """
     request_count.labels("upload_image").inc()
-    return __commit_image_file(
-        file.file.read(),
-        mode,
-        auto_remove,
-        image_format,
-        method,
-        lossless,
-        quality,
-        attach_info
-    )
+    with admit("upload"):
+        return commit_image_file(
+            file.file,
+            mode,
+            auto_remove,
+            image_format,
+            method,
+            lossless,
+            quality,
+            attach_info
+        )
 
 
 @app.post("/batch_upload", deprecated=True)
@@ -392,7 +664,7 @@ def batch_upload_image(
         mode: str = "keep",
         auto_remove: bool = False,
         image_format: str = "original",
-        method: int = 6,
+        method: int = None,
         lossless: bool = False,
         quality: int = 80,
         attach_info: str = "{}"
@@ -409,157 +681,33 @@ def batch_upload_image(
 
     **These parameters only works while to_webp is true**
 
-    - **method**: Compress method from 0~6, 0 is fastest and 6 is slowest
+    - **method**: Compress method from 0~6, 0 is fastest and 6 is slowest,
+      don't input means choosing by image size and server load (see `encoder_profile` in response attach)
     - **lossless**: lossless=true will make file large
     - **quality**: 0~100, default is 80, a good trade-off between size and quality
     - **attach_info**: JSON formatted attach info, an object/dictionary
     """
     request_count.labels("batch_upload_image").inc()
     response_all = []
-    for file in files:
-        try:
-            response_all.append(__commit_image_file(
-                file.file.read(),
-                mode,
-                auto_remove,
-                image_format,
-                method,
-                lossless,
-                quality,
-                attach_info
-            ))
-        except Exception as ex:
-            response_all.append({
-                "status": "fail"
-            })
-            log.error("Error while processing file in batch.", ex)
+    with admit("upload"):
+        for file in files:
+            try:
+                response_all.append(commit_image_file(
+                    file.file,
+                    mode,
+                    auto_remove,
+                    image_format,
+                    method,
+                    lossless,
+                    quality,
+                    attach_info
+                ))
+            except Exception as ex:
+                response_all.append({
+                    "status": "fail"
+                })
+                log.error("Error while processing file in batch.", ex)
     return {
         "status": "success",
         "responses": response_all
     }
-
-
-def __commit_image_file(
-        data: bytes,
-        mode: str,
-        auto_remove: bool,
-        image_format: str,
-        # WebP options
-        method: int,
-        lossless: bool,
-        quality: int,
-        attach_info: str
-):
-    """
-    Commit single file to weed FS filer
-
-    :param data:
-    :param mode:
-    :param auto_remove:
-    :param image_format:
-    :param method:
-    :param lossless:
-    :param quality:
-    :param attach_info:
-    :return:
-    """
-    request_count.labels("__commit_image_file").inc()
-    if mode not in {"keep", "block", "largest"}:
-        raise ParameterError("mode should in keep/block/largest.")
-
-    try:
-        attach_obj = json.loads(attach_info)
-    except Exception as ex:
-        log.warning("Error while parsing attach info as JSON caused by: {}".format(str(ex)))
-        attach_obj = {}
-    with BytesIO(data) as fp:
-        im = Image.open(fp)
-        width = im.width
-        height = im.height
-        im_format = im.format
-        attach_obj["mode"] = im.mode
-        attach_obj["tick"] = int(time.time() * 1000)
-        attach_obj["w"] = width
-        attach_obj["h"] = height
-        image_format = image_format.upper()
-        # That means don't need convert
-        image_format_matched = image_format.lower() == "original" or im.format == image_format
-        image_hash = get_hash(im)
-        is_animated = getattr(im, "is_animated", False)
-        attach_obj["is_animated"] = is_animated
-        if not image_format_matched:
-            # Won't convert animated image
-            if is_animated:
-                log.warning("Can't convert animated image format from {} -> {}".format(
-                    im.format,
-                    image_format
-                ))
-
-            else:
-                with BytesIO() as wio:
-                    im_format = image_format.upper()
-                    if image_format == "WEBP":
-                        im.save(
-                            wio,
-                            format="WEBP",
-                            lossless=lossless,
-                            method=method,
-                            quality=quality
-                        )
-                    else:
-                        im.save(wio, format=image_format)
-                    wio.seek(0)
-                    data = wio.read()
-        # Get image hash by hash function
-    attach_obj["format"] = im_format
-    lazy_existed_file_info = LazyResource(lambda: metadb.list_images(image_hash))
-    # Lock the hash in redis
-    with RedisDistributedLock(Redlock(
-            redis_connection_pool
-    ), image_hash) as _:
-        if mode == "keep":
-            need_to_write = True
-        else:
-            if len(lazy_existed_file_info.resource) <= 0:
-                need_to_write = True
-            else:
-                if mode == "block":
-                    need_to_write = False
-                elif mode == "largest":
-                    max_image_size = max(
-                        int(info["w"]) * int(info["h"])
-                        for info in lazy_existed_file_info.resource
-                        if "w" in info and "h" in info
-                    )
-                    need_to_write = (width * height) > max_image_size
-                else:
-                    raise Exception("Unknown mode: {}".format(mode))
-        if need_to_write:
-            # File name parts:
-            # <image hash>/<hostname>_<micro sec tick(%x)>_<random str>.img
-            removed = []
-            if auto_remove:
-                __delete_hash(image_hash=image_hash)
-            fid = filesystem.write(
-                data
-            )
-            attach_obj["content_size"] = len(data)
-            metadb.add_image(
-                image_hash=image_hash,
-                fid=fid,
-                **attach_obj
-            )
-            return {
-                "status": "success",
-                "wrote": True,
-                "fid": fid,
-                "removed": removed,
-                "hash": image_hash,
-                "attach": attach_obj
-            }
-        else:
-            return {
-                "status": "success",
-                "wrote": False,
-                "hash": image_hash,
-            }
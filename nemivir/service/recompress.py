@@ -0,0 +1,303 @@
+"""
+Recompress the stored original images to WEBP in background, the backends are configured as the service (nemivir.config)
+
+$ python -m nemivir.service.recompress --checkpoint recompress.json --processes 4 --rate 20
+
+- Meta is walked in the order of fid, page by page, the images of a page are encoded in a process pool
+- Lossless sources (--lossless-formats) are encoded as lossless WEBP, lossy sources (JPEG) are skipped
+  unless --allow-lossy is set, re-encoding a lossy image loses quality again
+- An image is replaced only if WEBP saves at least --min-saving of its size:
+  under the lock of the hash (as uploading and deleting), the new file is written, meta is switched to the new fid,
+  then cached items and the file of the old fid are removed
+- The last fid of finished pages is saved in the checkpoint, the job resumes from it after restarting
+- New fids may be greater than the current one, images recompressed before (having original_format)
+  are passed over when the walk reaches them again, they are not counted as scanned or skipped
+- If the lock can't be acquired, the image is counted as failed and kept as it is
+- Throttled by --rate (images per second), the report of bytes saved is printed at the end
+
+Notice: fid of a recompressed image is changed, /image/{old fid} returns 404 after that, /hash/{hash} keeps working.
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from io import BytesIO
+from typing import List, Optional
+
+from PIL import Image
+
+from nemivir.config import filesystem, lock_manager, cache, metadb, image_max_pixels, image_max_decode_bytes
+from nemivir.image import check_image_limits
+from nemivir.util import RedisDistributedLock
+
+log = logging.getLogger(__file__)
+
+DEFAULT_FORMATS = ("PNG", "JPEG", "BMP", "TIFF")
+
+
+def encode_webp(data: bytes, lossless_formats: List[str], quality: int, method: int) -> Optional[bytes]:
+    """
+    Encode the image to WEBP, runs in the process pool
+    :param data: content of the original image
+    :param lossless_formats: formats encoded as lossless WEBP (like PNG), others are lossy
+    :param quality: quality of lossy WEBP (or compression effort of lossless WEBP)
+    :param method: WEBP method 0~6, 6 is the slowest and the smallest
+    :return: WEBP content, None if the image can't be converted (animated)
+    """
+    with BytesIO(data) as fp:
+        im = Image.open(fp)
+        check_image_limits(im, image_max_pixels, image_max_decode_bytes)
+        if getattr(im, "is_animated", False):
+            return None
+        with BytesIO() as wio:
+            im.save(
+                wio,
+                format="WEBP",
+                lossless=im.format in lossless_formats,
+                quality=quality,
+                method=method,
+            )
+            return wio.getvalue()
+
+
+class Recompressor:
+    def __init__(
+            self,
+            checkpoint: str,
+            formats: List[str] = DEFAULT_FORMATS,
+            lossless_formats: List[str] = ("PNG", "BMP", "TIFF"),
+            quality: int = 80,
+            method: int = 6,
+            min_bytes: int = 64 * 1024,
+            min_saving: float = 0.1,
+            processes: int = None,
+            rate: float = None,
+            page_size: int = 100,
+            dry_run: bool = False,
+            allow_lossy: bool = False
+    ):
+        """
+        :param checkpoint: JSON file to save the progress
+        :param formats: formats to recompress
+        :param lossless_formats: formats encoded as lossless WEBP, other formats are skipped unless allow_lossy
+        :param quality: quality of WEBP
+        :param method: WEBP method 0~6
+        :param min_bytes: skip images smaller than this
+        :param min_saving: replace the image only if the ratio of bytes saved is at least this
+        :param processes: processes to encode, default is the CPU count
+        :param rate: max images per second, None means no limit
+        :param page_size: images of each page, the checkpoint is saved after every page
+        :param dry_run: encode and count the bytes saved, but don't write anything
+        :param allow_lossy: also recompress the formats not in lossless_formats (like JPEG) as lossy WEBP
+        """
+        self.checkpoint = checkpoint
+        self.formats = {f.upper() for f in formats}
+        self.lossless_formats = [f.upper() for f in lossless_formats]
+        self.quality = quality
+        self.method = method
+        self.min_bytes = min_bytes
+        self.min_saving = min_saving
+        self.processes = processes or os.cpu_count() or 1
+        self.rate = rate
+        self.page_size = page_size
+        self.dry_run = dry_run
+        self.allow_lossy = allow_lossy
+        self.state = self._load_checkpoint()
+        self._next_time = time.perf_counter()
+        self._throttle_lock = threading.Lock()
+
+    def _load_checkpoint(self) -> dict:
+        state = {
+            "last_fid": None,
+            "scanned": 0,
+            "recompressed": 0,
+            "skipped": 0,
+            "failed": 0,
+            "bytes_before": 0,
+            "bytes_after": 0,
+        }
+        if os.path.exists(self.checkpoint):
+            with open(self.checkpoint) as fp:
+                state.update(json.load(fp))
+            log.info("Resume from checkpoint: {}".format(state))
+        return state
+
+    def _save_checkpoint(self):
+        # Write to a temporary file and rename, the checkpoint won't be broken if killed while writing
+        temp_file = "{}.tmp".format(self.checkpoint)
+        with open(temp_file, "w") as fp:
+            json.dump(self.state, fp, indent=2)
+        os.replace(temp_file, self.checkpoint)
+
+    def _throttle(self):
+        if self.rate is None or self.rate <= 0:
+            return
+        with self._throttle_lock:
+            self._next_time = max(self._next_time + 1.0 / self.rate, time.perf_counter())
+            delay = self._next_time - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+
+    def _is_eligible(self, info: dict) -> bool:
+        image_format = str(info.get("format", "")).upper()
+        if image_format not in self.formats:
+            return False
+        if image_format not in self.lossless_formats and not self.allow_lossy:
+            return False
+        if info.get("is_animated", False):
+            return False
+        # Size of the images uploaded by old versions is unknown, checked after downloading
+        return info.get("content_size", self.min_bytes) >= self.min_bytes
+
+    def _download(self, info: dict) -> Optional[bytes]:
+        self._throttle()
+        data = filesystem.resource.read(info["fid"])
+        return data if len(data) >= self.min_bytes else None
+
+    def _replace(self, info: dict, data: bytes, new_data: bytes) -> bool:
+        """
+        Save the new file and switch the meta to it, then remove the old file
+        :return: False if the image is removed while recompressing
+        """
+        fid = info["fid"]
+        # The whole replacement is under the lock of the hash, uploading or deleting the hash waits for it,
+        # LockError is raised (nothing is written) if the lock can't be acquired
+        with RedisDistributedLock(lock_manager.resource, info["image_hash"]) as _:
+            new_fid = filesystem.resource.write(new_data)
+            replaced = metadb.resource.replace_image(
+                fid,
+                new_fid,
+                format="WEBP",
+                content_size=len(new_data),
+                original_format=info.get("format"),
+                original_size=len(data),
+                # Content is changed, for Last-Modified
+                tick=int(time.time() * 1000),
+            )
+            if not replaced:
+                filesystem.resource.delete(new_fid)
+                return False
+            cache.resource.clean(fid)
+            try:
+                filesystem.resource.delete(fid)
+            except KeyError:
+                pass
+            return True
+
+    def _process_page(self, images: List[dict], downloader: ThreadPoolExecutor, encoder: ProcessPoolExecutor):
+        eligible = [info for info in images if self._is_eligible(info)]
+        self.state["skipped"] += len(images) - len(eligible)
+        downloads = [(info, downloader.submit(self._download, info)) for info in eligible]
+        encodings = []
+        for info, future in downloads:
+            try:
+                data = future.result()
+            except Exception as ex:
+                log.warning("Failed to read {}: {}".format(info["fid"], ex))
+                self.state["failed"] += 1
+                continue
+            if data is None:
+                self.state["skipped"] += 1
+                continue
+            encodings.append((info, data, encoder.submit(
+                encode_webp, data, self.lossless_formats, self.quality, self.method
+            )))
+        for info, data, future in encodings:
+            try:
+                new_data = future.result()
+                if new_data is None or len(new_data) > len(data) * (1 - self.min_saving):
+                    self.state["skipped"] += 1
+                    continue
+                if not self.dry_run and not self._replace(info, data, new_data):
+                    self.state["skipped"] += 1
+                    continue
+            except Exception as ex:
+                log.warning("Failed to recompress {}: {}".format(info["fid"], ex))
+                self.state["failed"] += 1
+                continue
+            self.state["recompressed"] += 1
+            self.state["bytes_before"] += len(data)
+            self.state["bytes_after"] += len(new_data)
+
+    def get_report(self) -> dict:
+        return dict(self.state, bytes_saved=self.state["bytes_before"] - self.state["bytes_after"])
+
+    def run(self, limit: int = None) -> dict:
+        """
+        Recompress images until all are scanned
+        :param limit: stop after scanning this count of images (in this run)
+        :return: report
+        """
+        scanned = 0
+        page = []
+        with ThreadPoolExecutor(max_workers=self.processes) as downloader, \
+                ProcessPoolExecutor(max_workers=self.processes) as encoder:
+            images = metadb.resource.iter_images(self.state["last_fid"], batch_size=self.page_size)
+            for info in images:
+                if "original_format" in info:
+                    # Recompressed before, or the new fid written by this run
+                    continue
+                page.append(info)
+                scanned += 1
+                if len(page) >= self.page_size or (limit is not None and scanned >= limit):
+                    self._finish_page(page, downloader, encoder)
+                    page = []
+                    if limit is not None and scanned >= limit:
+                        break
+            if len(page) > 0:
+                self._finish_page(page, downloader, encoder)
+        return self.get_report()
+
+    def _finish_page(self, page: List[dict], downloader: ThreadPoolExecutor, encoder: ProcessPoolExecutor):
+        self._process_page(page, downloader, encoder)
+        self.state["last_fid"] = page[-1]["fid"]
+        self.state["scanned"] += len(page)
+        if not self.dry_run:
+            self._save_checkpoint()
+        report = self.get_report()
+        log.info("Scanned {scanned}, recompressed {recompressed}, failed {failed}, saved {bytes_saved} bytes, "
+                 "last fid {last_fid}".format(**report))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Recompress the stored original images to WEBP")
+    parser.add_argument("--checkpoint", default="recompress.json", help="file to save the progress")
+    parser.add_argument("--formats", default=",".join(DEFAULT_FORMATS), help="formats to recompress")
+    parser.add_argument("--lossless-formats", default="PNG,BMP,TIFF", help="formats encoded as lossless WEBP")
+    parser.add_argument("--allow-lossy", action="store_true",
+                        help="also recompress the other formats (like JPEG) as lossy WEBP, loses quality again")
+    parser.add_argument("--quality", type=int, default=80, help="quality of WEBP")
+    parser.add_argument("--method", type=int, default=6, help="WEBP method 0~6, 6 is the slowest and the smallest")
+    parser.add_argument("--min-bytes", type=int, default=64 * 1024, help="skip images smaller than this")
+    parser.add_argument("--min-saving", type=float, default=0.1, help="min ratio of bytes saved to replace")
+    parser.add_argument("--processes", type=int, default=None, help="processes to encode, default is CPU count")
+    parser.add_argument("--rate", type=float, default=None, help="max images per second")
+    parser.add_argument("--page-size", type=int, default=100, help="images of each checkpoint")
+    parser.add_argument("--limit", type=int, default=None, help="max images to scan in this run")
+    parser.add_argument("--dry-run", action="store_true", help="count the bytes to save without writing")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+
+    recompressor = Recompressor(
+        args.checkpoint,
+        formats=[f for f in args.formats.split(",") if f != ""],
+        lossless_formats=[f for f in args.lossless_formats.split(",") if f != ""],
+        quality=args.quality,
+        method=args.method,
+        min_bytes=args.min_bytes,
+        min_saving=args.min_saving,
+        processes=args.processes,
+        rate=args.rate,
+        page_size=args.page_size,
+        dry_run=args.dry_run,
+        allow_lossy=args.allow_lossy,
+    )
+    print(json.dumps(recompressor.run(args.limit), indent=2))
+
+
+if __name__ == '__main__':
+    main()
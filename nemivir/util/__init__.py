@@ -1,3 +1,8 @@
-from .cache import RedisImageCache
-from .distributed_lock import RedisDistributedLock, get_random_string
+from .cache import RedisImageCache, ShardedRedisImageCache, MemoryImageCache
+from .distributed_lock import RedisDistributedLock, LocalLockManager, LockError, get_random_string, \
+    ping_lock_manager
 from .tools import LazyResource
+from .profiling import StackSampler, MemoryTracer, format_collapsed_stacks, sample_stacks, ProfileMiddleware
+from .admission import AdmissionController, AdmissionQueue, OverloadError
+from .hash_ring import ConsistentHashRing
+from .request_limit import RequestSizeLimit, RequestTooLarge
@@ -0,0 +1,138 @@
+"""
+Admission control: every class of requests (cache hits, transforms, uploads, listings) has its own
+concurrency limit and waiting queue, so a spike of expensive requests can't slow down the cheap ones.
+Requests which can't start before the deadline of the queue are rejected (the service returns 503).
+"""
+import math
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict
+
+
+class OverloadError(Exception):
+    def __init__(self, request_class: str, reason: str, retry_after: int):
+        """
+        The request is rejected by admission control
+        :param request_class: class of the request
+        :param reason: why the request is rejected
+        :param retry_after: seconds the client should wait before retrying
+        """
+        super().__init__("Too many {} requests: {}".format(request_class, reason))
+        self.request_class = request_class
+        self.retry_after = retry_after
+
+
+class AdmissionQueue:
+    def __init__(self, name: str, concurrency: int, max_queue: int, deadline: float, alpha: float = 0.2):
+        """
+        Concurrency limit with a bounded waiting queue
+        :param name: class name
+        :param concurrency: max requests running at the same time
+        :param max_queue: max requests waiting, the request is rejected at once if the queue is full
+        :param deadline: max seconds to wait, the request is rejected if it can't start in time
+        :param alpha: smoothing factor of EWMA while updating the service time
+        """
+        self.name = name
+        self.concurrency = concurrency
+        self.max_queue = max_queue
+        self.deadline = deadline
+        self._alpha = alpha
+        self._semaphore = threading.BoundedSemaphore(concurrency)
+        self._waiting = 0
+        self._running = 0
+        self._service_time = deadline / 2
+        self._lock = threading.Lock()
+
+    def get_retry_after(self) -> int:
+        """
+        Estimate the seconds to drain the queue
+        """
+        drain_time = (self._waiting + 1) * self._service_time / self.concurrency
+        return max(1, int(math.ceil(drain_time)))
+
+    @contextmanager
+    def admit(self):
+        """
+        Wait for a free slot, raise OverloadError if the queue is full or the deadline exceeded
+        """
+        # Take a free slot at once, the queue is only for the requests which have to wait
+        acquired = self._semaphore.acquire(blocking=False)
+        if not acquired:
+            with self._lock:
+                if self._waiting >= self.max_queue:
+                    raise OverloadError(self.name, "queue is full", self.get_retry_after())
+                self._waiting += 1
+            try:
+                acquired = self._semaphore.acquire(timeout=self.deadline)
+            finally:
+                with self._lock:
+                    self._waiting -= 1
+            if not acquired:
+                raise OverloadError(self.name, "waited more than {}s".format(self.deadline), self.get_retry_after())
+        with self._lock:
+            self._running += 1
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            used_time = time.perf_counter() - start_time
+            with self._lock:
+                self._running -= 1
+                self._service_time = self._alpha * used_time + (1 - self._alpha) * self._service_time
+            self._semaphore.release()
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            return {
+                "concurrency": self.concurrency,
+                "running": self._running,
+                "waiting": self._waiting,
+                "max_queue": self.max_queue,
+                "deadline": self.deadline,
+                "service_time": self._service_time,
+            }
+
+
+class AdmissionController:
+    def __init__(self, queues: Dict[str, AdmissionQueue]):
+        """
+        Admission queues by request class
+        :param queues: class name -> queue, requests of unknown classes are admitted without limit
+        """
+        self._queues = queues
+
+    @property
+    def capacity(self) -> int:
+        """
+        Max threads used by admitted and waiting requests
+        """
+        return sum(queue.concurrency + queue.max_queue for queue in self._queues.values())
+
+    @contextmanager
+    def admit(self, request_class: str):
+        queue = self._queues.get(request_class)
+        if queue is None:
+            yield
+        else:
+            with queue.admit():
+                yield
+
+    def get_stats(self) -> dict:
+        return {
+            name: queue.get_stats()
+            for name, queue in self._queues.items()
+        }
+
+    @staticmethod
+    def parse_limits(limits: str) -> Dict[str, AdmissionQueue]:
+        """
+        Parse limits like "hit:64:128:0.5,transform:4:32:2", each class is name:concurrency:max_queue:deadline
+        """
+        queues = {}
+        for item in limits.split(","):
+            if item.strip() == "":
+                continue
+            name, concurrency, max_queue, deadline = item.strip().split(":")
+            queues[name] = AdmissionQueue(name, int(concurrency), int(max_queue), float(deadline))
+        return queues
@@ -1,9 +1,14 @@
 import logging
+import threading
 import time
+from collections import OrderedDict
+from collections import defaultdict
+from typing import List, Tuple, Optional, Dict
 
-from redis import StrictRedis
+from redis import StrictRedis, RedisError
 
 from nemivir.protos import ImageResponse
+from .hash_ring import ConsistentHashRing
 
 log = logging.getLogger(__file__)
 
@@ -26,10 +31,12 @@ class RedisImageCache:
             key,
         )
 
+    def _generate_index_key(self, filename: str):
+        # Set of the cached keys of a file, to invalidate them without scanning the keyspace
+        return "{}_idx_{}".format(self.key_prefix, filename)
+
     def put(self, filename: str, key: str, value: ImageResponse, ttl: int = None):
-        if ttl is None:
-            ttl = self.default_ttl
-        self.redis_client.setex(self._generate_key(filename, key), ttl, value.SerializeToString())
+        self.put_many([(filename, key, value)], ttl)
 
     def get(self, filename: str, key: str) -> ImageResponse:
         fk = self._generate_key(filename, key)
@@ -40,6 +47,41 @@ class RedisImageCache:
         else:
             raise KeyError("Can't find key {} in redis".format(fk))
 
+    def get_many(self, keys: List[Tuple[str, str]]) -> List[Optional[ImageResponse]]:
+        """
+        Get items in one MGET
+        :param keys: (filename, key) pairs
+        :return: items in the same order, None if missed
+        """
+        if len(keys) == 0:
+            return []
+        result = []
+        for data in self.redis_client.mget([self._generate_key(filename, key) for filename, key in keys]):
+            if data is None:
+                result.append(None)
+            else:
+                resp = ImageResponse()
+                resp.ParseFromString(data)
+                result.append(resp)
+        return result
+
+    def put_many(self, items: List[Tuple[str, str, ImageResponse]], ttl: int = None):
+        """
+        Put items in one pipeline
+        :param items: (filename, key, value)
+        :param ttl: TTL in seconds
+        """
+        if ttl is None:
+            ttl = self.default_ttl
+        pipeline = self.redis_client.pipeline(transaction=False)
+        for filename, key, value in items:
+            fk = self._generate_key(filename, key)
+            index_key = self._generate_index_key(filename)
+            pipeline.setex(fk, ttl, value.SerializeToString())
+            pipeline.sadd(index_key, fk)
+            pipeline.expire(index_key, ttl)
+        pipeline.execute()
+
     def _clean_by_pattern(self, pattern: str, batch_count: int = 100):
         log.info("Cleaning by pattern: {}".format(pattern))
 
@@ -61,12 +103,194 @@ class RedisImageCache:
 
     def clean(self, filename: str, key: str = None):
         if key is None:
-            self._clean_by_pattern(self._generate_key(filename, "*"))
+            self.clean_many([filename])
         else:
             self.redis_client.delete(self._generate_key(filename, key))
 
+    def clean_many(self, filenames: List[str]):
+        """
+        Remove all cached items of the files, in two round trips
+        :param filenames: file names (fid)
+        """
+        if len(filenames) == 0:
+            return
+        index_keys = [self._generate_index_key(filename) for filename in filenames]
+        pipeline = self.redis_client.pipeline(transaction=False)
+        for index_key in index_keys:
+            pipeline.smembers(index_key)
+        keys = [key for members in pipeline.execute() for key in members]
+        pipeline = self.redis_client.pipeline(transaction=False)
+        for key in keys + index_keys:
+            pipeline.delete(key)
+        pipeline.execute()
+
     def clean_hash(self, image_hash: str):
         self._clean_by_pattern("{}_{}*".format(self.key_prefix, image_hash))
 
     def clean_all(self):
         self._clean_by_pattern("{}_*".format(self.key_prefix))
+
+    def ping(self):
+        self.redis_client.ping()
+
+
+class ShardedRedisImageCache:
+    def __init__(
+            self,
+            redis_clients: Dict[str, StrictRedis],
+            default_ttl: float,
+            key_prefix: str = "imc",
+            virtual_nodes: int = 160
+    ):
+        """
+        Image cache sharded on several Redis nodes by consistent hashing on file name (fid),
+        all cached items of a file are on the same node, the same interface as RedisImageCache
+        If a node is down, reading its items misses and writing them is skipped, the other nodes keep working
+        :param redis_clients: node name (like the URL) -> client, keep the names stable to keep the keys in place
+        :param default_ttl: default TTL in seconds
+        :param key_prefix: prefix of keys
+        :param virtual_nodes: points per node on the hash ring
+        """
+        self.key_prefix = key_prefix
+        self.default_ttl = default_ttl
+        self.shards = {
+            name: RedisImageCache(redis_client, default_ttl, key_prefix)
+            for name, redis_client in redis_clients.items()
+        }
+        self._ring = ConsistentHashRing(self.shards.keys(), virtual_nodes)
+
+    def get_shard(self, filename: str) -> RedisImageCache:
+        return self.shards[self._ring.get_node(filename)]
+
+    def put(self, filename: str, key: str, value: ImageResponse, ttl: int = None):
+        self.put_many([(filename, key, value)], ttl)
+
+    def get(self, filename: str, key: str) -> ImageResponse:
+        name = self._ring.get_node(filename)
+        try:
+            return self.shards[name].get(filename, key)
+        except RedisError as ex:
+            log.warning("Cache node {} is unavailable: {}".format(name, ex))
+            raise KeyError("Can't read key {}_{} from cache node {}".format(filename, key, name))
+
+    def get_many(self, keys: List[Tuple[str, str]]) -> List[Optional[ImageResponse]]:
+        # One MGET per node
+        grouped = defaultdict(list)
+        for i, (filename, key) in enumerate(keys):
+            grouped[self._ring.get_node(filename)].append(i)
+        result = [None] * len(keys)
+        for name, indexes in grouped.items():
+            try:
+                values = self.shards[name].get_many([keys[i] for i in indexes])
+            except RedisError as ex:
+                log.warning("Cache node {} is unavailable: {}".format(name, ex))
+                continue
+            for i, value in zip(indexes, values):
+                result[i] = value
+        return result
+
+    def put_many(self, items: List[Tuple[str, str, ImageResponse]], ttl: int = None):
+        grouped = defaultdict(list)
+        for item in items:
+            grouped[self._ring.get_node(item[0])].append(item)
+        for name, shard_items in grouped.items():
+            try:
+                self.shards[name].put_many(shard_items, ttl)
+            except RedisError as ex:
+                log.warning("Cache node {} is unavailable: {}".format(name, ex))
+
+    def clean(self, filename: str, key: str = None):
+        self.get_shard(filename).clean(filename, key)
+
+    def clean_many(self, filenames: List[str]):
+        grouped = defaultdict(list)
+        for filename in filenames:
+            grouped[self._ring.get_node(filename)].append(filename)
+        for name, shard_filenames in grouped.items():
+            self.shards[name].clean_many(shard_filenames)
+
+    def clean_all(self):
+        for shard in self.shards.values():
+            shard.clean_all()
+
+    def ping(self):
+        for shard in self.shards.values():
+            shard.ping()
+
+
+class MemoryImageCache:
+    def __init__(self, default_ttl: float, max_bytes: int = 256 << 20):
+        """
+        In-process LRU image cache, the same interface as RedisImageCache
+        For single node deployment or testing, every worker has its own cache
+        :param default_ttl: default TTL in seconds
+        :param max_bytes: the least recently used items will be evicted while exceed max_bytes
+        """
+        self.default_ttl = default_ttl
+        self.max_bytes = max_bytes
+        self._items = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def put(self, filename: str, key: str, value: ImageResponse, ttl: int = None):
+        if ttl is None:
+            ttl = self.default_ttl
+        data = value.SerializeToString()
+        with self._lock:
+            self._remove((filename, key))
+            self._items[(filename, key)] = (time.time() + ttl, data)
+            self._size += len(data)
+            while self._size > self.max_bytes and len(self._items) > 0:
+                _, (_, evicted) = self._items.popitem(last=False)
+                self._size -= len(evicted)
+
+    def get(self, filename: str, key: str) -> ImageResponse:
+        with self._lock:
+            item = self._items.get((filename, key))
+            if item is None or item[0] < time.time():
+                self._remove((filename, key))
+                raise KeyError("Can't find key {}_{} in memory cache".format(filename, key))
+            self._items.move_to_end((filename, key))
+        resp = ImageResponse()
+        resp.ParseFromString(item[1])
+        return resp
+
+    def get_many(self, keys: List[Tuple[str, str]]) -> List[Optional[ImageResponse]]:
+        result = []
+        for filename, key in keys:
+            try:
+                result.append(self.get(filename, key))
+            except KeyError:
+                result.append(None)
+        return result
+
+    def put_many(self, items: List[Tuple[str, str, ImageResponse]], ttl: int = None):
+        for filename, key, value in items:
+            self.put(filename, key, value, ttl)
+
+    def _remove(self, item_key: tuple):
+        item = self._items.pop(item_key, None)
+        if item is not None:
+            self._size -= len(item[1])
+
+    def clean(self, filename: str, key: str = None):
+        with self._lock:
+            if key is None:
+                for item_key in [k for k in self._items.keys() if k[0] == filename]:
+                    self._remove(item_key)
+            else:
+                self._remove((filename, key))
+
+    def clean_many(self, filenames: List[str]):
+        filenames = set(filenames)
+        with self._lock:
+            for item_key in [k for k in self._items.keys() if k[0] in filenames]:
+                self._remove(item_key)
+
+    def clean_all(self):
+        with self._lock:
+            self._items.clear()
+            self._size = 0
+
+    def ping(self):
+        pass
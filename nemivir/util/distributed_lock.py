@@ -1,11 +1,21 @@
 import random
 import string
+import threading
+import time
+from collections import namedtuple
 
 from redlock import Redlock
 
 CHARACTERS = string.ascii_letters + string.digits
 
 
+class LockError(Exception):
+    """
+    Can't acquire the lock before retries run out, the resource is locked by others or the lock servers are down
+    """
+    pass
+
+
 class RedisDistributedLock:
     def __init__(self, redis_lock: Redlock, lock_key: str, ttl: int = 30):
         """
@@ -20,13 +30,82 @@ class RedisDistributedLock:
         self._lock = None
 
     def __enter__(self):
-        self._lock = self._rlk.lock(self._key, self._ttl)
+        # Redlock takes TTL in milliseconds
+        self._lock = self._rlk.lock(self._key, int(self._ttl * 1000))
+        if not self._lock:
+            raise LockError("Can't acquire the lock of {}".format(self._key))
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         self._rlk.unlock(self._lock)
 
 
+LocalLock = namedtuple("LocalLock", ("resource", "key", "validity"))
+
+
+class LocalLockManager:
+    def __init__(self, retry_count: int = 300, retry_delay: float = 0.01):
+        """
+        In-process lock with the same interface as Redlock, for single worker deployment or testing
+        :param retry_count: how many times to retry while the resource is locked
+        :param retry_delay: seconds to wait between retries
+        """
+        self._retry_count = retry_count
+        self._retry_delay = retry_delay
+        self._locks = {}
+        self._mutex = threading.Lock()
+
+    def lock(self, resource: str, ttl: int):
+        """
+        Lock the resource
+        :param resource: resource key
+        :param ttl: lock expires after ttl milliseconds (the same as Redlock)
+        :return: a lock object, or False if can't acquire the lock
+        """
+        key = get_random_string(22)
+        for _ in range(self._retry_count):
+            now = time.time()
+            with self._mutex:
+                current = self._locks.get(resource)
+                if current is None or current[1] < now:
+                    self._locks[resource] = (key, now + ttl / 1000.0)
+                    return LocalLock(resource, key, ttl)
+            time.sleep(self._retry_delay)
+        return False
+
+    def unlock(self, lock: LocalLock):
+        if not lock:
+            return
+        with self._mutex:
+            current = self._locks.get(lock.resource)
+            if current is not None and current[0] == lock.key:
+                del self._locks[lock.resource]
+
+
+def ping_lock_manager(lock_manager):
+    """
+    Check the lock backend is available, raise exception if not
+    Redlock can lock only if the majority of its servers are available
+    :param lock_manager: Redlock or LocalLockManager
+    """
+    if isinstance(lock_manager, LocalLockManager):
+        return
+    errors = []
+    for server in lock_manager.servers:
+        try:
+            server.ping()
+        except Exception as ex:
+            errors.append(str(ex))
+    available = len(lock_manager.servers) - len(errors)
+    if available < lock_manager.quorum:
+        raise Exception("{} of {} lock servers are available (quorum is {}): {}".format(
+            available,
+            len(lock_manager.servers),
+            lock_manager.quorum,
+            "; ".join(errors)
+        ))
+
+
 def get_random_string(size: int):
     """
     Get a random string combined by a-z,A-Z,0-9
@@ -0,0 +1,33 @@
+import bisect
+import hashlib
+from typing import Iterable, List
+
+
+class ConsistentHashRing:
+    def __init__(self, nodes: Iterable[str], virtual_nodes: int = 160):
+        """
+        Consistent hashing, adding or removing a node only remaps about 1/N of the keys
+        :param nodes: node names, the same name always owns the same points on the ring
+        :param virtual_nodes: points per node on the ring, more points make the keys more evenly distributed
+        """
+        self.nodes: List[str] = list(nodes)
+        if len(self.nodes) == 0:
+            raise Exception("Hash ring requires at least one node")
+        points = sorted(
+            (self._hash("{}#{}".format(node, i)), node)
+            for node in self.nodes
+            for i in range(virtual_nodes)
+        )
+        self._points = [point for point, _ in points]
+        self._owners = [node for _, node in points]
+
+    @staticmethod
+    def _hash(key: str) -> int:
+        return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+    def get_node(self, key: str) -> str:
+        """
+        The node owns the key: the first point clockwise from the hash of the key
+        """
+        index = bisect.bisect(self._points, self._hash(key)) % len(self._points)
+        return self._owners[index]
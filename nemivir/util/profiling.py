@@ -0,0 +1,212 @@
+"""
+Profiling tools which can be enabled on a running service:
+- StackSampler: sample the stacks of threads, output in collapsed format (compatible with flamegraph.pl/speedscope)
+- MemoryTracer: tracemalloc snapshots and the difference between snapshots
+- ProfileMiddleware: sample stacks while processing the selected requests
+"""
+import logging
+import os
+import random
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from typing import List, Optional
+
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+log = logging.getLogger(__file__)
+
+
+def _format_frame(frame) -> str:
+    code = frame.f_code
+    return "{}:{}:{}".format(os.path.basename(code.co_filename), code.co_name, frame.f_lineno)
+
+
+class StackSampler:
+    def __init__(self, interval: float = 0.005, package_only: bool = False):
+        """
+        Sample stacks of all threads in a background thread
+        :param interval: sampling interval in seconds
+        :param package_only: only keep the stacks which are running the code in nemivir
+        """
+        self._interval = interval
+        self._package_only = package_only
+        self._stacks = Counter()
+        self._sample_count = 0
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> Counter:
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+        return self._stacks
+
+    @property
+    def sample_count(self) -> int:
+        return self._sample_count
+
+    def _run(self):
+        current_id = threading.get_ident()
+        while not self._stop_event.wait(self._interval):
+            self._sample_count += 1
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == current_id:
+                    continue
+                stack = []
+                in_package = False
+                while frame is not None:
+                    if frame.f_code.co_filename.startswith(PACKAGE_DIR):
+                        in_package = True
+                    stack.append(_format_frame(frame))
+                    frame = frame.f_back
+                if self._package_only and not in_package:
+                    continue
+                self._stacks[";".join(reversed(stack))] += 1
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+
+class ProfileMiddleware:
+    def __init__(self, app, sample_rate: float = 0.0, header: str = "X-Nemivir-Profile"):
+        """
+        ASGI middleware sampling stacks while processing the selected requests, the profile is logged
+        Requests which are not selected are passed to the app directly, so profiling costs nothing when it's off
+        Notice: stacks of the concurrent requests in the same worker will be sampled too
+        :param app: ASGI application
+        :param sample_rate: ratio of requests to profile (0~1)
+        :param header: requests with this header are profiled anyway
+        """
+        self.app = app
+        self.sample_rate = sample_rate
+        self._header = header.lower().encode("latin-1")
+
+    def _selected(self, scope) -> bool:
+        if self.sample_rate > 0 and random.random() < self.sample_rate:
+            return True
+        return any(name == self._header for name, _ in scope["headers"])
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self._selected(scope):
+            await self.app(scope, receive, send)
+            return
+        sampler = StackSampler(package_only=True).start()
+        start_time = time.time()
+
+        async def send_with_samples(message):
+            if message["type"] == "http.response.start":
+                headers = list(message.get("headers", []))
+                headers.append((b"x-profile-samples", str(sampler.sample_count).encode("latin-1")))
+                message = dict(message, headers=headers)
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_samples)
+        finally:
+            # Streamed bodies are profiled until the last chunk is sent
+            stacks = sampler.stop()
+            log.info("Profile of {} {} used {:.4f}s, {} samples:\n{}".format(
+                scope["method"],
+                scope["path"],
+                time.time() - start_time,
+                sampler.sample_count,
+                format_collapsed_stacks(stacks, top=20)
+            ))
+
+
+def format_collapsed_stacks(stacks: Counter, top: int = None) -> str:
+    """
+    Format stacks in collapsed format: "frame1;frame2;frame3 count" per line
+    :param stacks: stacks counter from StackSampler
+    :param top: only output the top N stacks
+    :return:
+    """
+    return "\n".join(
+        "{} {}".format(stack, count)
+        for stack, count in stacks.most_common(top)
+    )
+
+
+def sample_stacks(seconds: float, interval: float = 0.005) -> Counter:
+    """
+    Sample the stacks of all threads for a while
+    :param seconds: sampling duration
+    :param interval: sampling interval
+    :return:
+    """
+    with StackSampler(interval=interval) as sampler:
+        time.sleep(seconds)
+    return sampler.stop()
+
+
+class MemoryTracer:
+    def __init__(self):
+        """
+        Wrapper of tracemalloc, keep the last snapshot to compare with
+        """
+        self._last_snapshot: Optional[tracemalloc.Snapshot] = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def is_tracing() -> bool:
+        return tracemalloc.is_tracing()
+
+    def start(self, frame_count: int = 1):
+        with self._lock:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(frame_count)
+            self._last_snapshot = None
+
+    def stop(self):
+        with self._lock:
+            tracemalloc.stop()
+            self._last_snapshot = None
+
+    def snapshot(self, top: int = 20, key_type: str = "lineno") -> dict:
+        """
+        Take a snapshot, get the top allocations and the difference compared with last snapshot
+        :param top: how many records to return
+        :param key_type: lineno/filename/traceback
+        :return:
+        """
+        if not tracemalloc.is_tracing():
+            raise Exception("tracemalloc is not started")
+        with self._lock:
+            snapshot = tracemalloc.take_snapshot().filter_traces((
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+            ))
+            result = {
+                "traced_memory": dict(zip(("current", "peak"), tracemalloc.get_traced_memory())),
+                "top": self._format_stats(snapshot.statistics(key_type)[:top]),
+            }
+            if self._last_snapshot is not None:
+                result["diff"] = self._format_stats(snapshot.compare_to(self._last_snapshot, key_type)[:top])
+            self._last_snapshot = snapshot
+            return result
+
+    @staticmethod
+    def _format_stats(stats: list) -> List[dict]:
+        result = []
+        for stat in stats:
+            item = {
+                "traceback": [str(frame) for frame in stat.traceback],
+                "size": stat.size,
+                "count": stat.count,
+            }
+            if isinstance(stat, tracemalloc.StatisticDiff):
+                item["size_diff"] = stat.size_diff
+                item["count_diff"] = stat.count_diff
+            result.append(item)
+        return result
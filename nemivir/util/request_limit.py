@@ -0,0 +1,79 @@
+"""
+Limit the size of request bodies before they are parsed, so oversized uploads are rejected
+without spooling the whole body to disk
+"""
+import json
+from typing import Iterable
+
+
+class RequestTooLarge(Exception):
+    pass
+
+
+class RequestSizeLimit:
+    def __init__(self, app, max_bytes: int, paths: Iterable[str]):
+        """
+        ASGI middleware rejecting requests with bodies larger than max_bytes with 413
+        Content-Length is checked before receiving, chunked bodies are counted while receiving
+        :param app: ASGI application
+        :param max_bytes: max bytes of the request body
+        :param paths: paths to limit
+        """
+        self.app = app
+        self.max_bytes = max_bytes
+        self.paths = set(paths)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] not in self.paths:
+            await self.app(scope, receive, send)
+            return
+        headers = dict(scope["headers"])
+        try:
+            content_length = int(headers.get(b"content-length", b"0"))
+        except ValueError:
+            content_length = 0
+        if content_length > self.max_bytes:
+            await self._reject(send)
+            return
+
+        received = 0
+        exceeded = False
+
+        async def limited_receive():
+            nonlocal received, exceeded
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_bytes:
+                    exceeded = True
+                    raise RequestTooLarge("Request body is larger than {} bytes".format(self.max_bytes))
+            return message
+
+        async def guarded_send(message):
+            # The response of the app to the exception is replaced by 413
+            if not exceeded:
+                await send(message)
+
+        try:
+            await self.app(scope, limited_receive, guarded_send)
+        except Exception:
+            if not exceeded:
+                raise
+        if exceeded:
+            await self._reject(send)
+
+    async def _reject(self, send):
+        body = json.dumps({
+            "status": "fail",
+            "message": "Request body is larger than {} bytes".format(self.max_bytes),
+        }).encode("utf-8")
+        await send({
+            "type": "http.response.start",
+            "status": 413,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode("utf-8")),
+                (b"connection", b"close"),
+            ],
+        })
+        await send({"type": "http.response.body", "body": body})
@@ -1,4 +1,5 @@
-from collections import Callable
+import threading
+from collections.abc import Callable
 
 
 class LazyResource:
@@ -6,14 +7,22 @@ class LazyResource:
         self.__create_res_func = create_resource
         self.__res_flag = False
         self.__res = None
+        self.__lock = threading.Lock()
 
     @property
     def resource(self):
         if not self.__res_flag:
-            self.__res = self.__create_res_func()
-            self.__res_flag = True
+            with self.__lock:
+                # Double check, another thread may created the resource while waiting
+                if not self.__res_flag:
+                    self.__res = self.__create_res_func()
+                    self.__res_flag = True
         return self.__res
 
+    @property
+    def created(self) -> bool:
+        return self.__res_flag
+
     def set_resource(self, resource):
         self.__res = resource
         self.__res_flag = True
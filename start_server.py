@@ -1,4 +1,8 @@
 #!/usr/bin/python3
+"""
+Development server with auto reload, for production please use:
+$ gunicorn -c gunicorn_conf.py nemivir.service.image_api:app
+"""
 
 import uvicorn
 
@@ -0,0 +1,55 @@
+"""
+Tests run in-process with the embedded backends (local filesystem, SQLite, memory cache, local lock),
+the environment must be set before importing nemivir.config
+"""
+import os
+import tempfile
+from io import BytesIO
+
+import numpy
+import pytest
+from PIL import Image
+
+_data_dir = tempfile.mkdtemp(prefix="nemivir_test_")
+os.environ.update(
+    FILESYSTEM_BACKEND="local",
+    LOCAL_FS_ROOT=os.path.join(_data_dir, "fs"),
+    META_BACKEND="sqlite",
+    SQLITE_META=os.path.join(_data_dir, "meta.db"),
+    CACHE_BACKEND="memory",
+    LOCK_BACKEND="local",
+    ADMISSION_LIMITS="hit:8:16:1,transform:4:16:2,upload:4:16:5,listing:4:8:1",
+)
+
+
+def create_image_bytes(w: int = 64, h: int = 48, image_format: str = "PNG", seed: int = None, **kwargs) -> bytes:
+    """
+    Random image, different seeds create different images
+    """
+    rnd = numpy.random.RandomState(seed)
+    im = Image.fromarray(numpy.uint8(rnd.randint(0, 255, (h, w, 3))))
+    with BytesIO() as fp:
+        im.save(fp, format=image_format, **kwargs)
+        return fp.getvalue()
+
+
+@pytest.fixture(scope="session")
+def client():
+    from fastapi.testclient import TestClient
+    from nemivir.service.image_api import app
+    with TestClient(app, raise_server_exceptions=False) as test_client:
+        yield test_client
+
+
+@pytest.fixture
+def upload(client):
+    def _upload(content: bytes = None, **params) -> dict:
+        response = client.post(
+            "/upload",
+            params=params,
+            files={"file": ("image", content if content is not None else create_image_bytes())}
+        )
+        assert response.status_code == 200, response.text
+        return response.json()
+
+    return _upload
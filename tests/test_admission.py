@@ -0,0 +1,97 @@
+import threading
+import time
+
+import pytest
+
+from nemivir.util import AdmissionQueue, AdmissionController, OverloadError
+
+
+def _hold(queue: AdmissionQueue, release: threading.Event) -> threading.Thread:
+    started = threading.Event()
+
+    def run():
+        with queue.admit():
+            started.set()
+            release.wait()
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    assert started.wait(5)
+    return thread
+
+
+def test_free_slot_without_queue():
+    queue = AdmissionQueue("hit", concurrency=2, max_queue=0, deadline=1)
+    with queue.admit():
+        with queue.admit():
+            assert queue.get_stats()["running"] == 2
+    assert queue.get_stats()["running"] == 0
+
+
+def test_queue_full():
+    queue = AdmissionQueue("hit", concurrency=1, max_queue=0, deadline=1)
+    release = threading.Event()
+    thread = _hold(queue, release)
+    with pytest.raises(OverloadError) as info:
+        with queue.admit():
+            pass
+    assert info.value.request_class == "hit"
+    assert info.value.retry_after >= 1
+    release.set()
+    thread.join()
+    with queue.admit():
+        pass
+
+
+def test_deadline():
+    queue = AdmissionQueue("transform", concurrency=1, max_queue=1, deadline=0.1)
+    release = threading.Event()
+    thread = _hold(queue, release)
+    start_time = time.perf_counter()
+    with pytest.raises(OverloadError):
+        with queue.admit():
+            pass
+    assert 0.1 <= time.perf_counter() - start_time < 1
+    assert queue.get_stats()["waiting"] == 0
+    release.set()
+    thread.join()
+
+
+def test_wait_in_queue():
+    queue = AdmissionQueue("upload", concurrency=1, max_queue=1, deadline=5)
+    release = threading.Event()
+    thread = _hold(queue, release)
+    timer = threading.Timer(0.1, release.set)
+    timer.start()
+    with queue.admit():
+        assert queue.get_stats()["running"] == 1
+    thread.join()
+
+
+def test_controller():
+    controller = AdmissionController(AdmissionController.parse_limits("hit:2:4:0.5, listing:1:0:1"))
+    assert controller.capacity == 7
+    assert set(controller.get_stats()) == {"hit", "listing"}
+    assert controller.get_stats()["hit"]["deadline"] == 0.5
+    with controller.admit("unknown"):
+        pass
+    with controller.admit("listing"):
+        pass
+
+
+def test_batch_image_overload(client, upload, monkeypatch):
+    from nemivir.config import admission
+    fid = upload()["fid"]
+    queue = AdmissionQueue("hit", concurrency=1, max_queue=0, deadline=0.1)
+    monkeypatch.setitem(admission._queues, "hit", queue)
+    release = threading.Event()
+    thread = _hold(queue, release)
+    try:
+        for output in ("protobuf", "multipart"):
+            response = client.post("/batch_image", json={"fids": [fid], "output": output})
+            assert response.status_code == 503
+            assert int(response.headers["Retry-After"]) >= 1
+    finally:
+        release.set()
+        thread.join()
+    assert client.post("/batch_image", json={"fids": [fid]}).status_code == 200
@@ -0,0 +1,27 @@
+from conftest import create_image_bytes
+from nemivir.config import metadb
+
+
+def test_batch_delete(client, upload):
+    by_fid = upload(create_image_bytes(seed=301))
+    by_hash = [upload(create_image_bytes(seed=302)) for _ in range(2)]
+    kept = upload(create_image_bytes(seed=303))
+    assert client.get("/image/{}".format(by_fid["fid"])).status_code == 200
+
+    response = client.post("/batch_delete", json={"fids": [by_fid["fid"]], "hashes": [by_hash[0]["hash"]]})
+    assert response.status_code == 200, response.text
+    result = response.json()
+    assert result["status"] == "success"
+    assert result["failed"] == {}
+    assert sorted(result["removed"]) == sorted([by_fid["fid"]] + [i["fid"] for i in by_hash])
+
+    # Cached images are invalidated
+    assert client.get("/image/{}".format(by_fid["fid"])).status_code == 404
+    assert metadb.resource.list_images(by_hash[0]["hash"]) == []
+    assert client.get("/image/{}".format(kept["fid"])).status_code == 200
+
+
+def test_batch_delete_missing(client):
+    response = client.post("/batch_delete", json={"fids": [], "hashes": ["missing_hash"]})
+    assert response.status_code == 200, response.text
+    assert response.json()["removed"] == []
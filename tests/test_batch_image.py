@@ -0,0 +1,61 @@
+from email.parser import BytesParser
+from email.policy import HTTP
+from io import BytesIO
+
+from PIL import Image
+
+from conftest import create_image_bytes
+from nemivir.config import batch_max_items
+from nemivir.protos import iter_batch_items
+
+
+def _batch_get(client, **body) -> list:
+    response = client.post("/batch_image", json=body)
+    assert response.status_code == 200, response.text
+    assert response.headers["Content-Type"] == "application/x-protobuf"
+    items = sorted(iter_batch_items(BytesIO(response.content)), key=lambda item: item.index)
+    assert int(response.headers["X-Batch-Count"]) == len(items)
+    return items
+
+
+def test_batch_image_protobuf(client, upload):
+    first = upload(create_image_bytes(seed=201))
+    second = upload(create_image_bytes(seed=202))
+    body = dict(fids=[first["fid"], "missing_fid"], hashes=[second["hash"]], rescale=0.5, image_format="png")
+    items = _batch_get(client, **body)
+    assert [item.index for item in items] == [0, 1, 2]
+    assert [item.status for item in items] == [200, 404, 200]
+    assert items[0].fid == first["fid"]
+    assert items[2].image_hash == second["hash"]
+    assert items[2].fid == second["fid"]
+    for item in (items[0], items[2]):
+        assert item.cache == "MISS"
+        assert item.etag != ""
+        assert item.image.media_type == "image/png"
+        assert Image.open(BytesIO(item.image.content)).size == (32, 24)
+
+    cached = _batch_get(client, **body)
+    assert [item.cache for item in cached if item.status == 200] == ["HIT", "HIT"]
+    assert [item.image.content for item in cached] == [item.image.content for item in items]
+
+
+def test_batch_image_multipart(client, upload):
+    uploaded = upload(create_image_bytes(seed=203))
+    response = client.post("/batch_image", json=dict(fids=[uploaded["fid"], "missing_fid"], output="multipart"))
+    assert response.status_code == 200, response.text
+    message = BytesParser(policy=HTTP).parsebytes(
+        "Content-Type: {}\r\n\r\n".format(response.headers["Content-Type"]).encode() + response.content
+    )
+    parts = {int(part["X-Index"]): part for part in message.iter_parts()}
+    assert parts[0]["X-Status"] == "200"
+    assert parts[0]["X-Fid"] == uploaded["fid"]
+    assert parts[0]["ETag"] != ""
+    assert Image.open(BytesIO(parts[0].get_payload(decode=True))).size == (64, 48)
+    assert parts[1]["X-Status"] == "404"
+    assert parts[1].get_content_type() == "text/plain"
+
+
+def test_batch_image_parameters(client):
+    assert client.post("/batch_image", json={"fids": ["fid"] * (batch_max_items + 1)}).status_code == 422
+    assert client.post("/batch_image", json={"fids": ["fid"], "output": "json"}).status_code == 422
+    assert client.post("/batch_image", json={"fids": ["fid"], "image_format": "tga"}).status_code == 422
@@ -0,0 +1,16 @@
+from benchmark.api_benchmark import percentile
+
+
+def test_percentile_nearest_rank():
+    values = list(range(1, 11))
+    assert percentile(values, 50) == 5
+    assert percentile(values, 90) == 9
+    assert percentile(values, 95) == 10
+    assert percentile(values, 99) == 10
+    assert percentile(values, 100) == 10
+    assert percentile(values, 0) == 1
+    # p / 100 * n is exactly .5, round() to even used to give different ranks
+    assert percentile(list(range(1, 6)), 50) == 3
+    assert percentile(list(range(1, 4)), 50) == 2
+    assert percentile([3.0, 1.0, 2.0, 4.0], 25) == 1.0
+    assert percentile([7.0], 99) == 7.0
@@ -0,0 +1,155 @@
+from collections import Counter
+
+from redis import ConnectionError
+
+from nemivir.protos import create_image_response
+from nemivir.util import ConsistentHashRing, ShardedRedisImageCache
+
+NODES = ["redis://10.0.0.{}:6379/".format(i) for i in range(1, 5)]
+
+
+def test_hash_ring_distribution():
+    ring = ConsistentHashRing(NODES)
+    counts = Counter(ring.get_node("fid{}".format(i)) for i in range(20000))
+    assert set(counts) == set(NODES)
+    # Every node owns 25% +- 5% of the keys
+    assert all(3000 < count < 7000 for count in counts.values())
+    assert ring.get_node("fid1") == ConsistentHashRing(reversed(NODES)).get_node("fid1")
+
+
+def test_hash_ring_remapping():
+    keys = ["fid{}".format(i) for i in range(20000)]
+    before = ConsistentHashRing(NODES)
+    after = ConsistentHashRing(NODES + ["redis://10.0.0.5:6379/"])
+    moved = [key for key in keys if before.get_node(key) != after.get_node(key)]
+    # Only the keys moved to the new node, about 1/5 of them
+    assert all(after.get_node(key) == "redis://10.0.0.5:6379/" for key in moved)
+    assert 0.1 < len(moved) / len(keys) < 0.3
+
+    removed = ConsistentHashRing(NODES[:-1])
+    moved = [key for key in keys if before.get_node(key) != removed.get_node(key)]
+    assert all(before.get_node(key) == NODES[-1] for key in moved)
+
+
+class FakeRedis:
+    """
+    The commands of StrictRedis used by RedisImageCache (without expiring), fails all commands while down
+    """
+
+    def __init__(self):
+        self.data = {}
+        self.down = False
+
+    def _check(self):
+        if self.down:
+            raise ConnectionError("Connection refused")
+
+    def exists(self, key):
+        self._check()
+        return int(key in self.data)
+
+    def get(self, key):
+        self._check()
+        return self.data.get(key)
+
+    def mget(self, keys):
+        self._check()
+        return [self.data.get(key) for key in keys]
+
+    def setex(self, key, ttl, value):
+        self._check()
+        self.data[key] = value
+
+    def sadd(self, key, member):
+        self._check()
+        self.data.setdefault(key, set()).add(member)
+
+    def expire(self, key, ttl):
+        self._check()
+
+    def smembers(self, key):
+        self._check()
+        return set(self.data.get(key, set()))
+
+    def delete(self, key):
+        self._check()
+        self.data.pop(key, None)
+
+    def ping(self):
+        self._check()
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+
+class FakePipeline:
+    def __init__(self, client: FakeRedis):
+        self.client = client
+        self.commands = []
+
+    def __getattr__(self, name):
+        def command(*args):
+            self.commands.append((name, args))
+
+        return command
+
+    def execute(self):
+        # Commands are sent in one round trip, fails as a whole
+        self.client._check()
+        return [getattr(self.client, name)(*args) for name, args in self.commands]
+
+
+def _image_keys(client: FakeRedis) -> set:
+    return {key for key in client.data.keys() if "_idx_" not in key}
+
+
+def test_sharded_cache_distribution():
+    clients = {node: FakeRedis() for node in NODES}
+    cache = ShardedRedisImageCache(clients, default_ttl=60)
+    image = create_image_response(b"content", "image/png")
+    fids = ["fid{}".format(i) for i in range(400)]
+    cache.put_many([(fid, "(png,-,-,-)", image) for fid in fids])
+    cache.put(fids[0], "(webp,-,-,-)", image)
+
+    # Keys are spread across the nodes, all keys of a fid are on the same node
+    assert all(len(_image_keys(client)) > 50 for client in clients.values())
+    assert sum(len(_image_keys(client)) for client in clients.values()) == len(fids) + 1
+    assert len([client for client in clients.values() if "imc_fid0_(webp,-,-,-)" in client.data]) == 1
+    assert len([client for client in clients.values() if "imc_fid0_(png,-,-,-)" in client.data]) == 1
+    assert all(item.content == b"content" for item in cache.get_many([(fid, "(png,-,-,-)") for fid in fids]))
+    assert cache.get(fids[0], "(webp,-,-,-)").content == b"content"
+
+    cache.clean(fids[0])
+    assert cache.get_many([(fids[0], "(png,-,-,-)"), (fids[0], "(webp,-,-,-)")]) == [None, None]
+    cache.clean_many(fids[1:10])
+    assert cache.get_many([(fid, "(png,-,-,-)") for fid in fids[1:10]]) == [None] * 9
+    assert cache.get_many([(fids[10], "(png,-,-,-)")])[0] is not None
+
+
+def test_sharded_cache_node_down():
+    clients = {node: FakeRedis() for node in NODES}
+    cache = ShardedRedisImageCache(clients, default_ttl=60)
+    image = create_image_response(b"content", "image/png")
+    fids = ["fid{}".format(i) for i in range(400)]
+    cache.put_many([(fid, "(png,-,-,-)", image) for fid in fids])
+
+    down = clients[NODES[0]]
+    lost = {key for key in _image_keys(down)}
+    down.down = True
+    # Only the keys of the node which is down are missed
+    result = cache.get_many([(fid, "(png,-,-,-)") for fid in fids])
+    missed = {"imc_{}_(png,-,-,-)".format(fid) for fid, item in zip(fids, result) if item is None}
+    assert missed == lost
+    for fid in fids[:20]:
+        try:
+            assert cache.get(fid, "(png,-,-,-)").content == b"content"
+        except KeyError:
+            assert "imc_{}_(png,-,-,-)".format(fid) in lost
+
+    # Writing to the node which is down is skipped, the others are written
+    cache.put_many([(fid, "(webp,-,-,-)", image) for fid in fids])
+    written = sum(len(_image_keys(client)) for client in clients.values() if client is not down)
+    assert written == 2 * (len(fids) - len(lost))
+
+    down.down = False
+    assert all(item is not None for item in cache.get_many([(fid, "(png,-,-,-)") for fid in fids]))
@@ -0,0 +1,246 @@
+import asyncio
+import json
+import time
+from io import BytesIO
+from typing import Tuple
+
+import httpx
+import pytest
+import requests
+from requests.adapters import BaseAdapter
+
+from conftest import create_image_bytes
+from nemivir.client import NemivirClient, AsyncNemivirClient, NemivirError
+from nemivir.service.image_api import app
+
+
+class RecordAdapter(BaseAdapter):
+    """
+    Transport adapter which records the URLs and returns an empty JSON object
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.urls = []
+
+    def send(self, request, **kwargs):
+        self.urls.append(request.url)
+        response = requests.Response()
+        response.status_code = 200
+        response.headers["Content-Type"] = "application/json"
+        response._content = json.dumps({}).encode()
+        response.request = request
+        response.url = request.url
+        return response
+
+    def close(self):
+        pass
+
+
+def test_service_base_path():
+    for service in ("http://proxy/nemivir", "http://proxy/nemivir/"):
+        with NemivirClient(service) as client:
+            adapter = RecordAdapter()
+            client._session.mount("http://", adapter)
+            client.delete("fid1")
+            client.batch_delete(fids=["fid1"])
+            assert adapter.urls == ["http://proxy/nemivir/image/fid1", "http://proxy/nemivir/batch_delete"]
+
+
+class AppAdapter(BaseAdapter):
+    """
+    Transport adapter which sends the requests to the app by TestClient,
+    records (method, path, status) and fails the first `overloaded` requests with 503
+    """
+
+    def __init__(self, client, overloaded: int = 0, retry_after: str = "0.2"):
+        super().__init__()
+        self.client = client
+        self.overloaded = overloaded
+        self.retry_after = retry_after
+        self.sent = []
+
+    def send(self, request, **kwargs):
+        path = request.path_url.split("?")[0]
+        if self.overloaded > 0:
+            self.overloaded -= 1
+            status_code, headers, content = 503, {"Retry-After": self.retry_after}, b'{"message": "overloaded"}'
+        else:
+            app_response = self.client.request(
+                request.method, request.url, content=request.body, headers=dict(request.headers)
+            )
+            status_code, headers, content = app_response.status_code, app_response.headers, app_response.content
+        self.sent.append((request.method, path, status_code))
+        response = requests.Response()
+        response.status_code = status_code
+        response.headers.update(headers)
+        response.raw = BytesIO(content)
+        response.request = request
+        response.url = request.url
+        return response
+
+    def close(self):
+        pass
+
+
+class AppTransport(httpx.AsyncBaseTransport):
+    """
+    The same as AppAdapter for the asyncio client
+    """
+
+    def __init__(self, overloaded: int = 0, retry_after: str = "0.2"):
+        self.transport = httpx.ASGITransport(app=app)
+        self.overloaded = overloaded
+        self.retry_after = retry_after
+        self.sent = []
+
+    async def handle_async_request(self, request):
+        if self.overloaded > 0:
+            self.overloaded -= 1
+            response = httpx.Response(503, headers={"Retry-After": self.retry_after}, json={"message": "overloaded"})
+        else:
+            response = await self.transport.handle_async_request(request)
+        self.sent.append((request.method, request.url.path, response.status_code))
+        return response
+
+
+def _create_client(client, **options) -> Tuple[NemivirClient, AppAdapter]:
+    adapter = AppAdapter(client, options.pop("overloaded", 0))
+    sync_client = NemivirClient("http://testserver/", **options)
+    sync_client._session.mount("http://", adapter)
+    return sync_client, adapter
+
+
+def _create_async_client(**options) -> Tuple[AsyncNemivirClient, AppTransport]:
+    transport = AppTransport(options.pop("overloaded", 0))
+    async_client = AsyncNemivirClient("http://testserver/", **options)
+    async_client._client = httpx.AsyncClient(base_url="http://testserver/", transport=transport)
+    return async_client, transport
+
+
+def test_retry_after(client, upload):
+    fid = upload(create_image_bytes(seed=501))["fid"]
+    # Waiting 2.5~5 seconds by backoff if Retry-After is ignored
+    sync_client, adapter = _create_client(client, overloaded=2, backoff=5.0)
+    start_time = time.perf_counter()
+    assert sync_client.delete(fid)["status"] == "success"
+    assert 0.4 <= time.perf_counter() - start_time < 2.0
+    assert [status for _, _, status in adapter.sent] == [503, 503, 200]
+
+    sync_client, adapter = _create_client(client, overloaded=5, max_retries=1)
+    with pytest.raises(NemivirError) as error:
+        sync_client.delete(fid)
+    assert error.value.status_code == 503
+    assert error.value.retry_after == 0.2
+    assert len(adapter.sent) == 2
+
+
+def test_retry_after_async(upload):
+    fid = upload(create_image_bytes(seed=502))["fid"]
+
+    async def run():
+        async_client, transport = _create_async_client(overloaded=2, backoff=5.0)
+        async with async_client:
+            start_time = time.perf_counter()
+            assert (await async_client.delete(fid))["status"] == "success"
+            assert 0.4 <= time.perf_counter() - start_time < 2.0
+        assert [status for _, _, status in transport.sent] == [503, 503, 200]
+
+        async_client, transport = _create_async_client(overloaded=5, max_retries=1)
+        async with async_client:
+            with pytest.raises(NemivirError) as error:
+                await async_client.delete(fid)
+        assert error.value.status_code == 503
+        assert error.value.retry_after == 0.2
+        assert len(transport.sent) == 2
+
+    asyncio.run(run())
+
+
+def test_etag_cache(client, upload):
+    uploaded = upload(create_image_bytes(seed=503))
+    sync_client, adapter = _create_client(client)
+    first = sync_client.get_image(uploaded["fid"], w=32, h=24, image_format="png")
+    # Image by fid is immutable, never requested again
+    assert sync_client.get_image(uploaded["fid"], w=32, h=24, image_format="png").content == first.content
+    assert adapter.sent == [("GET", "/image/{}".format(uploaded["fid"]), 200)]
+    # Image by hash is revalidated
+    by_hash = sync_client.get_image_by_hash(uploaded["hash"])
+    assert sync_client.get_image_by_hash(uploaded["hash"]).content == by_hash.content
+    assert [status for _, path, status in adapter.sent if path.startswith("/hash/")] == [200, 304]
+    assert by_hash.media_type == "image/png"
+
+
+def test_etag_cache_async(upload):
+    uploaded = upload(create_image_bytes(seed=504))
+
+    async def run():
+        async_client, transport = _create_async_client()
+        async with async_client:
+            first = await async_client.get_image(uploaded["fid"], w=32, h=24, image_format="png")
+            second = await async_client.get_image(uploaded["fid"], w=32, h=24, image_format="png")
+            assert second.content == first.content
+            by_hash = await async_client.get_image_by_hash(uploaded["hash"])
+            assert (await async_client.get_image_by_hash(uploaded["hash"])).content == by_hash.content
+        assert transport.sent == [
+            ("GET", "/image/{}".format(uploaded["fid"]), 200),
+            ("GET", "/hash/{}".format(uploaded["hash"]), 200),
+            ("GET", "/hash/{}".format(uploaded["hash"]), 304),
+        ]
+
+    asyncio.run(run())
+
+
+def _check_batch_items(items: list, fids: list, hashes: list):
+    items = sorted(items, key=lambda item: item.index)
+    # Index is the position in fids + hashes of all batches
+    assert [item.index for item in items] == list(range(len(fids) + len(hashes)))
+    for item, fid in zip(items, fids):
+        assert item.fid == fid
+        assert item.status == (404 if fid == "missing_fid" else 200)
+    for item, image_hash in zip(items[len(fids):], hashes):
+        assert item.image_hash == image_hash
+        assert item.status == (404 if image_hash == "missing_hash" else 200)
+
+
+def test_batch_get(client, upload):
+    uploaded = [upload(create_image_bytes(seed=505 + i)) for i in range(3)]
+    fids = [uploaded[0]["fid"], "missing_fid", uploaded[1]["fid"]]
+    hashes = ["missing_hash", uploaded[2]["hash"]]
+    sync_client, adapter = _create_client(client)
+    _check_batch_items(list(sync_client.batch_get(fids, hashes, rescale=0.5, batch_size=2)), fids, hashes)
+    assert len(adapter.sent) == 3
+
+    async def run():
+        async_client, transport = _create_async_client()
+        async with async_client:
+            items = [item async for item in async_client.batch_get(fids, hashes, rescale=0.5, batch_size=2)]
+        _check_batch_items(items, fids, hashes)
+        assert len(transport.sent) == 3
+
+    asyncio.run(run())
+
+
+def test_upload_many(client, tmp_path):
+    path = tmp_path / "image.png"
+    path.write_bytes(create_image_bytes(seed=508))
+    items = [create_image_bytes(seed=509), b"not an image", str(path), str(tmp_path / "missing.png")]
+
+    def check(results: list):
+        # Failures are returned with the item, the others are uploaded
+        results = {id(item): result for item, result in results}
+        assert len(results) == 4
+        assert results[id(items[0])]["wrote"] and results[id(items[2])]["wrote"]
+        assert isinstance(results[id(items[1])], NemivirError)
+        assert results[id(items[1])].status_code == 422
+        assert isinstance(results[id(items[3])], FileNotFoundError)
+
+    sync_client, _ = _create_client(client)
+    check(list(sync_client.upload_many(iter(items), concurrency=2)))
+
+    async def run():
+        async_client, _ = _create_async_client()
+        async with async_client:
+            return [result async for result in async_client.upload_many(iter(items), concurrency=2)]
+
+    check(asyncio.run(run()))
@@ -0,0 +1,65 @@
+from email.utils import formatdate
+
+from conftest import create_image_bytes
+
+
+def test_etag_of_fid(client, upload):
+    fid = upload(create_image_bytes(seed=340))["fid"]
+    response = client.get("/image/{}".format(fid), params={"w": 16, "h": 16})
+    assert response.status_code == 200
+    assert "immutable" in response.headers["Cache-Control"]
+    etag = response.headers["ETag"]
+
+    response = client.get("/image/{}".format(fid), params={"w": 16, "h": 16}, headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.content == b""
+    response = client.get("/image/{}".format(fid), params={"w": 16, "h": 16},
+                          headers={"If-None-Match": "\"other\", W/{}".format(etag)})
+    assert response.status_code == 304
+    # Different transform parameters, different ETag
+    response = client.get("/image/{}".format(fid), params={"w": 8, "h": 8}, headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+
+
+def test_vary_on_auto_format(client, upload):
+    fid = upload(create_image_bytes(seed=341))["fid"]
+    response = client.get("/image/{}".format(fid), params={"image_format": "auto"},
+                          headers={"Accept": "image/webp,*/*"})
+    assert response.headers["content-type"] == "image/webp"
+    assert response.headers["Vary"] == "Accept"
+    response = client.get("/image/{}".format(fid), params={"image_format": "auto"}, headers={"Accept": "*/*"})
+    assert response.headers["content-type"] == "image/png"
+    assert response.headers["Vary"] == "Accept"
+    response = client.get("/image/{}".format(fid), params={"image_format": "webp"})
+    assert "Vary" not in response.headers
+
+
+def test_if_none_match_any(client, upload):
+    image = upload(create_image_bytes(seed=342))
+    assert client.get("/image/{}".format(image["fid"]), headers={"If-None-Match": "*"}).status_code == 304
+    assert client.get("/hash/{}".format(image["hash"]), headers={"If-None-Match": "*"}).status_code == 304
+
+    assert client.delete("/image/{}".format(image["fid"])).status_code == 200
+    assert client.get("/image/{}".format(image["fid"]), headers={"If-None-Match": "*"}).status_code == 404
+    assert client.get("/hash/{}".format(image["hash"]), headers={"If-None-Match": "*"}).status_code == 404
+
+
+def test_if_modified_since_of_hash(client, upload):
+    image = upload(create_image_bytes(seed=343))
+    response = client.get("/hash/{}".format(image["hash"]))
+    assert response.status_code == 200
+    last_modified = response.headers["Last-Modified"]
+    assert "no-cache" in response.headers["Cache-Control"]
+
+    response = client.get("/hash/{}".format(image["hash"]), headers={"If-Modified-Since": last_modified})
+    assert response.status_code == 304
+    earlier = formatdate(image["attach"]["tick"] / 1000.0 - 60, usegmt=True)
+    response = client.get("/hash/{}".format(image["hash"]), headers={"If-Modified-Since": earlier})
+    assert response.status_code == 200
+    # If-None-Match takes precedence
+    response = client.get("/hash/{}".format(image["hash"]),
+                          headers={"If-Modified-Since": last_modified, "If-None-Match": "\"other\""})
+    assert response.status_code == 200
+    response = client.get("/hash/{}".format(image["hash"]), headers={"If-Modified-Since": "garbage"})
+    assert response.status_code == 200
@@ -0,0 +1,40 @@
+from io import BytesIO
+
+import pytest
+from PIL import Image
+
+from nemivir.image import PillowEngine, OpenCVEngine
+
+
+def _rotated_jpeg(w: int = 500, h: int = 125) -> bytes:
+    """
+    JPEG with EXIF orientation 6 (rotate 90 degrees to display)
+    """
+    exif = Image.Exif()
+    exif[0x0112] = 6
+    with BytesIO() as fp:
+        Image.new("RGB", (w, h), (200, 30, 30)).save(fp, format="JPEG", exif=exif.tobytes())
+        return fp.getvalue()
+
+
+ENGINES = [PillowEngine] + ([OpenCVEngine] if OpenCVEngine.available() else [])
+
+
+@pytest.mark.parametrize("engine_class", ENGINES)
+@pytest.mark.parametrize("reduce_factor", [1, 2, 4, 8])
+def test_exif_orientation_is_ignored(engine_class, reduce_factor):
+    engine = engine_class()
+    w, h = engine.get_size(engine.decode(_rotated_jpeg(), reduce_factor))
+    # Orientation is never applied, the stored (landscape) orientation is kept at every scale
+    assert w > h
+    assert w <= 500 and w >= 500 // reduce_factor
+
+
+@pytest.mark.parametrize("engine_class", ENGINES)
+def test_transform_rotated_jpeg(engine_class):
+    engine = engine_class()
+    bitmap = engine.decode(_rotated_jpeg(), 4)
+    resized = engine.resize(bitmap, (100, 25))
+    assert engine.get_size(resized) == (100, 25)
+    with Image.open(BytesIO(engine.encode(resized, "png"))) as im:
+        assert im.size == (100, 25)
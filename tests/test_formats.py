@@ -0,0 +1,162 @@
+import time
+from io import BytesIO
+
+import numpy
+import pytest
+from PIL import Image
+
+from nemivir.config import filesystem
+from nemivir.image import transform_animated, ImageLimitError, EncoderProfile, EncoderProfileSelector
+from nemivir.image.encoder_profile import DEFAULT_PROFILE
+from nemivir.service import core
+from nemivir.service.core import check_image_format, get_format_label, cache_count, ParameterError
+from conftest import create_image_bytes
+
+
+def test_check_image_format():
+    assert check_image_format(None) is None
+    assert check_image_format("WEBP") == "webp"
+    assert check_image_format("jpg") == "jpeg"
+    with pytest.raises(ParameterError):
+        check_image_format("junk")
+
+
+def test_format_label_is_bounded():
+    assert get_format_label(None) == "original"
+    assert get_format_label("PNG") == "png"
+    assert get_format_label("auto") == "auto"
+    assert get_format_label("junk0") == get_format_label("junk1") == "other"
+
+
+def _format_labels() -> set:
+    return {
+        sample.labels["image_format"]
+        for metric in cache_count.collect()
+        for sample in metric.samples
+    }
+
+
+def test_unknown_format_is_rejected(client, upload):
+    fid = upload(create_image_bytes(seed=30))["fid"]
+    for i in range(3):
+        response = client.get("/image/{}".format(fid), params={"image_format": "junk{}".format(i)})
+        assert response.status_code == 422
+    response = client.post("/batch_image", json={"fids": [fid], "image_format": "junk"})
+    assert response.status_code == 422
+    response = client.post("/upload", params={"image_format": "junk"}, files={"file": ("a", create_image_bytes())})
+    assert response.status_code == 422
+    assert not any(label.startswith("junk") for label in _format_labels())
+
+
+def test_format_alias(client, upload):
+    fid = upload(create_image_bytes(seed=31))["fid"]
+    response = client.get("/image/{}".format(fid), params={"image_format": "JPG"})
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "image/jpeg"
+    assert "jpeg" in _format_labels()
+
+
+def _create_animation(image_format: str = "GIF", durations=(100, 200, 300), loop: int = 2) -> bytes:
+    rnd = numpy.random.RandomState(35)
+    frames = [Image.fromarray(numpy.uint8(rnd.randint(0, 255, (48, 64, 3)))) for _ in durations]
+    with BytesIO() as fp:
+        frames[0].save(fp, format=image_format, save_all=True, append_images=frames[1:],
+                       duration=list(durations), loop=loop)
+        return fp.getvalue()
+
+
+def _get_frames(data: bytes) -> tuple:
+    """
+    :return: format, size, durations of frames, loop
+    """
+    im = Image.open(BytesIO(data))
+    durations = []
+    for i in range(getattr(im, "n_frames", 1)):
+        im.seek(i)
+        # Duration of a WEBP frame is known after loading
+        im.load()
+        durations.append(im.info.get("duration"))
+    return im.format, im.size, durations, im.info.get("loop")
+
+
+@pytest.mark.parametrize("image_format", ["GIF", "WEBP"])
+def test_transform_animated(image_format):
+    im = Image.open(BytesIO(_create_animation()))
+    data = transform_animated(im, (32, 24), image_format, max_frames=10, max_pixels=1 << 20)
+    assert _get_frames(data) == (image_format, (32, 24), [100, 200, 300], 2)
+    # Original size
+    im = Image.open(BytesIO(_create_animation()))
+    data = transform_animated(im, None, image_format, max_frames=10, max_pixels=1 << 20)
+    assert _get_frames(data) == (image_format, (64, 48), [100, 200, 300], 2)
+
+
+def test_transform_animated_to_still_format():
+    im = Image.open(BytesIO(_create_animation()))
+    data = transform_animated(im, (32, 24), "PNG", max_frames=1, max_pixels=32 * 24)
+    image_format, size, durations, _ = _get_frames(data)
+    assert (image_format, size, len(durations)) == ("PNG", (32, 24), 1)
+
+
+def test_transform_animated_limits():
+    with pytest.raises(ImageLimitError):
+        transform_animated(Image.open(BytesIO(_create_animation())), None, "GIF", max_frames=2, max_pixels=1 << 20)
+    with pytest.raises(ImageLimitError):
+        transform_animated(Image.open(BytesIO(_create_animation())), None, "GIF", max_frames=10,
+                           max_pixels=3 * 64 * 48 - 1)
+
+
+def test_animated_upload_and_resize(client, upload):
+    uploaded = upload(_create_animation(), image_format="webp")
+    assert uploaded["attach"]["is_animated"]
+    assert uploaded["attach"]["encoder_profile"].startswith("webp-")
+    assert _get_frames(filesystem.resource.read(uploaded["fid"])) == ("WEBP", (64, 48), [100, 200, 300], 2)
+    for image_format in ("gif", "webp"):
+        response = client.get("/image/{}".format(uploaded["fid"]), params={"rescale": 0.5, "image_format": image_format})
+        assert response.status_code == 200, response.text
+        assert _get_frames(response.content) == (image_format.upper(), (32, 24), [100, 200, 300], 2)
+
+
+@pytest.fixture
+def idle(monkeypatch):
+    # Load average of the machine running the tests doesn't change the selection
+    monkeypatch.setattr("os.getloadavg", lambda: (0.0, 0.0, 0.0))
+
+
+def test_encoder_profile_per_format(idle):
+    selector = EncoderProfileSelector(time_budget=1.0)
+    # Small images get the best compression of each format, huge images the fastest profile
+    assert [selector.select(f, 100 * 100).name for f in ("webp", "JPEG", "png")] == \
+           ["webp-m6", "jpeg-progressive", "png-9"]
+    assert [selector.select(f, 1 << 30).name for f in ("webp", "JPEG", "png")] == ["webp-m0", "jpeg-fast", "png-1"]
+    assert selector.select("webp", 3 * 10 ** 6).name == "webp-m4"
+    assert selector.select("GIF", 100) == DEFAULT_PROFILE
+
+
+def test_encoder_profile_speed(idle):
+    slow = EncoderProfile("slow", {"method": 6}, 10.0)
+    fast = EncoderProfile("fast", {"method": 0}, 100.0)
+    selector = EncoderProfileSelector(time_budget=1.0, profiles={"WEBP": [slow, fast]}, alpha=1.0)
+    assert selector.select("WEBP", 5 * 10 ** 6) == slow
+    # Measured 1 megapixel per second, 5 megapixels can't be finished in budget
+    with selector.encoding(slow, 10 ** 5):
+        time.sleep(0.1)
+    assert selector.select("WEBP", 5 * 10 ** 6) == fast
+
+
+def test_encoder_profile_options_used(idle, monkeypatch, upload):
+    # Neither JPEG nor PNG, converted to both
+    content = create_image_bytes(seed=37, image_format="BMP")
+    reference = {}
+    for name, options in (("jpeg-q10", {"quality": 10}), ("png-1", {"compress_level": 1})):
+        with BytesIO() as fp:
+            Image.open(BytesIO(content)).convert("RGB").save(fp, format=name.split("-")[0].upper(), **options)
+            reference[name] = fp.getvalue()
+    selector = EncoderProfileSelector(time_budget=1.0, profiles={
+        "JPEG": [EncoderProfile("jpeg-q10", {"quality": 10}, 100.0)],
+        "PNG": [EncoderProfile("png-1", {"compress_level": 1}, 100.0)],
+    })
+    monkeypatch.setattr(core, "upload_encoder_profiles", selector)
+    for name, image_format in (("jpeg-q10", "jpeg"), ("png-1", "png")):
+        uploaded = upload(content, image_format=image_format, mode="keep")
+        assert uploaded["attach"]["encoder_profile"] == name
+        assert filesystem.resource.read(uploaded["fid"]) == reference[name]
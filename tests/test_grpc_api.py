@@ -0,0 +1,72 @@
+import pytest
+
+grpc = pytest.importorskip("grpc")
+
+from conftest import create_image_bytes
+from nemivir.protos import UploadRequest, BatchGetRequest, DeleteRequest
+from nemivir.protos.image_service_pb2_grpc import ImageServiceStub
+from nemivir.config import admission
+from nemivir.service.grpc_api import create_server
+from nemivir.util import AdmissionQueue
+
+
+@pytest.fixture(scope="module")
+def stub():
+    server = create_server(max_workers=4)
+    port = server.add_insecure_port("127.0.0.1:0")
+    server.start()
+    with grpc.insecure_channel("127.0.0.1:{}".format(port)) as channel:
+        yield ImageServiceStub(channel)
+    server.stop(None)
+
+
+def _upload(stub, contents: list) -> list:
+    requests = (
+        UploadRequest(content=content, request_id=str(i), image_format="png")
+        for i, content in enumerate(contents)
+    )
+    return list(stub.Upload(requests, timeout=30))
+
+
+def test_upload_stream(stub):
+    results = _upload(stub, [create_image_bytes(seed=401), b"not an image", create_image_bytes(seed=402)])
+    # Results are in the order of requests, a failed image doesn't stop the stream
+    assert [result.request_id for result in results] == ["0", "1", "2"]
+    assert [result.status for result in results] == [200, 422, 200]
+    assert all(results[i].wrote and results[i].fid != "" for i in (0, 2))
+
+
+def test_batch_get(stub):
+    uploaded = _upload(stub, [create_image_bytes(seed=403), create_image_bytes(seed=404)])
+    request = BatchGetRequest(
+        fids=[uploaded[0].fid, "missing_fid"], hashes=[uploaded[1].image_hash], rescale=0.5, image_format="webp"
+    )
+    items = sorted(stub.BatchGet(request, timeout=30), key=lambda item: item.index)
+    assert [item.status for item in items] == [200, 404, 200]
+    assert items[2].fid == uploaded[1].fid
+    assert all(items[i].image.media_type == "image/webp" for i in (0, 2))
+    cached = sorted(stub.BatchGet(request, timeout=30), key=lambda item: item.index)
+    assert [cached[i].cache for i in (0, 2)] == ["HIT", "HIT"]
+
+
+def test_batch_get_errors(stub, monkeypatch):
+    with pytest.raises(grpc.RpcError) as error:
+        list(stub.BatchGet(BatchGetRequest(fids=["fid"], image_format="tga"), timeout=30))
+    assert error.value.code() == grpc.StatusCode.INVALID_ARGUMENT
+
+    queue = AdmissionQueue("hit", 1, 0, 0.1)
+    monkeypatch.setitem(admission._queues, "hit", queue)
+    with queue.admit():
+        with pytest.raises(grpc.RpcError) as error:
+            list(stub.BatchGet(BatchGetRequest(fids=["fid"]), timeout=30))
+    assert error.value.code() == grpc.StatusCode.UNAVAILABLE
+    assert "retry-after" in dict(error.value.trailing_metadata())
+
+
+def test_delete(stub):
+    uploaded = _upload(stub, [create_image_bytes(seed=405), create_image_bytes(seed=406)])
+    result = stub.Delete(DeleteRequest(fids=[uploaded[0].fid], hashes=[uploaded[1].image_hash]), timeout=30)
+    assert sorted(result.removed) == sorted(r.fid for r in uploaded)
+    assert len(result.failed) == 0
+    items = list(stub.BatchGet(BatchGetRequest(fids=[r.fid for r in uploaded]), timeout=30))
+    assert [item.status for item in items] == [404, 404]
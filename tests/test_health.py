@@ -0,0 +1,44 @@
+import pytest
+import redis
+from redlock import Redlock
+
+from nemivir.util import LocalLockManager, RedisDistributedLock, LockError, ping_lock_manager
+
+
+def _unreachable_redis() -> redis.StrictRedis:
+    return redis.StrictRedis(host="127.0.0.1", port=1, socket_connect_timeout=0.5)
+
+
+def test_health_and_ready(client):
+    assert client.get("/health").status_code == 200
+    response = client.get("/ready")
+    assert response.status_code == 200, response.text
+
+
+def test_ready_fails_without_lock_backend(client):
+    from nemivir.config import lock_manager
+    original = lock_manager.resource
+    lock_manager.set_resource(Redlock([_unreachable_redis()]))
+    try:
+        response = client.get("/ready")
+    finally:
+        lock_manager.set_resource(original)
+    assert response.status_code == 503
+    assert set(response.json()["errors"]) == {"lock"}
+
+
+def test_ping_lock_manager_quorum():
+    ping_lock_manager(LocalLockManager())
+    with pytest.raises(Exception):
+        ping_lock_manager(Redlock([_unreachable_redis()]))
+
+
+def test_lock_timeout():
+    manager = LocalLockManager(retry_count=2)
+    with RedisDistributedLock(manager, "key"):
+        with pytest.raises(LockError):
+            with RedisDistributedLock(manager, "key"):
+                pass
+    # Released after the block
+    with RedisDistributedLock(manager, "key"):
+        pass
@@ -0,0 +1,78 @@
+from io import BytesIO
+
+import pytest
+
+from nemivir.image import LocalFileSystem, SQLiteMeta
+from conftest import create_image_bytes
+
+
+def test_local_filesystem_duplicated_content(tmp_path):
+    fs = LocalFileSystem(str(tmp_path))
+    fid1 = fs.write(b"same content")
+    fid2 = fs.upload(BytesIO(b"same content"))
+    assert fid1 != fid2
+    assert fs.read(fid1) == fs.read(fid2) == b"same content"
+    fs.delete(fid1)
+    with pytest.raises(KeyError):
+        fs.delete(fid1)
+    with pytest.raises(FileNotFoundError):
+        fs.read(fid1)
+    assert fs.read(fid2) == b"same content"
+
+
+def test_local_filesystem_download_and_empty_file(tmp_path):
+    fs = LocalFileSystem(str(tmp_path))
+    fid = fs.write(b"")
+    assert fs.read(fid) == b""
+    fid = fs.write(b"x" * 200000)
+    out = BytesIO()
+    fs.download(fid, out)
+    assert out.getvalue() == b"x" * 200000
+    with pytest.raises(FileNotFoundError):
+        fs.read("../../etc/passwd")
+    with pytest.raises(KeyError):
+        fs.delete("../../etc/passwd")
+
+
+def test_sqlite_meta(tmp_path):
+    meta = SQLiteMeta(str(tmp_path / "meta.db"))
+    meta.add_image("h1", "f1", w=10, h=20, format="PNG")
+    meta.add_image("h1", "f2", w=30, h=40)
+    meta.add_image("h2", "f3")
+    assert {i["fid"] for i in meta.list_images("h1")} == {"f1", "f2"}
+    assert meta.list_images("h1", limit=1)[0]["image_hash"] == "h1"
+    assert {i["fid"] for i in meta.list_images_by_hashes(["h1", "h2"])} == {"f1", "f2", "f3"}
+    assert [i["fid"] for i in meta.iter_images(batch_size=2)] == ["f1", "f2", "f3"]
+    assert [i["fid"] for i in meta.iter_images(after_fid="f1")] == ["f2", "f3"]
+    assert meta.replace_image("f1", "f4", format="WEBP")
+    assert not meta.replace_image("missing", "f5")
+    assert {(i["fid"], i.get("format")) for i in meta.list_images("h1")} == {("f4", "WEBP"), ("f2", None)}
+    meta.remove_image("f2")
+    with pytest.raises(KeyError):
+        meta.remove_image("f2")
+    assert meta.remove_images(["f3", "missing"]) == 1
+    assert meta.remove_hash("h1") == 1
+    assert meta.list_images_by_hashes(["h1", "h2"]) == []
+
+
+def test_duplicated_upload(client, upload):
+    content = create_image_bytes(seed=26)
+    first = upload(content)
+    second = upload(content)
+    assert first["wrote"] and second["wrote"]
+    assert first["fid"] != second["fid"]
+    assert first["hash"] == second["hash"]
+    assert upload(content, mode="block")["wrote"] is False
+
+    assert client.delete("/image/{}".format(first["fid"])).status_code == 200
+    response = client.get("/image/{}".format(second["fid"]))
+    assert response.status_code == 200
+    assert response.content == content
+    assert client.get("/hash/{}".format(first["hash"])).content == content
+
+
+def test_invalid_fid(client):
+    # Malformed fid (a SeaweedFS fid on the local backend) and missing fid are both not found
+    for fid in ("xyz,123", "3,01637037d6", "0" * 80):
+        assert client.get("/image/{}".format(fid)).status_code == 404
+        assert client.get("/image/{}".format(fid), params={"w": 32, "h": 32}).status_code == 404
@@ -0,0 +1,135 @@
+import json
+import threading
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from starlette.requests import Request
+
+from conftest import create_image_bytes
+from nemivir.image.filesystem import MultipartFileBody, WeedFileSystem
+from nemivir.util import RequestSizeLimit
+
+
+def _parse_file(content_type: str, body: bytes) -> bytes:
+    message = BytesParser(policy=HTTP).parsebytes(
+        "Content-Type: {}\r\n\r\n".format(content_type).encode("utf-8") + body
+    )
+    parts = list(message.iter_parts())
+    assert len(parts) == 1
+    assert parts[0].get_param("name", header="content-disposition") == "file"
+    return parts[0].get_payload(decode=True)
+
+
+@pytest.mark.parametrize("read_size", [1, 7, 4096, -1])
+def test_multipart_body_read(read_size):
+    content = bytes(range(256)) * 100
+    fp = BytesIO(b"skipped" + content)
+    fp.seek(7)
+    body = MultipartFileBody(fp)
+    chunks = []
+    while True:
+        chunk = body.read(read_size)
+        if len(chunk) == 0:
+            break
+        assert read_size < 0 or len(chunk) <= read_size
+        chunks.append(chunk)
+    data = b"".join(chunks)
+    assert len(data) == len(body)
+    assert _parse_file(body.content_type, data) == content
+
+
+def test_multipart_body_iter():
+    content = b"x" * 100000
+    body = MultipartFileBody(BytesIO(content), chunk_size=1000)
+    chunks = list(body)
+    assert max(len(chunk) for chunk in chunks) <= 1000
+    assert _parse_file(body.content_type, b"".join(chunks)) == content
+
+
+class _VolumeHandler(BaseHTTPRequestHandler):
+    received = []
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        self.received.append((self.path, self.headers.get("Transfer-Encoding"), self.headers["Content-Type"], body))
+        response = json.dumps({"size": len(body)}).encode("utf-8")
+        self.send_response(201)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, *args):
+        pass
+
+
+def test_save_file():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _VolumeHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        content = bytes(range(256)) * 1000
+        url = "http://127.0.0.1:{}/".format(server.server_address[1])
+        WeedFileSystem._save_file(url, "3,01637037d6", BytesIO(content), timeout=5)
+        path, transfer_encoding, content_type, body = _VolumeHandler.received[-1]
+        assert path == "/3,01637037d6"
+        # Sent with Content-Length, not chunked
+        assert transfer_encoding is None
+        assert _parse_file(content_type, body) == content
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.fixture(scope="module")
+def limited_client():
+    limited_app = FastAPI()
+    limited_app.add_middleware(RequestSizeLimit, max_bytes=1000, paths=["/upload"])
+
+    @limited_app.post("/upload")
+    async def receive_body(request: Request):
+        return {"size": len(await request.body())}
+
+    @limited_app.post("/other")
+    async def receive_other(request: Request):
+        return {"size": len(await request.body())}
+
+    with TestClient(limited_app) as test_client:
+        yield test_client
+
+
+def test_request_size_limit_content_length(limited_client):
+    response = limited_client.post("/upload", content=b"x" * 1000)
+    assert response.status_code == 200
+    assert response.json() == {"size": 1000}
+    response = limited_client.post("/upload", content=b"x" * 1001)
+    assert response.status_code == 413
+    assert response.json()["status"] == "fail"
+    # Other paths are not limited
+    assert limited_client.post("/other", content=b"x" * 5000).json() == {"size": 5000}
+
+
+def test_request_size_limit_chunked(limited_client):
+    def chunks(count: int):
+        for _ in range(count):
+            yield b"x" * 300
+
+    # Sent without Content-Length, counted while receiving
+    response = limited_client.post("/upload", content=chunks(3))
+    assert response.request.headers.get("Transfer-Encoding") == "chunked"
+    assert response.status_code == 200
+    assert response.json() == {"size": 900}
+    response = limited_client.post("/upload", content=chunks(4))
+    assert response.status_code == 413
+
+
+def test_upload_under_limit(client):
+    content = create_image_bytes(seed=601)
+    response = client.post("/upload", files={"file": ("image", content)}, params={"image_format": "original"})
+    assert response.status_code == 200, response.text
+    assert client.get("/image/{}".format(response.json()["fid"])).content == content
@@ -0,0 +1,22 @@
+from conftest import create_image_bytes
+
+
+def test_profile_by_header(client, upload):
+    fid = upload(create_image_bytes(seed=310))["fid"]
+    response = client.get("/image/{}".format(fid), params={"w": 20, "h": 20}, headers={"X-Nemivir-Profile": "1"})
+    assert response.status_code == 200
+    assert "X-Profile-Samples" in response.headers
+
+
+def test_not_profiled_by_default(client):
+    response = client.get("/health")
+    assert response.status_code == 200
+    assert "X-Profile-Samples" not in response.headers
+
+
+def test_streamed_response_is_profiled(client, upload):
+    fid = upload(create_image_bytes(seed=311))["fid"]
+    response = client.post("/batch_image", json={"fids": [fid]}, headers={"X-Nemivir-Profile": "1"})
+    assert response.status_code == 200
+    assert "X-Profile-Samples" in response.headers
+    assert len(response.content) > 0
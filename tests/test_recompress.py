@@ -0,0 +1,92 @@
+import time
+from io import BytesIO
+
+import numpy
+from PIL import Image
+
+from conftest import create_image_bytes
+from nemivir.config import metadb, filesystem, lock_manager
+from nemivir.service.recompress import Recompressor
+from nemivir.util import LocalLockManager
+
+
+def _create_gradient(image_format: str, **kwargs) -> bytes:
+    """
+    Smooth image which lossless WEBP compresses much better than uncompressed PNG
+    """
+    row = numpy.linspace(0, 255, 128)
+    im = Image.fromarray(numpy.uint8(numpy.dstack([numpy.tile(row, (96, 1))] * 3)))
+    with BytesIO() as fp:
+        im.save(fp, format=image_format, **kwargs)
+        return fp.getvalue()
+
+
+def _run(tmp_path, **options) -> dict:
+    return Recompressor(
+        str(tmp_path / "checkpoint.json"), min_bytes=0, processes=1, **options
+    ).run()
+
+
+def _count_originals() -> int:
+    return len([info for info in metadb.resource.iter_images() if "original_format" not in info])
+
+
+def test_recompress_lossless_only(tmp_path, client, upload):
+    png = upload(_create_gradient("PNG", compress_level=0), image_format="original")
+    jpeg = upload(create_image_bytes(image_format="JPEG", seed=101), image_format="original")
+    last_modified = client.get("/hash/{}".format(png["hash"])).headers["Last-Modified"]
+    assert _run(tmp_path, dry_run=True)["recompressed"] >= 1
+    assert metadb.resource.list_images(png["hash"])[0]["fid"] == png["fid"]
+
+    # Last-Modified is in seconds
+    time.sleep(1.1)
+    originals = _count_originals()
+    report = _run(tmp_path)
+    # The new fids written by the run are not scanned again
+    assert report["scanned"] == originals
+    assert report["scanned"] == report["recompressed"] + report["skipped"] + report["failed"]
+    png_info = metadb.resource.list_images(png["hash"])[0]
+    assert png_info["fid"] != png["fid"]
+    assert png_info["format"] == "WEBP"
+    assert png_info["original_format"] == "PNG"
+    assert Image.open(BytesIO(filesystem.resource.read(png_info["fid"]))).format == "WEBP"
+    response = client.get("/hash/{}".format(png["hash"]), headers={"If-Modified-Since": last_modified})
+    assert response.status_code == 200
+    assert response.headers["Last-Modified"] != last_modified
+    # JPEG is lossy, skipped by default
+    jpeg_info = metadb.resource.list_images(jpeg["hash"])[0]
+    assert jpeg_info["fid"] == jpeg["fid"]
+    assert jpeg_info["format"] == "JPEG"
+
+
+def test_recompress_allow_lossy(tmp_path, upload):
+    # Vertical gradient, not the same hash as the PNG above
+    column = numpy.linspace(0, 255, 256).reshape(256, 1)
+    im = Image.fromarray(numpy.uint8(numpy.dstack([numpy.tile(column, (1, 256))] * 3)))
+    with BytesIO() as fp:
+        im.save(fp, format="JPEG", quality=100)
+        jpeg = upload(fp.getvalue(), image_format="original")
+    _run(tmp_path, allow_lossy=True, quality=50)
+    jpeg_info = metadb.resource.list_images(jpeg["hash"])[0]
+    assert jpeg_info["fid"] != jpeg["fid"]
+    assert jpeg_info["original_format"] == "JPEG"
+
+
+def test_recompress_locked(tmp_path, upload):
+    # Diagonal gradient, not the same hash as the others
+    gradient = numpy.add.outer(numpy.arange(96), numpy.arange(128)) * 255 / 222
+    with BytesIO() as fp:
+        Image.fromarray(numpy.uint8(numpy.dstack([gradient] * 3))).save(fp, format="PNG", compress_level=0)
+        png = upload(fp.getvalue(), image_format="original")
+    original = lock_manager.resource
+    lock_manager.set_resource(LocalLockManager(retry_count=2))
+    try:
+        # Locked by an upload or a delete of the hash
+        lock_manager.resource.lock(png["hash"], 60000)
+        report = _run(tmp_path)
+    finally:
+        lock_manager.set_resource(original)
+    assert report["failed"] >= 1
+    info = metadb.resource.list_images(png["hash"])[0]
+    assert info["fid"] == png["fid"]
+    assert "original_format" not in info
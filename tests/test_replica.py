@@ -0,0 +1,172 @@
+import threading
+import time
+
+import pytest
+import requests
+
+from nemivir.image import filesystem
+from nemivir.image.filesystem import WeedFileSystem
+from nemivir.image.replica import ReplicaSelector
+
+
+def test_rank_by_latency():
+    selector = ReplicaSelector(explore_ratio=0)
+    for _ in range(5):
+        selector.record("slow:8080", 0.2, True)
+        selector.record("fast:8080", 0.01, True)
+    # Unknown host is measured first
+    assert selector.rank(["slow:8080", "fast:8080", "new:8080"]) == ["new:8080", "fast:8080", "slow:8080"]
+    # EWMA follows the recent latencies
+    for _ in range(20):
+        selector.record("slow:8080", 0.001, True)
+    assert selector.rank(["slow:8080", "fast:8080"]) == ["slow:8080", "fast:8080"]
+
+
+def test_error_penalty():
+    selector = ReplicaSelector(explore_ratio=0, error_penalty=10.0)
+    selector.record("a:8080", 0.01, True)
+    selector.record("b:8080", 0.02, True)
+    selector.record("a:8080", 0.001, False)
+    assert selector.get_stats()["a:8080"]["error_rate"] == pytest.approx(0.2)
+    # A failed request doesn't lower the latency, and the error rate raises the score
+    assert selector.get_stats()["a:8080"]["latency"] == pytest.approx(0.01)
+    assert selector.score("a:8080") == pytest.approx(0.01 * 3)
+    assert selector.rank(["a:8080", "b:8080"]) == ["b:8080", "a:8080"]
+
+
+def test_record_slow():
+    selector = ReplicaSelector(explore_ratio=0, alpha=0.5)
+    selector.record("a:8080", 0.01, True)
+    selector.record_slow("a:8080", 0.005)
+    assert selector.get_stats()["a:8080"]["latency"] == pytest.approx(0.01)
+    selector.record_slow("a:8080", 0.11)
+    assert selector.get_stats()["a:8080"]["latency"] == pytest.approx(0.06)
+
+
+def test_hedge_delay():
+    selector = ReplicaSelector(hedge_percentile=90, default_hedge_delay=0.05, min_hedge_delay=0.005)
+    assert selector.hedging
+    assert selector.get_hedge_delay() == 0.05
+    for i in range(100):
+        selector.record("a:8080", (i + 1) / 1000, True)
+    assert selector.get_hedge_delay() == pytest.approx(0.091)
+    fast = ReplicaSelector(min_hedge_delay=0.005)
+    for _ in range(100):
+        fast.record("a:8080", 0.0001, True)
+    assert fast.get_hedge_delay() == 0.005
+    assert not ReplicaSelector(hedge_percentile=None).hedging
+
+
+class FakeResponse:
+    def __init__(self, host: str, status_code: int):
+        self.host = host
+        self.status_code = status_code
+        self.closed = False
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError("{} Error".format(self.status_code), response=self)
+
+    def close(self):
+        self.closed = True
+
+
+class FakeVolumeServers:
+    """
+    Stub of requests.get: host -> (delay in seconds, status code or None for connection error)
+    """
+
+    def __init__(self, replicas: dict):
+        self.replicas = replicas
+        self.requested = []
+        self.responses = []
+        self._lock = threading.Lock()
+
+    def get(self, url, stream=False, timeout=None):
+        host = url.split("/")[2]
+        with self._lock:
+            self.requested.append(host)
+        delay, status_code = self.replicas[host]
+        time.sleep(delay)
+        if status_code is None:
+            raise requests.ConnectionError("Connection refused: {}".format(host))
+        response = FakeResponse(host, status_code)
+        with self._lock:
+            self.responses.append(response)
+        return response
+
+
+@pytest.fixture
+def volume_servers(monkeypatch):
+    def create(replicas: dict, hedge_percentile=95.0) -> WeedFileSystem:
+        servers = FakeVolumeServers(replicas)
+        monkeypatch.setattr(filesystem.requests, "get", servers.get)
+        selector = ReplicaSelector(explore_ratio=0, hedge_percentile=hedge_percentile, default_hedge_delay=0.05)
+        # Rank the replicas in the order of the dict
+        for i, host in enumerate(replicas.keys()):
+            selector.record(host, (i + 1) / 1000, True)
+        fs = WeedFileSystem("http://master:9333/", replica_selector=selector)
+        fs.servers = servers
+        return fs
+
+    return create
+
+
+def _open(fs: WeedFileSystem):
+    urls = ["http://{}/3,01637037d6".format(host) for host in fs.servers.replicas.keys()]
+    start_time = time.perf_counter()
+    response = fs._open_fastest(urls)
+    return response, time.perf_counter() - start_time
+
+
+def test_fast_primary(volume_servers):
+    fs = volume_servers({"a:8080": (0, 200), "b:8080": (0, 200)})
+    response, _ = _open(fs)
+    assert response.host == "a:8080"
+    assert fs.servers.requested == ["a:8080"]
+
+
+def test_hedge_wins(volume_servers):
+    fs = volume_servers({"a:8080": (0.5, 200), "b:8080": (0, 200), "c:8080": (0, 200)})
+    response, elapsed = _open(fs)
+    assert response.host == "b:8080"
+    assert elapsed < 0.3
+    # Only one hedged request
+    assert fs.servers.requested == ["a:8080", "b:8080"]
+    # The slow primary is avoided next time, and its response is closed once it arrives
+    assert fs.get_replica_stats()["a:8080"]["latency"] > fs.get_replica_stats()["b:8080"]["latency"]
+    time.sleep(0.6)
+    loser = [r for r in fs.servers.responses if r.host == "a:8080"]
+    assert len(loser) == 1 and loser[0].closed
+
+
+def test_no_hedging(volume_servers):
+    fs = volume_servers({"a:8080": (0.2, 200), "b:8080": (0, 200)}, hedge_percentile=None)
+    response, elapsed = _open(fs)
+    assert response.host == "a:8080"
+    assert fs.servers.requested == ["a:8080"]
+
+
+def test_failover(volume_servers):
+    fs = volume_servers({"a:8080": (0, None), "b:8080": (0, 500), "c:8080": (0, 200)})
+    response, _ = _open(fs)
+    assert response.host == "c:8080"
+    assert fs.servers.requested == ["a:8080", "b:8080", "c:8080"]
+    assert [r.closed for r in fs.servers.responses if r.host == "b:8080"] == [True]
+    assert fs.get_replica_stats()["a:8080"]["error_rate"] > 0
+
+
+def test_failed_hedge_replaced(volume_servers):
+    # The hedged request fails fast while the primary is slow, the next replica is requested at once
+    fs = volume_servers({"a:8080": (0.5, 200), "b:8080": (0, None), "c:8080": (0, 200)})
+    response, elapsed = _open(fs)
+    assert response.host == "c:8080"
+    assert elapsed < 0.3
+
+
+def test_all_failed(volume_servers):
+    fs = volume_servers({"a:8080": (0, None), "b:8080": (0, 404)})
+    with pytest.raises(requests.HTTPError):
+        _open(fs)
+    with pytest.raises(FileNotFoundError):
+        fs._open_fastest([])